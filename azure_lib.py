@@ -9,1279 +9,6640 @@
 #
 ###########################################################
 import re
+import sys
+import argparse
+import shutil
+import tempfile
+import fnmatch
 import logging
 import time
 import yaml
 import os
 import ast
-from subprocess import check_output
+import codecs
+import io
+import gzip
+import shlex
+import hashlib
+import mmap
+import copy
+import base64
+import math
+import random
+import sqlite3
+import ipaddress
+import bisect
+import heapq
+import threading
+import signal
+import weakref
+import queue
+import http.client
+import json as jsonlib
+from collections import namedtuple, deque
+from itertools import takewhile
+from contextlib import contextmanager
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from subprocess import Popen, PIPE, CalledProcessError, TimeoutExpired
+from urllib.parse import urlsplit, urlencode, quote
+from email.utils import parsedate_to_datetime
+try:
+    import jmespath
+except ImportError:
+    jmespath = None
 
 log = logging.getLogger(__name__)
 
-class AzureCLI():
-    '''
-    This is the base class for the Azure CLI. Allows you to login and do 
-    Base manipulations of Azure. Can either login using Application-ID, 
-    Directory-ID and Auth-Key, or by Username and Password. Make sure to 
-    provide all the required parameters for chosen method.
+# Typed record returned by Resource Graph queries
+GraphRecord = namedtuple('GraphRecord', ['id', 'name', 'type', 'resource_group', 'location',
+                                         'subscription_id', 'tags', 'properties'])
 
-    Initial Arguments:
-            * self: is the container
-            * appid: Azure Application ID to connect to, default None
-            * dirid: Azure Directory ID to connect to, default None
-            * key: Azure Secret Key used to connect, default None
+# Outcome of one step of a plan run by run_plan, start and elapsed in seconds
+PlanStepResult = namedtuple('PlanStepResult', ['id', 'method', 'status', 'result', 'error', 'start', 'elapsed'])
 
-            * username : Azure username, default None
-            * pw : Azure Password, default None
-    '''
+# Outcome of deleting one resource group in a bulk teardown
+RGTeardownResult = namedtuple('RGTeardownResult', ['name', 'status', 'elapsed', 'error'])
 
-    def __init__(self, appid=None, dirid=None, key=None, username=None, pw=None):
-        '''Azure CLI base class __init__ will set global variables to use in object'''
-        self.type       = 'azure'
-        #Check which method using to login confirm all needed parameters included
-        if (appid and dirid and key):
-            self.appid = appid
-            self.dirid = dirid
-            self.key = key
-        elif (username and pw):
-            self.username = username
-            self.pw = pw 
-        else: 
-            raise  ValueError("Either use Application-ID, Directory-ID and Auth-Key or Username and PW to login,"\
-                             " make sure to provide all parameters of your chosen method")
+# Desired or actual route in a route table
+Route = namedtuple('Route', ['name', 'prefix', 'next_hop_type', 'next_hop_add'])
+Route.__new__.__defaults__ = ("VirtualAppliance", None)
 
-        self.is_logged_in = False
+# Route changes needed to make route table match desired routes
+RouteDiff = namedtuple('RouteDiff', ['adds', 'updates', 'deletes', 'unchanged'])
+
+# Resource recorded in a StateStore
+StoredResource = namedtuple('StoredResource', ['id', 'type', 'resource_group', 'parent', 'created_at',
+                                               'workflow', 'deleted_at'])
+
+# Result of tearing down recorded resources
+TeardownReport = namedtuple('TeardownReport', ['waves', 'deleted', 'failed', 'dry_run'])
+
+# Target of a fan-out operation, None leaves subscription, location or group at CLI default
+FanOutTarget = namedtuple('FanOutTarget', ['subscription', 'location', 'rg_name'])
+FanOutTarget.__new__.__defaults__ = (None, None)
+
+# Outcome of a fan-out operation for one target
+FanOutResult = namedtuple('FanOutResult', ['target', 'ok', 'result', 'error', 'elapsed'])
 
+# Result of a blob download or upload, skipped bytes didn't have to be transferred
+BlobTransfer = namedtuple('BlobTransfer', ['path', 'size', 'transferred', 'skipped', 'elapsed'])
+
+# Environment kept ready by a WarmPool
+PoolEnvironment = namedtuple('PoolEnvironment', ['rg_name', 'vnet_name', 'subnet_name', 'storage_name',
+                                                 'container_name', 'vm_names'])
+
+# Outcome of waiting for one resource in a shared polling loop
+WaitResult = namedtuple('WaitResult', ['key', 'status', 'state', 'elapsed'])
+
+# Outcome of refreshing an inventory, full is True when everything was listed again
+InventoryRefresh = namedtuple('InventoryRefresh', ['full', 'events', 'updated', 'removed', 'elapsed'])
+
+# Result of sweeping orphaned resources
+SweepReport = namedtuple('SweepReport', ['orphans', 'deleted', 'failed', 'dry_run'])
+
+def _props(record):
+    '''Properties of resource - CLI output is flattened, ARM and Resource Graph output uses properties'''
+    return record.get('properties') or record
+
+def _kql_str(value):
+    '''Formats value as a quoted KQL string literal'''
+    return "'%s'" %str(value).replace("'", "\\'")
+
+def _kql_list(values):
+    '''Formats python list as a KQL literal list ie ('a', 'b')'''
+    return "(%s)" %", ".join(_kql_str(value) for value in values)
+
+def _jmes_str(value):
+    '''Formats value as a JMESPath raw string literal'''
+    return "'%s'" %str(value).replace("'", "\\'")
+
+def _field_names(fields):
     '''
-    ************************************
-    Azure Connectivity Functions
-    ************************************
+    Dictionary of output name and field path for fields given as path, list of paths (named by
+    their last segment) or dictionary. Raises ValueError when two paths end in the same name
+    '''
+    if isinstance(fields, str):
+        fields = [fields]
+    if isinstance(fields, dict):
+        return fields
+    named = {}
+    for path in fields:
+        name = path.split('.')[-1]
+        if name in named and named[name] != path:
+            raise ValueError("Fields %s and %s both output as %s, name them with a dictionary"
+                             %(named[name], path, name))
+        named[name] = path
+    return named
+
+def _fields_query(fields, many=True, tsv=False):
+    '''
+    JMESPath projection of fields ie ['name', 'ipAddress'] or {'ip': 'ipAddress'} - a hash of
+    fields, or for tsv output a list so values keep their order
+    '''
+    fields = _field_names(fields)
+    if tsv:
+        projection = "[%s]" %", ".join(fields.values())
+    else:
+        projection = "{%s}" %", ".join("%s:%s" %(name, path) for name, path in fields.items())
+    return "[]." + projection if many else projection
+
+def _flatten(record):
+    '''Record with its properties lifted to the top like Azure CLI output'''
+    flat = dict((key, value) for key, value in record.items() if key != 'properties')
+    flat.update(record.get('properties') or {})
+    return flat
+
+def _select_fields(records, fields, many=True):
+    '''Selects fields from records locally, see _fields_query'''
+    fields = _field_names(fields)
+
+    def select(record):
+        selected = {}
+        for name, path in fields.items():
+            value = record
+            for key in path.split('.'):
+                value = value.get(key) if isinstance(value, dict) else None
+            selected[name] = value
+        return selected
+
+    return [select(record) for record in records] if many else select(records)
+
+def _tsv(value):
+    '''Formats value as tab separated lines like Azure CLI tsv output'''
+    def cell(item):
+        if item is None:
+            return ""
+        if isinstance(item, (dict, list)):
+            return jsonlib.dumps(item)
+        return str(item)
+
+    def row(item):
+        if isinstance(item, dict):
+            item = list(item.values())
+        return "\t".join(cell(column) for column in item) if isinstance(item, list) else cell(item)
+
+    rows = value if isinstance(value, list) else [value]
+    return "".join(row(item) + "\n" for item in rows)
+
+def _iter_json_array(stream, chunk_size=65536):
+    '''
+    Incrementally parses a JSON array read from a byte stream, yielding each element as soon
+    as it has been read so only the current element is held in memory
+    '''
+    decoder = jsonlib.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ""
+    started = False
+    while True:
+        chunk = stream.read(chunk_size)
+        buf += utf8.decode(chunk, final=not chunk)
+        pos = 0
+        while True:
+            #Skip whitespace and separators between elements
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError("Expected JSON array in output, found %r" %buf[pos:pos+20])
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                #Element not complete yet - read more data
+                if not chunk:
+                    raise
+                break
+            if chunk and (end == len(buf) or buf[end] not in " \t\r\n,]"):
+                #Scalar element may be cut off at the end of the chunk, ie 1.5 read as 1 - read more data
+                break
+            yield element
+            pos = end
+        buf = buf[pos:]
+        if not chunk:
+            if buf.strip() or started:
+                raise ValueError("JSON array in output is truncated")
+            return
+
+def _hash_blocks(file_path, block_size, max_workers=8):
+    '''
+    Hashes file in blocks of block_size over a memory map, blocks hashed at the same time since
+    hashlib releases the GIL. Returns size of file and list of sha256 hex digests, None for
+    blocks that are all zeros
+    '''
+    size = os.path.getsize(file_path)
+    if not size:
+        return 0, []
+    zero_digests = {}
+    with open(file_path, 'rb') as image, mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        data = memoryview(view)
+
+        def digest(start):
+            block = data[start:start + block_size]
+            length = len(block)
+            value = hashlib.sha256(block).hexdigest()
+            block.release()
+            if length not in zero_digests:
+                zero_digests[length] = hashlib.sha256(bytes(length)).hexdigest()
+            return None if value == zero_digests[length] else value
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as hash_pool:
+                digests = list(hash_pool.map(digest, range(0, size, block_size)))
+        finally:
+            data.release()
+    return size, digests
+
+class AzCassette():
+    '''
+    Records every command run by an AzureCLI object together with its argv, output, exit code
+    and latency, or replays recorded responses so workflows can be run and timed without
+    Azure. Recordings are kept in memory and written as compact JSON lines (gzipped when path
+    ends with .gz) on save(), with secrets such as passwords and storage keys masked. In replay
+    mode a command recorded several times is answered in recorded order, the last response is
+    reused once they run out.
+
+    Initial Arguments:
+            * path: Cassette file to write or read
+            * mode: 'record' or 'replay', default 'replay'
+            * replay_latency: Sleep for the recorded latency of each command on replay, default False
+            * latency_scale: Multiplier applied to recorded latency on replay, default 1.0
     '''
 
-    def login_azure_cli(self):
+    def __init__(self, path, mode="replay", replay_latency=False, latency_scale=1.0):
+        '''Cassette __init__ loads recorded interactions in replay mode'''
+        if mode not in ("record", "replay"):
+            raise ValueError("Cassette mode has to be 'record' or 'replay' not %s" %mode)
+
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.latency_scale = latency_scale
+        self.secrets = set()
+        self.interactions = []
+        self._responses = {}
+        self._lock = threading.Lock()
+
+        if mode == "replay":
+            with self._open('rt') as cassette:
+                for line in cassette:
+                    if line.strip():
+                        interaction = jsonlib.loads(line)
+                        self.interactions.append(interaction)
+                        self._responses.setdefault(tuple(interaction['argv']), deque()).append(interaction)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.mode == "record":
+            self.save()
+
+    def _open(self, mode):
+        if self.path.endswith('.gz'):
+            return gzip.open(self.path, mode)
+        return open(self.path, mode)
+
+    def add_secrets(self, secrets):
+        '''Adds values to be masked in recorded commands and output'''
+        with self._lock:
+            self.secrets.update(secret for secret in secrets if secret)
+
+    def _redact(self, text):
+        for secret in self.secrets:
+            text = text.replace(secret, "***")
+        return text
+
+    def _argv(self, cmd):
+        argv = cmd if isinstance(cmd, list) else shlex.split(cmd)
+        return [self._redact(str(arg)) for arg in argv]
+
+    def play(self, cmd, run):
         '''
         Purpose:
-                Checks Azure CLI is installed on box then logs in with either 
-                Username and Password or Application-ID, Directory-ID and Auth-Key
-                depending on how azure object was initialized. If Azure-CLI not installed
-                will attempt to install (this will only work on machines where logged in 
-                as root or have admin permissions)
+                Runs and records command in record mode, or returns its recorded response
+                in replay mode. Failed commands raise CalledProcessError in both modes
         Arguments:
-                * self - Azure object
+                * self - Cassette object
+                * cmd - Command as string or argv list
+                * run - Function running command for real, returns output bytes
+        Returns:
+                Output of command as bytes
         '''
-
-        # Confirm Azure CLI installed 
-        try:
-            output = check_output("which az", shell=True)
-        except Exception as e:
-            log.info("Azure CLI not installed on this machine : %s" %e)
-            #Install Azure CLI 
+        if self.mode == "record":
+            start = time.time()
+            exit_code = 0
             try:
-                log.info("Attempting to install Azure-CLI, can take a few minutes")
-                output = check_output("pip install azure-cli", shell=True)
-                log.info("Azure CLI installed")
-            except Exception as e:
-                log.error("Unable to install Azure CLI: %s" %e)
-                log.error(output)
-                raise
+                out = run()
+            except CalledProcessError as e:
+                out = e.output or b""
+                exit_code = e.returncode
+            latency = time.time() - start
+
+            with self._lock:
+                self.interactions.append({'argv': cmd, 'stdout': out.decode('utf-8', 'replace'),
+                                          'exit': exit_code, 'latency': round(latency, 4)})
+            if exit_code:
+                raise CalledProcessError(exit_code, cmd, out)
+            return out
+
+        argv = tuple(self._argv(cmd))
+        with self._lock:
+            responses = self._responses.get(argv)
+            if not responses:
+                raise LookupError("No recorded response in cassette %s for command: %s"
+                                  %(self.path, " ".join(argv)))
+            interaction = responses.popleft() if len(responses) > 1 else responses[0]
+
+        if self.replay_latency:
+            time.sleep(interaction['latency'] * self.latency_scale)
+        out = interaction['stdout'].encode('utf-8')
+        if interaction['exit']:
+            raise CalledProcessError(interaction['exit'], cmd, out)
+        return out
 
-        # Confirm able to login
-        if self.appid:
-            try:
-                #Try to login with app-id, dir-id and auth-key
-                check_output("az login -u %s --service-principal --tenant %s -p %s" %(self.appid, self.dirid, self.key), shell=True)
-            except Exception as e:
-                log.error("Unable to logon to Azure with App-ID, Dir-ID and Auth-Key %s" %e)
-                raise
+    def save(self):
+        '''Writes recorded interactions to the cassette file, masking all known secrets'''
+        with self._lock, self._open('wt') as cassette:
+            for interaction in self.interactions:
+                cassette.write(jsonlib.dumps({'argv': self._argv(interaction['argv']),
+                                              'stdout': self._redact(interaction['stdout']),
+                                              'exit': interaction['exit'],
+                                              'latency': interaction['latency']},
+                                             separators=(',', ':')) + "\n")
+        log.info("Saved %d commands to cassette %s" %(len(self.interactions), self.path))
+
+class AddressPlanner():
+    '''
+    Plans subnet address space locally so no API call or failed deployment is needed to find
+    out a prefix overlaps. Keeps, for every vnet, a sorted index of the prefixes already used
+    (overlap checks by binary search) and free lists of aligned blocks by prefix length
+    (buddy allocation), so handing out or returning a prefix takes logarithmic time.
+    Vnets are identified by name, use one planner per resource group.
 
-        elif self.username:
-            try:
-                #Try to login with username and pw
-                check_output("az login -u %s -p %s" %(self.username, self.pw), shell=True)
-            except Exception as e:
-                log.error("Unable to logon to Azure with Username and Password %s" %e)
-                raise
+    Initial Arguments:
+            * vnets: Dictionary of vnet name and list of its address prefixes, default None
+            * used: Dictionary of vnet name and list of prefixes used by its subnets, default None
+    '''
 
-        log.info("Logged into Azure")
-        self.is_logged_in = True
+    def __init__(self, vnets=None, used=None):
+        '''Address planner __init__ indexes address space of vnets passed in'''
+        self._roots = {}
+        self._used = {}
+        self._free = {}
+        self._free_heaps = {}
+        for vnet_name in vnets or {}:
+            self.add_vnet(vnet_name, vnets[vnet_name], (used or {}).get(vnet_name, []))
 
-    def disconnect_azure(self):
+    def add_vnet(self, vnet_name, prefixes, used=()):
         '''
         Purpose:
-                Disconnects safely from Azure ClI
+                Adds vnet address space and the subnet prefixes already used in it
         Arguments:
-                * self - Azure object
+                * self - Planner object
+                * vnet_name - Name of vnet
+                * prefixes - List of vnet address prefixes ie ['10.0.0.0/16']
+                * used - List of prefixes already used by subnets, default ()
         '''
-
-        try:
-            #Try to logout
-            check_output("az logout", shell=True)
-        except Exception as e:
-            log.error("Unable to logout %s" %(e))
-
-    ''' 
-    ************************************
-    Azure Resource Group Functions
-    ************************************
-    '''
-    def create_rg(self, rg_name, location="eastus"):
+        self._roots[vnet_name] = [ipaddress.ip_network(prefix) for prefix in prefixes]
+        self._used[vnet_name] = []
+        self._free[vnet_name] = set()
+        self._free_heaps[vnet_name] = {}
+        for root in self._roots[vnet_name]:
+            self._add_free(vnet_name, root)
+        for prefix in used:
+            self.reserve(vnet_name, prefix)
+
+    def _add_free(self, vnet_name, network):
+        key = (network.version, network.prefixlen)
+        self._free[vnet_name].add((key, int(network.network_address)))
+        heapq.heappush(self._free_heaps[vnet_name].setdefault(key, []), int(network.network_address))
+
+    def _pop_free(self, vnet_name, key):
+        '''Lowest free block of given version and prefix length, or None'''
+        heap = self._free_heaps[vnet_name].get(key, [])
+        while heap:
+            start = heapq.heappop(heap)
+            #Heaps are cleaned lazily - skip blocks already taken
+            if (key, start) in self._free[vnet_name]:
+                self._free[vnet_name].discard((key, start))
+                return start
+        return None
+
+    def _network(self, version, start, prefixlen):
+        if version == 4:
+            return ipaddress.IPv4Network((start, prefixlen))
+        return ipaddress.IPv6Network((start, prefixlen))
+
+    def overlaps(self, vnet_name, prefix):
         '''
         Purpose:
-                Creates new resource group
+                Finds used subnet prefixes overlapping with prefix
         Arguments:
-                * self - Azure object
-                * rg_name - Name of resource group to be created
-                * location - Location for resource group, default = "eastus"
+                * self - Planner object
+                * vnet_name - Name of vnet
+                * prefix - Prefix to check ie '10.0.1.0/24'
+        Returns:
+                List of overlapping prefixes as ip_network, empty if prefix is free
         '''
-
-        try:
-            #Try create resource group
-            check_output("az group create --name %s --location %s" %(rg_name, location), shell=True)
-        except Exception as e:
-            log.error("Unable to create rg %s: %s" %(rg_name, e))
-            raise
-
-    def delete_rg(self, rg_name):
+        network = ipaddress.ip_network(prefix)
+        start, end = int(network.network_address), int(network.broadcast_address)
+        used = self._used[vnet_name]
+        #Used prefixes never overlap each other so only the one before start can reach into
+        #prefix, after it every used prefix starting up to end lies inside prefix
+        index = bisect.bisect_left(used, (network.version, start))
+        overlapping = []
+        if index and used[index - 1][0] == network.version and used[index - 1][2] >= start:
+            overlapping.append(used[index - 1][3])
+        while index < len(used) and used[index][0] == network.version and used[index][1] <= end:
+            overlapping.append(used[index][3])
+            index += 1
+        return overlapping
+
+    def check(self, vnet_name, prefix):
         '''
         Purpose:
-                Deletes exisiting resource group
+                Validates prefix is inside vnet address space and doesn't overlap any used prefix
         Arguments:
-                * self - Azure object
-                * rg_name - Name of resource group to be deleted
+                * self - Planner object
+                * vnet_name - Name of vnet
+                * prefix - Prefix to check ie '10.0.1.0/24'
         '''
+        network = ipaddress.ip_network(prefix)
+        if not any(network.version == root.version and network.subnet_of(root) for root in self._roots[vnet_name]):
+            raise ValueError("Prefix %s is outside address space of vnet %s %s"
+                             %(prefix, vnet_name, [str(root) for root in self._roots[vnet_name]]))
+        overlapping = self.overlaps(vnet_name, network)
+        if overlapping:
+            raise ValueError("Prefix %s overlaps %s in vnet %s" %(prefix, ", ".join(map(str, overlapping)), vnet_name))
+
+    def reserve(self, vnet_name, prefix):
+        '''
+        Purpose:
+                Marks prefix as used, ie for subnets created with an explicit prefix
+        Arguments:
+                * self - Planner object
+                * vnet_name - Name of vnet
+                * prefix - Prefix to reserve ie '10.0.1.0/24'
+        Returns:
+                Reserved prefix as ip_network
+        '''
+        network = ipaddress.ip_network(prefix)
+        self.check(vnet_name, network)
+
+        #Find free block holding prefix and split it around prefix
+        for prefixlen in range(network.prefixlen, -1, -1):
+            block = network.supernet(new_prefix=prefixlen) if prefixlen < network.prefixlen else network
+            key = ((network.version, prefixlen), int(block.network_address))
+            if key in self._free[vnet_name]:
+                self._free[vnet_name].discard(key)
+                for rest in block.address_exclude(network) if block != network else []:
+                    self._add_free(vnet_name, rest)
+                break
+
+        self._mark_used(vnet_name, network)
+        return network
+
+    def _mark_used(self, vnet_name, network):
+        bisect.insort(self._used[vnet_name], (network.version, int(network.network_address),
+                                              int(network.broadcast_address), network))
+
+    def allocate(self, vnet_name, prefix_length, version=4):
+        '''
+        Purpose:
+                Hands out free prefix of requested size in vnet, smallest free block that fits is
+                split so larger blocks stay free for larger subnets
+        Arguments:
+                * self - Planner object
+                * vnet_name - Name of vnet
+                * prefix_length - Size of prefix ie 24 for a /24
+                * version - IP version, default 4
+        Returns:
+                Allocated prefix as ip_network
+        '''
+        smallest = min([root.prefixlen for root in self._roots[vnet_name] if root.version == version] or [0])
+        for prefixlen in range(prefix_length, smallest - 1, -1):
+            start = self._pop_free(vnet_name, (version, prefixlen))
+            if start is None:
+                continue
+            #Split block in halves until it has the requested size, upper halves stay free
+            bits = 32 if version == 4 else 128
+            while prefixlen < prefix_length:
+                prefixlen += 1
+                self._add_free(vnet_name, self._network(version, start + 2 ** (bits - prefixlen), prefixlen))
+            network = self._network(version, start, prefix_length)
+            self._mark_used(vnet_name, network)
+            return network
+
+        raise ValueError("No free /%d left in vnet %s" %(prefix_length, vnet_name))
+
+    def release(self, vnet_name, prefix):
+        '''
+        Purpose:
+                Returns used prefix to the free space of vnet, merging it with its free buddy blocks
+        Arguments:
+                * self - Planner object
+                * vnet_name - Name of vnet
+                * prefix - Prefix to release ie '10.0.1.0/24'
+        '''
+        network = ipaddress.ip_network(prefix)
+        entry = (network.version, int(network.network_address), int(network.broadcast_address), network)
+        used = self._used[vnet_name]
+        index = bisect.bisect_left(used, entry)
+        if index == len(used) or used[index][:3] != entry[:3]:
+            raise ValueError("Prefix %s is not used in vnet %s" %(prefix, vnet_name))
+        del used[index]
+
+        roots = [root for root in self._roots[vnet_name] if root.version == network.version]
+        while network.prefixlen > 0 and not any(network == root for root in roots):
+            parent = network.supernet()
+            buddy = next(half for half in parent.subnets() if half != network)
+            buddy_key = ((network.version, buddy.prefixlen), int(buddy.network_address))
+            if buddy_key not in self._free[vnet_name]:
+                break
+            self._free[vnet_name].discard(buddy_key)
+            network = parent
+        self._add_free(vnet_name, network)
+
+def _intern(value):
+    '''Interns repeated strings so records of the same location, group, type or SKU share one copy'''
+    return sys.intern(value) if isinstance(value, str) else value
+
+def _ref(value):
+    '''ID of referenced sub-resource ie {"id": "..."}, None if not set'''
+    return value.get('id') if value else None
+
+def _refs(values):
+    '''Tuple of IDs of referenced sub-resources'''
+    return tuple(value['id'] for value in values or [] if value.get('id'))
+
+def _rg_from_id(resource_id):
+    '''Resource group name taken from resource ID'''
+    parts = (resource_id or '').split('/')
+    lowered = [part.lower() for part in parts]
+    if 'resourcegroups' in lowered:
+        return parts[lowered.index('resourcegroups') + 1]
+    return None
+
+class Resource():
+    '''
+    Compact record of an Azure resource. Records use __slots__ and share interned location,
+    resource group and type strings so large inventories stay small. Subclasses add the fields
+    of a resource type, any other type is kept as a plain Resource
 
-        try:
-            #Try to logout
-            check_output("az group delete --name %s -y" %rg_name, shell=True)
-        except Exception as e:
-            log.error("Unable to delete rg %s: %s" %(rg_name, e))
-            raise
-
-    def list_rg(self, tags={'location':'eastus'}, json=False):
+    Initial Arguments:
+            * id - Azure resource ID
+            * name - Name of resource
+            * type - Resource type, defaults to TYPE of the record class
+            * resource_group - Name of resource group, default taken from id
+            * location - Location of resource, default None
+            * tags - dictionary of tags, default None
+            * fields - Values of the FIELDS of the record class
+    '''
+    __slots__ = ('id', 'name', 'type', 'resource_group', 'location', 'tags')
+    TYPE = None
+    FIELDS = ()
+
+    def __init__(self, id, name, type=None, resource_group=None, location=None, tags=None, **fields):
+        '''Resource __init__ interns shared strings and sets FIELDS of the record class'''
+        self.id = id
+        self.name = name
+        self.type = _intern(self.TYPE or type)
+        self.resource_group = _intern(resource_group or _rg_from_id(id))
+        self.location = _intern(location)
+        self.tags = tags or None
+        for field in self.FIELDS:
+            setattr(self, field, _intern(fields.get(field)))
+
+    @classmethod
+    def _fields(cls, record, props):
+        '''FIELDS values parsed from CLI or ARM record'''
+        return {}
+
+    @classmethod
+    def from_record(cls, record):
         '''
         Purpose:
-                Gets list of Azure resource groups based on passed in tags
+                Builds record from Azure CLI, ARM or Resource Graph output
         Arguments:
-                * self - Azure object
-                * tags - dictionary containing tag id and tag value default = {'location':'eastus'}
-                * json - If you want the data in json format, default False
+                * cls - Record class
+                * record - Resource as dictionary or GraphRecord
         Returns:
-                Azure resource groups as string or json depending on input
+                Record of class cls
         '''
+        if isinstance(record, GraphRecord):
+            record = {'id': record.id, 'name': record.name, 'type': record.type,
+                      'resourceGroup': record.resource_group, 'location': record.location,
+                      'tags': record.tags, 'properties': record.properties}
+        return cls(record['id'], record.get('name'), record.get('type'), record.get('resourceGroup'),
+                   record.get('location'), record.get('tags'), **cls._fields(record, _props(record)))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, slot) == getattr(other, slot)
+                                                 for slot in Resource.__slots__ + self.FIELDS)
+
+    def __hash__(self):
+        #Equal records have the same id, Azure resource IDs are case insensitive
+        return hash(self.id.lower())
+
+    def __repr__(self):
+        return "%s(%s)" %(type(self).__name__, ", ".join("%s=%r" %(slot, getattr(self, slot))
+                                                         for slot in Resource.__slots__ + self.FIELDS))
+
+class VirtualMachine(Resource):
+    '''Virtual machine record, see Resource'''
+    __slots__ = FIELDS = ('vm_size', 'os_type', 'os_disk_id', 'nic_ids', 'power_state')
+    TYPE = 'Microsoft.Compute/virtualMachines'
+
+    @classmethod
+    def _fields(cls, record, props):
+        os_disk = (props.get('storageProfile') or {}).get('osDisk') or {}
+        return {'vm_size': (props.get('hardwareProfile') or {}).get('vmSize'),
+                'os_type': os_disk.get('osType'),
+                'os_disk_id': _ref(os_disk.get('managedDisk')),
+                'nic_ids': _refs((props.get('networkProfile') or {}).get('networkInterfaces')),
+                #Only set when listed with details (az vm list -d)
+                'power_state': record.get('powerState')}
+
+class NetworkInterface(Resource):
+    '''Network interface record, see Resource'''
+    __slots__ = FIELDS = ('vm_id', 'private_ips', 'public_ip_ids', 'subnet_ids', 'nsg_id')
+    TYPE = 'Microsoft.Network/networkInterfaces'
+
+    @classmethod
+    def _fields(cls, record, props):
+        configs = [_props(config) for config in props.get('ipConfigurations') or []]
+        return {'vm_id': _ref(props.get('virtualMachine')),
+                'private_ips': tuple(config.get('privateIpAddress') or config.get('privateIPAddress')
+                                     for config in configs),
+                'public_ip_ids': tuple(filter(None, (_ref(config.get('publicIpAddress') or config.get('publicIPAddress'))
+                                                     for config in configs))),
+                'subnet_ids': tuple(filter(None, (_ref(config.get('subnet')) for config in configs))),
+                'nsg_id': _ref(props.get('networkSecurityGroup'))}
+
+class Disk(Resource):
+    '''Managed disk record, see Resource'''
+    __slots__ = FIELDS = ('size_gb', 'sku', 'disk_state', 'managed_by')
+    TYPE = 'Microsoft.Compute/disks'
+
+    @classmethod
+    def _fields(cls, record, props):
+        return {'size_gb': props.get('diskSizeGb') or props.get('diskSizeGB'),
+                'sku': (record.get('sku') or {}).get('name'),
+                'disk_state': props.get('diskState'),
+                'managed_by': record.get('managedBy')}
+
+class PublicIp(Resource):
+    '''Public IP address record, see Resource'''
+    __slots__ = FIELDS = ('ip_address', 'allocation', 'ip_config_id')
+    TYPE = 'Microsoft.Network/publicIPAddresses'
+
+    @classmethod
+    def _fields(cls, record, props):
+        return {'ip_address': props.get('ipAddress'),
+                'allocation': props.get('publicIpAllocationMethod') or props.get('publicIPAllocationMethod'),
+                'ip_config_id': _ref(props.get('ipConfiguration'))}
+
+class NetworkSecurityGroup(Resource):
+    '''Network security group record, see Resource'''
+    __slots__ = FIELDS = ('rule_names', 'nic_ids', 'subnet_ids')
+    TYPE = 'Microsoft.Network/networkSecurityGroups'
+
+    @classmethod
+    def _fields(cls, record, props):
+        return {'rule_names': tuple(rule['name'] for rule in props.get('securityRules') or []),
+                'nic_ids': _refs(props.get('networkInterfaces')),
+                'subnet_ids': _refs(props.get('subnets'))}
+
+class RouteTable(Resource):
+    '''Route table record holding its routes as Route tuples, see Resource'''
+    __slots__ = FIELDS = ('routes', 'subnet_ids')
+    TYPE = 'Microsoft.Network/routeTables'
+
+    @classmethod
+    def _fields(cls, record, props):
+        routes = []
+        for route in props.get('routes') or []:
+            route_props = _props(route)
+            routes.append(Route(route['name'], route_props.get('addressPrefix'),
+                                _intern(route_props.get('nextHopType')), route_props.get('nextHopIpAddress')))
+        return {'routes': tuple(routes), 'subnet_ids': _refs(props.get('subnets'))}
+
+class StorageAccount(Resource):
+    '''Storage account record, see Resource'''
+    __slots__ = FIELDS = ('kind', 'sku', 'blob_endpoint')
+    TYPE = 'Microsoft.Storage/storageAccounts'
+
+    @classmethod
+    def _fields(cls, record, props):
+        return {'kind': record.get('kind'),
+                'sku': (record.get('sku') or {}).get('name'),
+                'blob_endpoint': (props.get('primaryEndpoints') or {}).get('blob')}
+
+# Record class of each resource type, by lower case type
+RESOURCE_CLASSES = dict((cls.TYPE.lower(), cls) for cls in (VirtualMachine, NetworkInterface, Disk, PublicIp,
+                                                            NetworkSecurityGroup, RouteTable, StorageAccount))
+
+class ResourceInventory():
+    '''
+    In-memory inventory of compact resource records indexed by ID and by name, so lookups
+    take constant time however many resources are held. Records are built from Azure CLI,
+    ARM or Resource Graph output with the record class of their type (see RESOURCE_CLASSES).
+    Safe to share between threads, kept fresh with AzureCLI.refresh_inventory which records
+    how far the activity log of each resource group was read in cursors
 
-        # Concantinate all tags into a single string to pass to Azure ClI
-        tag_str = ""
-        for tag in tags:
-            tag_str += "[?%s=='%s']" %(tag, tags[tag])
+    Initial Arguments:
+            * records - Iterable of records to add, default ()
+    '''
 
-        if (json):
-            out = check_output('az group list --query "%s"' %tag_str, shell=True)
-        else: 
-            out = check_output('az group list --query "%s" -o table' %tag_str, shell=True)
+    def __init__(self, records=()):
+        '''Resource inventory __init__ adds records passed in'''
+        self._by_id = {}
+        self._by_name = {}
+        self._lock = threading.RLock()
+        self.cursors = {}
+        self.update(records)
 
-        #Check data isn't empty
-        assert not out.isspace(), "No Resource Groups information collected"
-        return out.decode('utf-8')
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._by_id.values()))
+
+    def __contains__(self, resource_id):
+        return resource_id.lower() in self._by_id
 
-    def show_rg(self, rg_name, json=False):
+    def add(self, record):
         '''
         Purpose:
-                Gets data about specific Azure resource group
+                Adds resource to inventory, replacing record with the same ID
         Arguments:
-                * self - Azure object
-                * rg_name - Name of Resource Group you want data about
-                * json - If you want the data in json format, default False
+                * self - Inventory object
+                * record - Resource record, dictionary or GraphRecord
         Returns:
-                Azure resource group information as string or json depending on input
+                Resource record added
         '''
-
-        if (json):
-            out = check_output('az group show --name %s' %rg_name, shell=True)
-        else:
-            out = check_output('az group show --name %s -o table' %rg_name, shell=True)
-
-         #Check data isn't empty
-        assert not out.isspace(), "No information for Resource Group %s collected" %rg_name
-        return out.decode('utf-8')
-
-    ''' 
-    ************************************
-    Azure VNET Functions
-    ************************************
-    '''
-    def create_vnet(self, name, rg_name, add_prefix=None, location="eastus", subnet_name=None, subnet_prefix=None):
+        if not isinstance(record, Resource):
+            record = RESOURCE_CLASSES.get((record.type if isinstance(record, GraphRecord)
+                                           else record.get('type') or '').lower(), Resource).from_record(record)
+        with self._lock:
+            self.remove(record.id)
+            self._by_id[record.id.lower()] = record
+            self._by_name.setdefault((record.name or '').lower(), []).append(record)
+        return record
+
+    def update(self, records):
         '''
         Purpose:
-                Creates new Vnet - Either leave defaults for add_prefix, subnet_name and subnet_prefix\
-                                   to use Azure's default prefix or define prefix and add subnet parameters\
-                                   to define a vnet with a subnet
+                Adds resources to inventory, see add
         Arguments:
-                * self - Azure object
-                * name - Azure vnet name
-                * rg_name - Name of resource group to be created
-                * add_prefix - Address prfix of vnet, optional defaults to Azure default (default = None)
-                * location - Location for resource group, default = "eastus"
-                * subnet_name -Optional name of subnet to add, default = None
-                * subnet_prefix -Optional subnet prefix to add, default = None
+                * self - Inventory object
+                * records - Iterable of records
+        Returns:
+                Number of records added
         '''
+        count = 0
+        for record in records:
+            self.add(record)
+            count += 1
+        return count
 
-        try:
-            #Try to create vnet with or without subnet depending on parameters defined
-            if add_prefix and subnet_prefix and subnet_name:
-                check_output("az network vnet create -g %s -n %s --location %s --address-prefix %s"\
-                    " --subnet-name %s --subnet-prefix %s" %(rg_name, name, location, add_prefix,\
-                     subnet_name, subnet_prefix), shell=True)
-            else:
-                check_output("az network vnet create -g %s -n %s --location %s" %(rg_name, name, location), shell=True)
-        except Exception as e:
-            log.error("Unable to create vnet %s: %s" %(rg_name, e))
-            raise
-
-    def delete_vnet(self, name, rg_name):
+    def remove(self, resource_id):
         '''
         Purpose:
-                Deletes exisiting vnet
+                Removes resource from inventory
         Arguments:
-                * self - Azure object
-                * name - Name of VNET you want to delete
-                * rg_name - Name of resource group to be deleted
+                * self - Inventory object
+                * resource_id - Azure resource ID
+        Returns:
+                Removed record or None if it wasn't in inventory
         '''
-
-        try:
-            #Try to logout
-            check_output("az network vnet delete -n %s -g %s" %(name, rg_name), shell=True)
-        except Exception as e:
-            log.error("Unable to delete vnet %s: %s" %(name, e))
-            raise
-
-    def list_vnet(self, rg_name, json=False):
+        with self._lock:
+            record = self._by_id.pop(resource_id.lower(), None)
+            if record:
+                named = self._by_name[(record.name or '').lower()]
+                named.remove(record)
+                if not named:
+                    del self._by_name[(record.name or '').lower()]
+        return record
+
+    def get(self, resource_id):
+        '''Record with resource ID, None if not in inventory'''
+        return self._by_id.get(resource_id.lower())
+
+    def find(self, name, type=None, rg_name=None):
         '''
         Purpose:
-                Gets list of Azure Vnets contained in resource group
+                Finds resources by name
         Arguments:
-                * self - Azure object
-                * rg _name - resource group you want to find VNETs associated with
-                * json - If you want the data in json format, default False
+                * self - Inventory object
+                * name - Name of resource
+                * type - Resource type to match ie 'Microsoft.Network/publicIPAddresses', default None
+                * rg_name - Resource group to match, default None
         Returns:
-                Azure vnets as string or json depending on input
+                List of matching records
         '''
+        with self._lock:
+            named = list(self._by_name.get(name.lower(), []))
+        return [record for record in named
+                if (not type or (record.type or '').lower() == type.lower())
+                and (not rg_name or (record.resource_group or '').lower() == rg_name.lower())]
 
-        if (json):
-            out = check_output('az network vnet list --resource-group %s' %rg_name, shell=True)
-        else: 
-            out = check_output('az network vnet list --resource-group %s -o table' %rg_name, shell=True)
+    def of_type(self, type):
+        '''List of records of resource type'''
+        return [record for record in self if (record.type or '').lower() == type.lower()]
 
-        #Check data isn't empty
-        assert not out.isspace(), "Unable to list VNET information"
-        return out.decode('utf-8')
+class DeploymentLedger():
+    '''
+    Local ledger of successful template deployments kept as a JSON file. Each entry is keyed by a
+    hash of the template, parameters and resource group (see key) and holds the deployment name,
+    its correlation ID and outputs, so an unchanged deployment can be skipped and its recorded
+    outputs returned. The correlation ID tells the recorded run apart from later deployments
+    under the same name
+
+    Initial Arguments:
+            * path: Ledger file to read and write, created on first record
+    '''
 
-    def show_vnet(self, name, rg_name, json=False):
+    def __init__(self, path):
+        '''Deployment ledger __init__ loads entries already recorded in path'''
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as ledger:
+                self.entries = jsonlib.load(ledger)
+
+    @staticmethod
+    def key(template_file, parameter_file, rg_name, *extra):
         '''
         Purpose:
-                Gets data about specific Azure Vnet associated to a rg
+                Hashes contents of template and parameter file together with resource group
         Arguments:
-                * self - Azure object
-                * name - Name of Vnet you want data about
-                * rg_name - Name of Resource Group you want data about
-                * json - If you want the data in json format, default False
+                * template_file - Path of deployment template
+                * parameter_file - Path of parameter file
+                * rg_name - Name of resource group deployed to
+                * extra - Any other values deployment depends on ie uploaded image
         Returns:
-                Azure vnet information as string or json depending on input
+                sha256 hex digest
         '''
+        digest = hashlib.sha256()
+        for path in (template_file, parameter_file):
+            with open(path, 'rb') as deployment_file:
+                digest.update(deployment_file.read())
+            digest.update(b'\0')
+        for value in (rg_name.lower(),) + extra:
+            digest.update(str(value).encode('utf-8') + b'\0')
+        return digest.hexdigest()
+
+    def get(self, key):
+        '''Recorded entry {"rg_name", "deployment", "correlation_id", "outputs", "deployed_at"} for key,
+        None if not recorded'''
+        return self.entries.get(key)
+
+    def record(self, key, rg_name, deployment, outputs, correlation_id=None):
+        '''
+        Purpose:
+                Records successful deployment and writes ledger file
+        Arguments:
+                * self - Ledger object
+                * key - Hash of deployment, see key
+                * rg_name - Name of resource group deployed to
+                * deployment - Name of deployment
+                * outputs - Outputs of deployment
+                * correlation_id - Correlation ID of deployment run, default None
+        '''
+        with self._lock:
+            self.entries[key] = {'rg_name': rg_name, 'deployment': deployment, 'outputs': outputs,
+                                 'correlation_id': correlation_id, 'deployed_at': time.time()}
+            self._save()
+
+    def forget(self, key):
+        '''Removes entry for key, ie when deployment no longer exists'''
+        with self._lock:
+            if self.entries.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        #Write whole file then swap it in so an interrupted write can't corrupt ledger
+        with open(self.path + '.tmp', 'w') as ledger:
+            jsonlib.dump(self.entries, ledger, indent=2, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+def _type_from_id(resource_id):
+    '''Resource type taken from resource ID ie Microsoft.Network/virtualNetworks/subnets'''
+    parts = resource_id.strip('/').split('/')
+    lowered = [part.lower() for part in parts]
+    if 'providers' not in lowered:
+        return 'Microsoft.Resources/resourceGroups' if 'resourcegroups' in lowered else 'Microsoft.Resources/subscriptions'
+    names = parts[lowered.index('providers') + 1:]
+    return "/".join([names[0]] + names[1::2])
+
+def _top_from_id(resource_id):
+    '''ID of top level resource for child resources ie vnet of subnet, resource ID itself for others'''
+    parts = resource_id.rstrip('/').split('/')
+    lowered = [part.lower() for part in parts]
+    if 'providers' in lowered:
+        return "/".join(parts[:lowered.index('providers') + 4])
+    return resource_id.rstrip('/')
+
+def _parent_from_id(resource_id):
+    '''ID of parent resource for child resources ie subnets and routes, None for others'''
+    parts = resource_id.rstrip('/').split('/')
+    lowered = [part.lower() for part in parts]
+    if 'providers' in lowered and len(parts) - lowered.index('providers') > 4:
+        return "/".join(parts[:-2])
+    return None
+
+# Order resources are torn down in, dependants first - types not listed go with rank 3
+_TEARDOWN_ORDER = {'microsoft.compute/virtualmachines': 0,
+                   'microsoft.network/networkinterfaces': 1,
+                   'microsoft.compute/disks': 1,
+                   'microsoft.network/publicipaddresses': 2,
+                   'microsoft.network/networksecuritygroups': 2,
+                   'microsoft.network/virtualnetworks/subnets': 2,
+                   'microsoft.network/routetables': 4,
+                   'microsoft.resources/resourcegroups': 5}
+
+class StateStore():
+    '''
+    SQLite record of every resource created through an AzureCLI object (ID, type, resource
+    group, parent, creation time and workflow), so resources can be found by the run that
+    created them or by age and torn down without listing anything in Azure. Deleted resources
+    are kept with their deletion time.
 
-        if (json):
-            out = check_output('az network vnet show -g %s -n %s' %(rg_name,name), shell=True)
-        else: 
-            out = check_output('az network vnet show -g %s -n %s -o table' %(rg_name,name), shell=True)
-
-        #Check data isn't empty
-        assert not out.isspace(), "Unable get information about VNET %s" %name
-        return out.decode('utf-8')
+    Initial Arguments:
+            * path: SQLite database file, ':memory:' for a store only held in memory
+            * workflow: Name of workflow resources are recorded for, default a new run ID
+                        made of start time and process ID
+    '''
 
-    def add_vnet_subnet(self, name, rg_name, vnet_name, address_prefix, route_table=None):
+    def __init__(self, path, workflow=None):
+        '''State store __init__ opens database and creates table on first use'''
+        self.path = path
+        self.workflow = workflow or "%s-%d" %(time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS resources (id TEXT PRIMARY KEY COLLATE NOCASE, "
+                             "type TEXT, resource_group TEXT COLLATE NOCASE, parent TEXT COLLATE NOCASE, "
+                             "created_at REAL, workflow TEXT, deleted_at REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS resources_workflow ON resources (workflow)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS resources_created ON resources (created_at)")
+
+    def close(self):
+        self._db.close()
+
+    def record(self, resource_id, workflow=None):
         '''
         Purpose:
-                Creates new subnet and attaches it to a vnet
+                Records created resource, a resource already recorded keeps its creation time
+                and workflow unless it had been deleted
         Arguments:
-                * self - Azure object
-                * name - Azure subnet name
-                * rg_name - Name of resource group to be created unerder
-                * vnet_name - Name of subnet
-                * address_prefix - subnet Prefix to add
-                * route_table - Optional Route-table you want to associate it with, default None
+                * self - Store object
+                * resource_id - Azure resource ID
+                * workflow - Workflow resource was created by, default workflow of store
         '''
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM resources WHERE id = ? AND deleted_at IS NOT NULL", (resource_id,))
+            self._db.execute("INSERT OR IGNORE INTO resources VALUES (?, ?, ?, ?, ?, ?, NULL)",
+                             (resource_id, _type_from_id(resource_id), _rg_from_id(resource_id),
+                              _parent_from_id(resource_id), time.time(), workflow or self.workflow))
 
-        try:
-            #Try to create subnet and attach to a vnet
-            if route_table:
-                check_output("az network vnet subnet create -g %s -n %s --vnet-name %s --address-prefix %s --route-table %s"\
-                             %(rg_name, name, vnet_name, address_prefix, route_table), shell=True)
-            else:
-                check_output("az network vnet subnet create -g %s -n %s --vnet-name %s --address-prefix %s"\
-                             %(rg_name, name, vnet_name, address_prefix), shell=True)
-        except Exception as e:
-            log.error("Unable to create vnet subnet %s: %s" %(name, e))
-            raise
-
-    def delete_vnet_subnet(self, name, rg_name, vnet_name):
+    def record_output(self, output):
         '''
         Purpose:
-                Delete subnet attached to a vnet
+                Records resources found in output of a create command or ARM call, including
+                wrapped resources (ie newVNet) and resources of template deployments
         Arguments:
-                * self - Azure object
-                * name - Azure subnet name to delete
-                * rg_name - Name of resource group
-                * vnet_name - Name of vnet subnet belongs to
+                * self - Store object
+                * output - Output as bytes, string or parsed JSON
+        Returns:
+                List of recorded IDs
         '''
-
-        try:
-            #Try to delete a subnet
-            check_output("az network vnet subnet delete -g %s -n %s --vnet-name %s"\
-                             %(rg_name, name, vnet_name), shell=True)
-        except Exception as e:
-            log.error("Unable to delete subnet %s: %s" %(name, e))
-            raise
-
-    def list_vnet_subnets(self, name, rg_name, json=False):
+        if isinstance(output, (bytes, str)):
+            try:
+                output = jsonlib.loads(output or "null")
+            except ValueError:
+                return []
+        if not isinstance(output, dict):
+            return []
+
+        ids = []
+        for record in [output] + [value for value in output.values() if isinstance(value, dict)]:
+            if isinstance(record.get('id'), str) and record['id'].lower().startswith('/subscriptions/'):
+                ids.append(record['id'])
+        ids += [resource['id'] for resource in _props(output).get('outputResources') or [] if resource.get('id')]
+
+        for resource_id in ids:
+            self.record(resource_id)
+        return ids
+
+    def mark_deleted(self, resource_ids):
+        '''Sets deletion time of resources'''
+        with self._lock, self._db:
+            self._db.executemany("UPDATE resources SET deleted_at = ? WHERE id = ?",
+                                 [(time.time(), resource_id) for resource_id in resource_ids])
+
+    def mark_deleted_path(self, rg_name, path=None):
         '''
         Purpose:
-                Gets data about Azure subnet
+                Sets deletion time of recorded resource found by resource group and path instead
+                of ID, along with its child resources. Without path the resource group and every
+                resource recorded in it are marked deleted
         Arguments:
-                * self - Azure object
-                * name - Name of Vnet you want subnet data about
-                * rg_name - Name of Resource Group subnet is associated with
-                * json - If you want the data in json format, default False
+                * self - Store object
+                * rg_name - Resource group name
+                * path - Path of resource below providers ie
+                         Microsoft.Network/virtualNetworks/vnet1/subnets/subnet1, default None
         Returns:
-                List of Azure subnets associated with vnet in string or Json format
+                List of IDs marked deleted
         '''
-
-        if (json):
-            out = check_output('az network vnet subnet list -g %s --vnet-name %s' %(rg_name,name), shell=True)
-        else: 
-            out = check_output('az network vnet subnet list -g %s --vnet-name %s -o table' %(rg_name,name), shell=True)
-
-        #Check data isn't empty
-        assert not out.isspace(), "Unable to list VNET Subnets information"
-        return out.decode('utf-8')
-
-    def show_vnet_subnet(self, name, rg_name, vnet_name, json=False):
+        resources = self.resources(rg_name=rg_name)
+        if path:
+            suffix = "/providers/" + path.strip('/').lower()
+            resources = [resource for resource in resources
+                         if resource.id.lower().endswith(suffix) or suffix + '/' in resource.id.lower()]
+        ids = [resource.id for resource in resources]
+        self.mark_deleted(ids)
+        return ids
+
+    def resources(self, workflow=None, rg_name=None, older_than=None, include_deleted=False):
         '''
         Purpose:
-                Gets data about a specific Azure subnet associated to a vnet
+                Queries recorded resources
         Arguments:
-                * self - Azure object
-                * name - Name of subnet you want data about
-                * rg_name - Name of Resource Group vnet is associated with
-                * vnet_name - Name of VNet subnet is associated with
-                * json - If you want the data in json format, default False
+                * self - Store object
+                * workflow - Only resources created by workflow, default None (any workflow)
+                * rg_name - Only resources in resource group, default None
+                * older_than - Only resources created more than this many hours ago, default None
+                * include_deleted - Include resources already deleted, default False
         Returns:
-                Azure subnet information as string or json depending on input
+                List of StoredResource (id, type, resource_group, parent, created_at, workflow, deleted_at)
         '''
-
-        if (json):
-            out = check_output('az network vnet subnet show -g %s -n %s --vnet-name %s' %(rg_name,name, vnet_name), shell=True)
-        else: 
-            out = check_output('az network vnet subnet show -g %s -n %s --vnet-name %s -o table'\
-                        %(rg_name,name,vnet_name), shell=True)
-
-        #Check data isn't empty
-        assert not out.isspace(), "Unable to get information about Subnet VNET %s" %name
-        return out.decode('utf-8')
- 
-    ''' 
-    ************************************
-    Azure Deployment Functions
-    ************************************
-    '''
-    def create_parameter_file(self, parameter_template, testbed_file, output_file_path, yaml_object= "azure"):
+        query, args = "SELECT * FROM resources WHERE 1", []
+        if workflow:
+            query += " AND workflow = ?"
+            args.append(workflow)
+        if rg_name:
+            query += " AND resource_group = ?"
+            args.append(rg_name)
+        if older_than is not None:
+            query += " AND created_at < ?"
+            args.append(time.time() - older_than * 3600)
+        if not include_deleted:
+            query += " AND deleted_at IS NULL"
+        with self._lock:
+            return [StoredResource(*row) for row in self._db.execute(query + " ORDER BY created_at", args)]
+
+    def created_by(self, workflow):
+        '''Resources created by workflow and not deleted yet, see resources'''
+        return self.resources(workflow=workflow)
+
+    def older_than(self, hours):
+        '''Resources created more than hours ago and not deleted yet, see resources'''
+        return self.resources(older_than=hours)
+
+    def plan_teardown(self, resources):
         '''
         Purpose:
-                Method to create parameter file from information in testbed YAML file and parameter template
-                file. Combines values from testbed YAML and places them in appropriate placeholders
-                in parameter template file. This outputed parameter file can then be passed into the 
-                deployment methods to be used with deployment templates 
+                Orders deletion of resources from recorded data only. Resources inside a recorded
+                resource group, and child resources of recorded parents, go with the group or
+                parent. The rest is split into waves by dependency (VMs, then NICs and disks, then
+                public IPs, NSGs and subnets, ...), resources of one wave can be deleted in parallel
         Arguments:
-                * self - Azure object
-                * parameter_template - Parameter template file to use
-                * testbed_file - Testbed YAML file holding data for parameter template
-                * output_file_path - Path of output file
-                * yaml_object - Object in the YAML file the dictionary containing variable to be placed 
-                                in the parameter_template live under ie testbed[azure] or testbed[asa]
-                                default=Azure if the variables aren't under any object and be called by 
-                                testbed[parameter]
+                * self - Store object
+                * resources - List of StoredResource to tear down
+        Returns:
+                List of waves, each a list of StoredResource
         '''
-        
-        new_parameters = ""
-        #Open files
-        testbed = yaml.load(open(testbed_file, 'r'))
-        parameters = open(parameter_template, 'r')
-        new_param_file = open(output_file_path, 'w+')
-
-        #Get specific object in testbed YAML file - Will usually be 'azure'
-        if yaml_object:
-            testbed = testbed[yaml_object]
-
-        #Check each line in parameter template for place holder
-        #if placeholder found update with relevant data from testbed file
-        lines = parameters.readlines()
-        for line in lines:
-            if '[' and ']' in line:
-                m = re.search(r'\[(\w*)\]', line)
-                new_line = line.replace(m.group(0), '"'+ testbed[m.group(1)]+ '"')
-                line = new_line
-            #Write new parameter file
-            new_parameters += (line)
-            new_param_file.write(line)
+        ids = set(resource.id.lower() for resource in resources)
+        groups = set(resource.resource_group.lower() for resource in resources
+                     if resource.type == 'Microsoft.Resources/resourceGroups')
+
+        waves = {}
+        for resource in resources:
+            if resource.type != 'Microsoft.Resources/resourceGroups' and \
+               (resource.resource_group or '').lower() in groups:
+                continue
+            if resource.parent and resource.parent.lower() in ids:
+                continue
+            waves.setdefault(_TEARDOWN_ORDER.get(resource.type.lower(), 3), []).append(resource)
+        return [waves[rank] for rank in sorted(waves)]
+
+class TopologyTemplate():
+    '''
+    Builds one ARM template for a whole topology - vnets with their subnets, route tables and
+    Linux VMs each with NIC, NSG and public IP - so it is created by a single deployment that ARM
+    runs in parallel instead of one az create per resource. Credentials are template parameters,
+    the parameter file is written with [placeholder] values to be filled from a testbed YAML by
+    AzureCLI.create_parameter_file, see AzureCLI.deploy_topology. Private and public IP of every
+    VM are deployment outputs named <vm>PrivateIp and <vm>PublicIp
 
-        #Close all files
-        new_param_file.close()
-        parameters.close()
+    Initial Arguments:
+            * specs: Optional dictionary with lists 'vnets', 'subnets', 'route_tables' and 'vms',
+                     each item a dictionary of arguments of add_vnet, add_subnet,
+                     add_route_table or add_vm
+    '''
 
-    def deploy_from_template_custom_image(self, resource_group, storage_name, image_path, template_file,
-                                            parameter_file, location='eastus', storage_container_name="images"):
+    NETWORK_API = '2023-05-01'
+    COMPUTE_API = '2023-03-01'
+
+    def __init__(self, specs=None):
+        '''Topology template __init__ adds resources listed in specs'''
+        self.vnets = {}
+        self.route_tables = {}
+        self.vms = {}
+        self.parameters = {}
+        specs = specs or {}
+        for spec in specs.get('route_tables', []):
+            self.add_route_table(**spec)
+        for spec in specs.get('vnets', []):
+            self.add_vnet(**spec)
+        for spec in specs.get('subnets', []):
+            self.add_subnet(**spec)
+        for spec in specs.get('vms', []):
+            self.add_vm(**spec)
+
+    def add_vnet(self, name, prefixes, subnets=None):
         '''
         Purpose:
-                Creates new deployment using custom image - Have to create a resource group and storage container to 
-                store custom image then copy over the custom image to the new storage container. Will then attempt to 
-                deploy template passed in. Note if this fails please remember to delete resource group in any cleanup done
+                Adds vnet to topology
         Arguments:
-                * self - Azure object
-                * resource_group - Name of resource group to created
-                * storage_name - Name of storage container to be created
-                * image_path - Path to custom image to be copied to storage container and then deployed
-                * template_file - path to file to use for deployment
-                * parameter_file - Parameter file to be combined with Template file for deployment
-                * location - Location of deployment default 'eastus'
-                * storage_container_name - Name of storage container - defaults to 'images', which is what is defined 
-                                           in template file - do not change to different value unless you know 
-                                           what you are doing and have matching value in template file
+                * name - Name of vnet
+                * prefixes - Address prefix or list of prefixes of vnet
+                * subnets - List of dictionaries of add_subnet arguments without vnet, default None
         '''
-        try:
-            # Create Resource Group
-            self.create_rg(resource_group, location)
-            log.info("Resource Group %s Created" %resource_group)
-
-            # Create Storage and Storage Container
-            self.create_storage(storage_name, resource_group, location)
-            log.info("Storage %s Created" %storage_name)
-
-            self.create_storage_container(storage_container_name, resource_group, storage_name)
-            log.info("Storage Container %s Created" %storage_container_name)
-
-            # Copy custom image onto storage container 
-            self.upload_vhd_to_container(storage_container_name, storage_name, resource_group, image_path)
-            log.info("Image %s uploaded to Storage container %s" %(image_path, storage_container_name))
-
-        except Exception as e:
-            log.error("Unable to set up the resource group and storage to deploy template to: %s" %e)
-            raise
-
-        # Deploy template
-        try:
-            #Try create deployment
-            log.info("Image on Azure, now deploying Template, can take a few minutes")
-            check_output("az group deployment create -g %s --template-file %s --parameters %s" %(resource_group, template_file, parameter_file), shell=True)
-            log.info("Template deployed")
-        except Exception as e:
-            log.error("Unable to deploy template %s" %e)
-            raise
+        if isinstance(prefixes, str):
+            prefixes = [prefixes]
+        self.vnets[name] = {'prefixes': list(prefixes), 'subnets': {}}
+        for subnet in subnets or []:
+            self.add_subnet(vnet=name, **subnet)
 
-    def deploy_from_template_mp_image(self, rg_name, location, template_file, parameter_file):
+    def add_subnet(self, vnet, name, prefix, route_table=None):
         '''
         Purpose:
-                Creates new deployment using Marketplace Image, will check if resource group is created
-                if not will create one. If this fails please remember to delete resource group created
+                Adds subnet to vnet already in topology
         Arguments:
-                * self - Azure object
-                * rg_name - Resource Group name
-                * template_file - path to azure template file to use for deployment
-                * parameter_file - path to file containing parameters needed for deployment
+                * vnet - Name of vnet
+                * name - Name of subnet
+                * prefix - Address prefix of subnet
+                * route_table - Name of route table in topology to associate, default None
+        '''
+        if vnet not in self.vnets:
+            log.error("Vnet %s of subnet %s isn't in topology" %(vnet, name))
+            raise ValueError("Vnet %s of subnet %s isn't in topology" %(vnet, name))
+        if route_table and route_table not in self.route_tables:
+            log.error("Route table %s of subnet %s isn't in topology" %(route_table, name))
+            raise ValueError("Route table %s of subnet %s isn't in topology" %(route_table, name))
+        self.vnets[vnet]['subnets'][name] = {'prefix': prefix, 'route_table': route_table}
+
+    def add_route_table(self, name, routes=None):
+        '''
+        Purpose:
+                Adds route table to topology
+        Arguments:
+                * name - Name of route table
+                * routes - List of routes as Route, tuples (name, prefix, next_hop_type, next_hop_add)
+                           or dictionaries with those keys, default None
+        '''
+        table = []
+        for route in routes or []:
+            if isinstance(route, dict):
+                route = Route(**route)
+            elif not isinstance(route, Route):
+                route = Route(*route)
+            table.append(route)
+        self.route_tables[name] = table
+
+    def add_vm(self, name, vnet, subnet, size="Standard_DS1_v2", image=None, public_ip=True, private_ip=None,
+               ports=(22,), username="adminUsername", password="adminPassword"):
+        '''
+        Purpose:
+                Adds Linux VM with its NIC, NSG and public IP named like az vm create does
+        Arguments:
+                * name - Name of VM
+                * vnet - Name of vnet in topology
+                * subnet - Name of subnet in vnet
+                * size - VM size, default Standard_DS1_v2
+                * image - Image reference dictionary (publisher, offer, sku, version), default Ubuntu 18.04 LTS
+                * public_ip - Give VM a public IP, default True
+                * private_ip - Static private IP, default None for dynamic
+                * ports - Inbound TCP ports NSG allows, default (22,)
+                * username - Template parameter (and placeholder) holding admin username, default adminUsername
+                * password - Template parameter (and placeholder) holding admin password, default adminPassword
+        '''
+        if subnet not in self.vnets.get(vnet, {}).get('subnets', {}):
+            log.error("Subnet %s/%s of VM %s isn't in topology" %(vnet, subnet, name))
+            raise ValueError("Subnet %s/%s of VM %s isn't in topology" %(vnet, subnet, name))
+        self.vms[name] = {'vnet': vnet, 'subnet': subnet, 'size': size, 'public_ip': public_ip,
+                          'private_ip': private_ip, 'ports': list(ports), 'username': username,
+                          'password': password,
+                          'image': image or {'publisher': 'Canonical', 'offer': 'UbuntuServer',
+                                             'sku': '18.04-LTS', 'version': 'latest'}}
+        self.parameters[username] = 'string'
+        self.parameters[password] = 'securestring'
+
+    def template(self):
+        '''
+        Purpose:
+                Builds ARM template of topology
         Returns:
-                Output from successful deployment
+                Template as dictionary
         '''
-        #Check if resource group exists - If not create it
-        try:
-            # See if able to get resource group information
-            self.show_rg(rg_name)
-            log.info("Resource group %s already exists" %rg_name)
-        except:
-            # If unable to get rg information make new one then continue
-            log.info("Creating Resoucre group %s" %rg_name)
-            self.create_rg(rg_name, location)
-
-        # Deploy template
-        try:
-            #Try create deployment
-            out = check_output("az group deployment create -g %s --template-file %s --parameters %s" %(rg_name, template_file, parameter_file), shell=True)
-        except Exception as e:
-            log.error("Unable to deploy template: %s" %(e))
-            raise
-
+        location = "[parameters('location')]"
+        resources = []
+
+        for name, routes in self.route_tables.items():
+            resources.append({
+                'type': 'Microsoft.Network/routeTables', 'apiVersion': self.NETWORK_API, 'name': name,
+                'location': location, 'properties': {'routes': [
+                    {'name': route.name, 'properties': dict(
+                        {'addressPrefix': route.prefix, 'nextHopType': route.next_hop_type},
+                        **({'nextHopIpAddress': route.next_hop_add} if route.next_hop_add else {}))}
+                    for route in routes]}})
+
+        for name, vnet in self.vnets.items():
+            #Subnets are part of vnet resource so ARM doesn't update vnet and subnets at the same time
+            subnets = []
+            depends = set()
+            for subnet_name, subnet in vnet['subnets'].items():
+                properties = {'addressPrefix': subnet['prefix']}
+                if subnet['route_table']:
+                    properties['routeTable'] = {'id': "[resourceId('Microsoft.Network/routeTables', '%s')]"
+                                                      %subnet['route_table']}
+                    depends.add("[resourceId('Microsoft.Network/routeTables', '%s')]" %subnet['route_table'])
+                subnets.append({'name': subnet_name, 'properties': properties})
+            resources.append({
+                'type': 'Microsoft.Network/virtualNetworks', 'apiVersion': self.NETWORK_API, 'name': name,
+                'location': location, 'dependsOn': sorted(depends),
+                'properties': {'addressSpace': {'addressPrefixes': vnet['prefixes']}, 'subnets': subnets}})
+
+        outputs = {}
+        for name, vm in self.vms.items():
+            pip_id = "[resourceId('Microsoft.Network/publicIPAddresses', '%sPublicIP')]" %name
+            nsg_id = "[resourceId('Microsoft.Network/networkSecurityGroups', '%sNSG')]" %name
+            nic_id = "[resourceId('Microsoft.Network/networkInterfaces', '%sVMNic')]" %name
+            resources.append({
+                'type': 'Microsoft.Network/networkSecurityGroups', 'apiVersion': self.NETWORK_API,
+                'name': name + "NSG", 'location': location, 'properties': {'securityRules': [
+                    {'name': 'default-allow-%d' %port, 'properties': {
+                        'priority': 1000 + index, 'protocol': 'Tcp', 'access': 'Allow', 'direction': 'Inbound',
+                        'sourceAddressPrefix': '*', 'sourcePortRange': '*', 'destinationAddressPrefix': '*',
+                        'destinationPortRange': str(port)}}
+                    for index, port in enumerate(vm['ports'])]}})
+
+            ip_config = {'subnet': {'id': "[resourceId('Microsoft.Network/virtualNetworks/subnets', '%s', '%s')]"
+                                          %(vm['vnet'], vm['subnet'])},
+                         'privateIPAllocationMethod': 'Static' if vm['private_ip'] else 'Dynamic'}
+            if vm['private_ip']:
+                ip_config['privateIPAddress'] = vm['private_ip']
+            depends = ["[resourceId('Microsoft.Network/virtualNetworks', '%s')]" %vm['vnet'], nsg_id]
+            if vm['public_ip']:
+                resources.append({
+                    'type': 'Microsoft.Network/publicIPAddresses', 'apiVersion': self.NETWORK_API,
+                    'name': name + "PublicIP", 'location': location, 'sku': {'name': 'Standard'},
+                    'properties': {'publicIPAllocationMethod': 'Static'}})
+                ip_config['publicIPAddress'] = {'id': pip_id}
+                depends.append(pip_id)
+                outputs[name + 'PublicIp'] = {'type': 'string', 'value': "[reference(%s).ipAddress]" %pip_id[1:-1]}
+
+            resources.append({
+                'type': 'Microsoft.Network/networkInterfaces', 'apiVersion': self.NETWORK_API,
+                'name': name + "VMNic", 'location': location, 'dependsOn': depends,
+                'properties': {'networkSecurityGroup': {'id': nsg_id},
+                               'ipConfigurations': [{'name': 'ipconfig' + name, 'properties': ip_config}]}})
+            resources.append({
+                'type': 'Microsoft.Compute/virtualMachines', 'apiVersion': self.COMPUTE_API, 'name': name,
+                'location': location, 'dependsOn': [nic_id],
+                'properties': {
+                    'hardwareProfile': {'vmSize': vm['size']},
+                    'storageProfile': {'imageReference': vm['image'], 'osDisk': {'createOption': 'FromImage'}},
+                    'osProfile': {'computerName': name,
+                                  'adminUsername': "[parameters('%s')]" %vm['username'],
+                                  'adminPassword': "[parameters('%s')]" %vm['password'],
+                                  'linuxConfiguration': {'disablePasswordAuthentication': False}},
+                    'networkProfile': {'networkInterfaces': [{'id': nic_id}]}}})
+            outputs[name + 'PrivateIp'] = {'type': 'string', 'value': "[reference(%s).ipConfigurations[0]"
+                                                                      ".properties.privateIPAddress]" %nic_id[1:-1]}
+
+        parameters = {'location': {'type': 'string', 'defaultValue': "[resourceGroup().location]"}}
+        for name, kind in self.parameters.items():
+            parameters[name] = {'type': kind}
+        return {'$schema': "https://schema.management.azure.com/schemas/2019-04-01/deploymentTemplate.json#",
+                'contentVersion': '1.0.0.0', 'parameters': parameters, 'resources': resources,
+                'outputs': outputs}
+
+    def write(self, template_file, parameter_file, values=None):
+        '''
+        Purpose:
+                Writes template and its parameter file. Parameters without a value in values are
+                written as [placeholder] lines, one per line, for create_parameter_file to fill in
+        Arguments:
+                * template_file - Path of template file to write
+                * parameter_file - Path of parameter file to write
+                * values - Dictionary of parameter values, default None
+        '''
+        values = values or {}
+        with open(template_file, 'w') as template:
+            jsonlib.dump(self.template(), template, indent=2)
+
+        lines = ['{',
+                 '  "$schema": "https://schema.management.azure.com/schemas/2019-04-01/deploymentParameters.json#",',
+                 '  "contentVersion": "1.0.0.0",',
+                 '  "parameters": {']
+        names = sorted(self.parameters)
+        for index, name in enumerate(names):
+            value = jsonlib.dumps(values[name]) if name in values else "[%s]" %name
+            lines.append('    %s: {"value": %s}%s' %(jsonlib.dumps(name), value,
+                                                      "," if index < len(names) - 1 else ""))
+        lines += ['  }', '}']
+        with open(parameter_file, 'w') as parameters:
+            parameters.write("\n".join(lines) + "\n")
+
+class WarmPool():
     '''
-    ************************************
-    Azure VM Functions
-    ************************************
+    Keeps ready to use environments - resource group with vnet and subnet, storage account with
+    image container and optionally idle Linux VMs - provisioned in the background, so jobs lease
+    one instead of waiting for it to be built. Returned environments are scrubbed back to what was
+    provisioned, or deleted and replaced. Number of ready environments follows lease rate: it is
+    kept at leases per second times provisioning time (within min_size and max_size), extra
+    environments left idle for idle_timeout are deleted. Failed builds are retried after a delay
+    doubling with every failure in a row, after max_failures in a row the pool stops building and
+    lease raises the last build error.
+
+    Initial Arguments:
+            * azure: AzureCLI object environments are built with, has to be logged in
+            * prefix: Prefix of resource group and resource names, default 'warm'
+            * location: Location of environments, default None (location of azure context, else 'eastus')
+            * min_size: Number of environments always kept ready, default 1
+            * max_size: Most environments ready or being built at once, default 5
+            * vm_count: Idle Linux VMs in each environment, default 0
+            * vnet_prefix: Address prefix of vnet, default '10.0.0.0/16'
+            * subnet_prefix: Address prefix of subnet, default '10.0.0.0/24'
+            * container_name: Image container made in storage account, default 'images'
+            * rate_window: Seconds of leases lease rate is measured over, default 600
+            * idle_timeout: Seconds an extra ready environment is kept, default 1800
+            * max_workers: Number of environments built at the same time, default 4
+            * retry_delay: Seconds before building again after a failed build, doubled for every
+                           further failure in a row, default 30
+            * max_failures: Failed builds in a row before pool stops building, default 5
     '''
 
-    def deploy_linux(self, name, rg_name, vnet_name, subnet_name, username="automation-admin", pw="Cisco-123123"):
+    def __init__(self, azure, prefix="warm", location=None, min_size=1, max_size=5, vm_count=0,
+                 vnet_prefix="10.0.0.0/16", subnet_prefix="10.0.0.0/24", container_name="images",
+                 rate_window=600, idle_timeout=1800, max_workers=4, retry_delay=30, max_failures=5):
+        '''Warm pool __init__ sets pool settings, nothing is built until start'''
+        self.azure = azure
+        self.prefix = prefix
+        self.location = azure._location(location)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.vm_count = vm_count
+        self.vnet_prefix = vnet_prefix
+        self.subnet_prefix = subnet_prefix
+        self.container_name = container_name
+        self.rate_window = rate_window
+        self.idle_timeout = idle_timeout
+        self.retry_delay = retry_delay
+        self.max_failures = max_failures
+
+        self._ready = deque()
+        self._leased = {}
+        self._baseline = {}
+        self._building = 0
+        self._waiting = 0
+        self._leases = deque()
+        self._build_time = None
+        self._failures = 0
+        self._last_error = None
+        self._retry_at = 0
+        self._running = False
+        self._thread = None
+        self._cond = threading.Condition()
+        self.max_workers = max_workers
+        self._pool = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        '''Starts background thread keeping environments ready, a stopped pool can be started again'''
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._failures = 0
+            self._last_error = None
+            self._retry_at = 0
+            #Executor of a stopped pool is shut down, each start gets its own
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._thread = threading.Thread(target=self._maintain, name="warm-pool-%s" %self.prefix, daemon=True)
+        self._thread.start()
+
+    def stop(self, teardown=True):
         '''
         Purpose:
-                Creates basic linux VM
+                Stops background thread and waits for environments being built
         Arguments:
-                * self - Azure object
-                * name - Name of Linux VM
-                * rg_name - Name of resource group associated with Linux VM
-                * vnet_name - Name of Vnet 
-                * subnet_name - Name of subnet in Vnet
-                * username - Username of VM defaul = automation-admin
-                * pw - Password of VM deault = Cisco-123123 
+                * self - Pool object
+                * teardown - Delete ready environments, leased ones are deleted when returned, default True
+        '''
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+        if self._pool:
+            self._pool.shutdown(wait=True)
+        if teardown:
+            with self._cond:
+                ready = [environment for environment, _ in self._ready]
+                self._ready.clear()
+            for environment in ready:
+                self._delete(environment)
+
+    def target_size(self):
+        '''Number of ready environments wanted for current lease rate'''
+        now = time.time()
+        with self._cond:
+            while self._leases and self._leases[0] < now - self.rate_window:
+                self._leases.popleft()
+            rate = len(self._leases) / float(self.rate_window)
+            build_time = self._build_time or 0
+            wanted = int(math.ceil(rate * build_time)) + self._waiting
+        return max(self.min_size, min(self.max_size, wanted))
+
+    def lease(self, timeout=None):
+        '''
+        Purpose:
+                Takes ready environment from pool, waits for one to be built if none is ready.
+                Raises last build error if pool stopped building after max_failures failed builds
+        Arguments:
+                * self - Pool object
+                * timeout - Seconds to wait for an environment, default None (wait until one is ready)
         Returns:
-                Output from successful deployment - Includes public and private IP addreses in dictionary
+                PoolEnvironment (rg_name, vnet_name, subnet_name, storage_name, container_name, vm_names)
         '''
-        #Deploy Linux 
-        try:
-            #Try create deployment
-            out = check_output("az vm create -n %s -g %s --admin-username %s --admin-password %s --image UbuntuLTS --vnet-name %s --subnet %s"\
-                             %(name, rg_name, username, pw, vnet_name, subnet_name), shell=True)
-            out = out.decode('utf-8')
-        except Exception as e:
-            log.error("Unable to deploy Linux: %s" %( e))
-            raise
-
-        #Confirm VM running is seen in output
-        assert  "VM running" in out, "Linux Deployment not sucessful: %s" %out
-        return out
-
-    def delete_linux(self, name, rg_name):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            self._leases.append(time.time())
+            self._waiting += 1
+            self._cond.notify_all()
+            try:
+                while not self._ready:
+                    if not self._running:
+                        raise RuntimeError("Warm pool %s is not running" %self.prefix)
+                    if self._failures >= self.max_failures:
+                        raise self._last_error
+                    remaining = deadline - time.time() if deadline else None
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError("No environment ready in warm pool %s after %s seconds, last build error: %s"
+                                           %(self.prefix, timeout, self._last_error))
+                    self._cond.wait(remaining)
+                environment, _ = self._ready.popleft()
+                self._leased[environment.rg_name] = environment
+            finally:
+                self._waiting -= 1
+                self._cond.notify_all()
+        log.info("Leased environment %s" %environment.rg_name)
+        return environment
+
+    def release(self, environment, recycle=False):
         '''
         Purpose:
-                Deletes existing linux VM
+                Returns leased environment. It is scrubbed in the background - resources added
+                while leased are deleted - and made ready again, or deleted and replaced if recycle
+                is set or scrubbing fails
         Arguments:
-                * self - Azure object
-                * name - Name of Linux VM
-                * rg_name - Name of resource group associated with Linux VM
+                * self - Pool object
+                * environment - PoolEnvironment from lease
+                * recycle - Delete environment instead of reusing it, default False
         '''
-        #Delete Linux VM and all things associated with it 
-        log.info("Deleting Linux VM %s" %name)
+        with self._cond:
+            self._leased.pop(environment.rg_name, None)
+            running = self._running
+        if recycle or not running:
+            self._delete(environment)
+            return
+        self._pool.submit(self._scrub, environment)
+
+    @contextmanager
+    def leased(self, timeout=None):
+        '''
+        Purpose:
+                Leases environment for a with block, it is returned when the block ends and
+                replaced instead of scrubbed if the block raised
+        Arguments:
+                * self - Pool object
+                * timeout - Seconds to wait for an environment, default None
+        '''
+        environment = self.lease(timeout)
         try:
-            check_output("az vm delete -n %s -g %s --yes" %(name, rg_name), shell=True)
-        except Exception as e:
-            log.error("Unable to delete Linux: %s" %( e))
+            yield environment
+        except Exception:
+            self.release(environment, recycle=True)
             raise
+        self.release(environment)
+
+    def _names(self):
+        '''Resource names of a new environment, storage accounts need globally unique lower case names'''
+        suffix = "%08x" %random.getrandbits(32)
+        storage = re.sub(r'[^a-z0-9]', '', self.prefix.lower())[:14] + suffix
+        return PoolEnvironment("%s-%s" %(self.prefix, suffix), self.prefix + "-vnet", self.prefix + "-subnet",
+                               storage, self.container_name,
+                               tuple("%s-vm%d" %(self.prefix, index) for index in range(self.vm_count)))
+
+    def _build(self):
+        environment = self._names()
+        start = time.time()
+        try:
+            self.azure.create_rg(environment.rg_name, self.location)
+            #Network and storage don't depend on each other, VMs only need the network
+            with ThreadPoolExecutor(max_workers=2) as build:
+                network = build.submit(self.azure.create_vnet, environment.vnet_name, environment.rg_name,
+                                       self.vnet_prefix, self.location, environment.subnet_name, self.subnet_prefix)
+                storage = build.submit(self._build_storage, environment)
+                network.result()
+                vms = [build.submit(self.azure.deploy_linux, vm_name, environment.rg_name, environment.vnet_name,
+                                    environment.subnet_name) for vm_name in environment.vm_names]
+                for future in [storage] + vms:
+                    future.result()
+            baseline = self._resource_ids(environment)
+        except Exception as e:
+            log.error("Unable to build environment %s: %s" %(environment.rg_name, e))
+            self._delete(environment)
+            with self._cond:
+                self._building -= 1
+                self._failures += 1
+                self._last_error = e
+                self._retry_at = time.time() + self.retry_delay * 2 ** (self._failures - 1)
+                if self._failures == self.max_failures:
+                    log.error("Warm pool %s stopped building after %d failed builds in a row"
+                              %(self.prefix, self._failures))
+                self._cond.notify_all()
+            return
+
+        elapsed = time.time() - start
+        with self._cond:
+            #Smoothed so one slow build doesn't resize pool
+            self._build_time = elapsed if self._build_time is None else 0.7 * self._build_time + 0.3 * elapsed
+            self._baseline[environment.rg_name] = baseline
+            self._ready.append((environment, time.time()))
+            self._building -= 1
+            self._failures = 0
+            self._last_error = None
+            self._cond.notify_all()
+        log.info("Environment %s ready in %.0f seconds" %(environment.rg_name, elapsed))
+
+    def _build_storage(self, environment):
+        self.azure.create_storage(environment.storage_name, environment.rg_name, self.location)
+        #Container creation logs and swallows its errors, only its result tells build failed
+        if not self.azure.create_storage_container(environment.container_name, environment.rg_name,
+                                                   environment.storage_name):
+            raise RuntimeError("Unable to create container %s in %s" %(environment.container_name,
+                                                                      environment.storage_name))
+
+    def _resource_ids(self, environment):
+        return set(resource['id'].lower() for resource in
+                   jsonlib.loads(self.azure.list_resources(environment.rg_name, json=True, fields=['id'])))
+
+    def _scrub(self, environment):
+        '''Deletes resources added to environment while it was leased and makes it ready again'''
+        try:
+            baseline = self._baseline[environment.rg_name]
+            resources = jsonlib.loads(self.azure.list_resources(environment.rg_name, json=True, fields=['id', 'type']))
+            added = [resource for resource in resources if resource['id'].lower() not in baseline]
+            missing = baseline - set(resource['id'].lower() for resource in resources)
+            assert not missing, "Provisioned resources were deleted: %s" %", ".join(sorted(missing))
+
+            #Dependants first, same order as recorded teardowns
+            waves = {}
+            for resource in added:
+                waves.setdefault(_TEARDOWN_ORDER.get(resource['type'].lower(), 3), []).append(resource['id'])
+            for rank in sorted(waves):
+                deleted, failed = self.azure._delete_ids(waves[rank])
+                assert not failed, "Unable to delete %s" %", ".join(failed)
+        except Exception as e:
+            log.warning("Unable to scrub environment %s, replacing it: %s" %(environment.rg_name, e))
+            self._delete(environment)
+            return
 
-        log.info("Try to delete remaining resources associated with linux %s" %name)
+        with self._cond:
+            self._ready.append((environment, time.time()))
+            self._cond.notify_all()
+        log.info("Environment %s scrubbed, %d resources removed" %(environment.rg_name, len(added)))
+
+    def _delete(self, environment):
+        self._baseline.pop(environment.rg_name, None)
         try:
-            #delete associated disk
-            self.delete_disk(rg_name, name)
-            log.info("Deleted disk")
+            self.azure.delete_rg(environment.rg_name, no_wait=True)
+        except Exception as e:
+            log.error("Unable to delete environment %s: %s" %(environment.rg_name, e))
+
+    def _maintain(self):
+        '''Background loop building environments up to target size and retiring idle extras'''
+        while True:
+            target = self.target_size()
+            retire = []
+            with self._cond:
+                if not self._running:
+                    return
+                missing = target - len(self._ready) - self._building
+                #After failures only one build at a time, once retry delay has passed
+                if self._failures >= self.max_failures or time.time() < self._retry_at:
+                    missing = 0
+                elif self._failures:
+                    missing = min(missing, 1 - self._building)
+                for _ in range(max(0, missing)):
+                    self._building += 1
+                    self._pool.submit(self._build)
+
+                #Oldest ready environments are at the front
+                while len(self._ready) > target and self._ready[0][1] < time.time() - self.idle_timeout:
+                    retire.append(self._ready.popleft()[0])
+
+                delay = self._retry_at - time.time()
+                self._cond.wait(min(5, delay) if delay > 0 else 5)
+
+            for environment in retire:
+                log.info("Retiring idle environment %s" %environment.rg_name)
+                self._delete(environment)
+
+class AzureCancelledError(Exception):
+    '''
+    Azure operation stopped before it finished because it was cancelled, see CancelToken
 
-            #delete associated NIC
-            self.delete_nic(rg_name, name)
-            log.info("Deleted network interface")
+    Initial Arguments:
+            * operation: Command or request that was stopped
+            * elapsed: Seconds operation ran for
+            * state: Partial state of resource operation was working on, None if unknown
+            * reason: Why operation was stopped ie 'cancelled' or 'deadline'
+    '''
 
-            #delete associated NSG
-            self.delete_nsg(rg_name, name)
-            log.info("Deleted network security group")
+    def __init__(self, operation, elapsed, state=None, reason="cancelled"):
+        super(AzureCancelledError, self).__init__("%s stopped (%s) after %.1f seconds, partial state: %s"
+                                                  %(operation, reason, elapsed, state))
+        self.operation = operation
+        self.elapsed = elapsed
+        self.state = state
+        self.reason = reason
 
-            #delete associated Public IP
-            self.delete_public_ip(rg_name, name)
-            log.info("Deleted public IP")
 
-            #Check all resources with name are deleted
-            output= self.list_resources(rg_name)
-            assert name not in output, "Some resources with name %s remaining: %s" %(name,output)
-            log.info("All additional resources sucessfully deleted")
+class AzureDeadlineError(AzureCancelledError):
+    '''Azure operation stopped because its deadline passed, see AzureCancelledError'''
+
+    def __init__(self, operation, elapsed, state=None):
+        super(AzureDeadlineError, self).__init__(operation, elapsed, state, "deadline")
 
-        except Exception as e:
-            log.error("Unable to delete all resources associated with Linux %s : %s" %(name, e))
-            raise
 
-    def list_vm(self, rg_name, json=False):
+def _kill_tree(proc):
+    '''Kills process group of proc started with start_new_session, so commands az started die too'''
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+class CancelToken():
+    '''
+    Deadline and cooperative cancellation of the operations run by an AzureCLI object, shared with
+    its copies (see AzureCLI.context and AzureCLI.scope) and so with parallel operations. Cancelling
+    kills the process tree of every running az command registered with the token or its children,
+    wakes up waiting loops, and makes every later operation raise AzureCancelledError
+
+    Initial Arguments:
+            * timeout: Seconds until deadline, default None (no deadline)
+            * parent: CancelToken this one is cancelled with, deadline is never later than parent's
+    '''
+
+    def __init__(self, timeout=None, parent=None):
+        '''Cancel token __init__ links token to parent'''
+        self.parent = parent
+        self.deadline = time.time() + timeout if timeout is not None else None
+        if parent and parent.deadline is not None:
+            self.deadline = min(parent.deadline, self.deadline or parent.deadline)
+        self.reason = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._procs = set()
+        self._children = weakref.WeakSet()
+        if parent:
+            with parent._lock:
+                parent._children.add(self)
+            if parent.cancelled:
+                self.cancel(parent.reason)
+
+    @property
+    def cancelled(self):
+        '''True once token or its parent was cancelled'''
+        return self._event.is_set()
+
+    def cancel(self, reason="cancelled"):
         '''
         Purpose:
-                Lists Azure VM associated with a resource_group
+                Cancels operations running under token and its children
         Arguments:
-                * self - Azure object
-                * rg_name - Resource group VMs are associated with
-                * json - If you want the data in json format, default False
+                * reason - Reason reported by AzureCancelledError, default 'cancelled'
         '''
-        try:
-            #Try to delete route table
-            if(json):
-                out = check_output("az vm list -g %s" %(rg_name), shell=True)
-            else:
-                out = check_output("az vm list -g %s -o table" %(rg_name), shell=True)
-        except Exception as e:
-            log.error("Unable to list vms %s" %(e))
-            raise
-
-        #Check data isn't empty
-        assert not out.isspace(), "Unable to list VMs"
-        return out.decode('utf-8')
-
-    def list_resources(self, rg_name, json=False):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            procs = list(self._procs)
+            children = list(self._children)
+        for proc in procs:
+            _kill_tree(proc)
+        for child in children:
+            child.cancel(reason)
+
+    def remaining(self):
+        '''Seconds left until deadline, None if token has no deadline'''
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.time())
+
+    def check(self, operation, start_time=None, state=None):
         '''
         Purpose:
-                Lists Azure resources associated with resource_group
+                Raises if operation should stop
         Arguments:
-                * self - Azure object
-                * rg_name - Resource group resources are associated with
-                * json - If you want the data in json format, default False
+                * operation - Description of operation ie command
+                * start_time - Time operation started, default None (now)
+                * state - Partial state of resource reported in error, default None
         '''
-        try:
-            #Try to delete route table
-            if(json):
-                out = check_output("az resource list -g %s" %(rg_name), shell=True)
-            else:
-                out = check_output("az resource list -g %s -o table" %(rg_name), shell=True)
-        except Exception as e:
-            log.error("Unable to list resources %s" %(e))
+        elapsed = time.time() - start_time if start_time else 0
+        if self.cancelled:
+            raise AzureCancelledError(operation, elapsed, state, self.reason)
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise AzureDeadlineError(operation, elapsed, state)
+
+    def sleep(self, seconds):
+        '''Sleeps for seconds, returning early when token is cancelled or its deadline passes'''
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+        self._event.wait(max(0, seconds))
+
+    def _register(self, proc):
+        '''Adds running process to be killed on cancel'''
+        with self._lock:
+            self._procs.add(proc)
+            cancelled = self._event.is_set()
+        if cancelled:
+            _kill_tree(proc)
+
+    def _unregister(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
 
-        #Check data isn't empty
-        assert not out.isspace(), "Unable to list Resources associated with resource group %s" %rg_name
-        return out.decode('utf-8')
+
+class AzureCLI():
+    '''
+    This is the base class for the Azure CLI. Allows you to login and do 
+    Base manipulations of Azure. Can either login using Application-ID, 
+    Directory-ID and Auth-Key, or by Username and Password. Make sure to 
+    provide all the required parameters for chosen method.
+
+    Initial Arguments:
+            * self: is the container
+            * appid: Azure Application ID to connect to, default None
+            * dirid: Azure Directory ID to connect to, default None
+            * key: Azure Secret Key used to connect, default None
+
+            * username : Azure username, default None
+            * pw : Azure Password, default None
+
+            * cassette : AzCassette to record commands to or replay them from, default None
+            * store : StateStore to record created resources in, default None
+            * config_dir : Azure CLI configuration directory (AZURE_CONFIG_DIR) holding login of
+                           this object, default None (profile of user)
+            * timeout : Seconds any az command may run before its process tree is killed, default None
+            * timeouts : Dictionary of seconds by az command ie {'vm create': 900} overriding timeout,
+                         default None
+
+    One object can be shared by many threads: login happens once, cached state is locked and
+    used as a context manager it logs in on enter and disconnects on exit. Operations can be
+    given a deadline and cancelled from other threads, see scope and cancel
+    '''
+
+    def __init__(self, appid=None, dirid=None, key=None, username=None, pw=None, cassette=None, store=None,
+                 config_dir=None, timeout=None, timeouts=None):
+        '''Azure CLI base class __init__ will set global variables to use in object'''
+        self.type       = 'azure'
+        #Credentials of the other login method stay None
+        self.appid = self.dirid = self.key = self.username = self.pw = None
+        #Check which method using to login confirm all needed parameters included
+        if (appid and dirid and key):
+            self.appid = appid
+            self.dirid = dirid
+            self.key = key
+        elif (username and pw):
+            self.username = username
+            self.pw = pw 
+        else: 
+            raise  ValueError("Either use Application-ID, Directory-ID and Auth-Key or Username and PW to login,"\
+                             " make sure to provide all parameters of your chosen method")
+
+        self.is_logged_in = False
+        self._login_lock = threading.RLock()
+
+        #Resolve Azure CLI once instead of looking it up for every command
+        self.az_path = shutil.which("az")
+
+        #Actual state of resources read by ensure functions, guarded by per kind locks
+        self._state_cache = {}
+        self._state_locks = {}
+        self._lock = threading.Lock()
+
+        self.cassette = cassette
+        if cassette:
+            cassette.add_secrets([key, pw])
+
+        self.store = store
+
+        #Subscription and environment commands run with, see context
+        self.subscription = None
+        self.location = None
+        self._env = dict(os.environ, AZURE_CONFIG_DIR=config_dir) if config_dir else None
+
+        #Deadlines and cancellation of commands, see scope
+        self.timeout = timeout
+        self.timeouts = dict(timeouts or {})
+        self.cancel_token = CancelToken()
 
     '''
     ************************************
-    Azure Route-Table and Route Functions
+    Azure Connectivity Functions
     ************************************
     '''
 
-    def show_all_route_tables(self, rg_name, json=False):
+    def login_azure_cli(self, force=False):
         '''
         Purpose:
-                Gets data about Azure route tables associated with resource group
+                Checks Azure CLI is installed on box then logs in with either 
+                Username and Password or Application-ID, Directory-ID and Auth-Key
+                depending on how azure object was initialized. If Azure-CLI not installed
+                will attempt to install (this will only work on machines where logged in 
+                as root or have admin permissions). Threads calling at the same time wait
+                for one login, nothing is done if already logged in
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group you want route-tables in
-                * json - If you want the data in json format, default False
-        Returns:
-                Azure route-table information as string or json depending on input
+                * force - Login again even if already logged in, default False
         '''
+        with self._login_lock:
+            if self.is_logged_in and not force:
+                return
+            self._login()
+
+    def _login(self):
+        '''Installs Azure CLI if needed and logs in, see login_azure_cli'''
+
+        # Confirm Azure CLI installed - path resolved when object was created,
+        # not needed when replaying commands from a cassette
+        if not self.az_path and not (self.cassette and self.cassette.mode == "replay"):
+            log.info("Azure CLI not installed on this machine")
+            #Install Azure CLI 
+            try:
+                log.info("Attempting to install Azure-CLI, can take a few minutes")
+                self._run([sys.executable, "-m", "pip", "install", "azure-cli"])
+                self.az_path = shutil.which("az") or os.path.join(os.path.dirname(sys.executable), "az")
+                log.info("Azure CLI installed")
+            except Exception as e:
+                log.error("Unable to install Azure CLI: %s" %e)
+                raise
 
-        if (json):
-            out = check_output("az network route-table list -g %s" %rg_name, shell=True)
-        else: 
-            out = check_output("az network route-table list -g %s -o table" %rg_name, shell=True)
+        # Confirm able to login
+        if self.appid:
+            try:
+                #Try to login with app-id, dir-id and auth-key
+                self._run(["az", "login", "-u", self.appid, "--service-principal", "--tenant",
+                           self.dirid, "-p", self.key])
+            except Exception as e:
+                log.error("Unable to logon to Azure with App-ID, Dir-ID and Auth-Key %s" %e)
+                raise
 
-        #Check data isn't empty
-        assert not out.isspace(), "Unable to list route tables associated with resource group %s" %rg_name
-        return out.decode('utf-8')
+        elif self.username:
+            try:
+                #Try to login with username and pw
+                self._run(["az", "login", "-u", self.username, "-p", self.pw])
+            except Exception as e:
+                log.error("Unable to logon to Azure with Username and Password %s" %e)
+                raise
+
+        log.info("Logged into Azure")
+        self.is_logged_in = True
 
-    def show_route_table(self, rg_name, route_table, json=False):
+    def disconnect_azure(self):
         '''
         Purpose:
-                Gets data about specific Azure route table, To see route information have json=True
+                Disconnects safely from Azure ClI
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group route-table is associated with
-                * route_table - Route-table to collect info on
-                * json - If you want the data in json format, default False
-        Returns:
-                Azure route-table information as string or json depending on input
         '''
 
-        if (json):
-               out = check_output("az network route-table show -g %s -n %s" %(rg_name, route_table), shell=True)
-        else: 
-               out = check_output("az network route-table show -g %s -n %s -o table" %(rg_name, route_table), shell=True)
+        with self._login_lock:
+            try:
+                #Try to logout
+                self._run(["az", "logout"])
+            except Exception as e:
+                log.error("Unable to logout %s" %(e))
+            self.is_logged_in = False
 
-        #Check data isn't empty
-        assert not out.isspace(), "Unable get information about route-table %s" %route_table
-        return out.decode('utf-8')
+    def __enter__(self):
+        '''Logs in, see login_azure_cli'''
+        self.login_azure_cli()
+        return self
+
+    def __exit__(self, *exc):
+        '''Disconnects, see disconnect_azure'''
+        self.disconnect_azure()
+
+    def _argv(self, cmd):
+        '''Command list with az replaced by path of Azure CLI resolved when object was created'''
+        if cmd[0] == "az" and self.az_path:
+            return [self.az_path] + list(cmd[1:])
+        return list(cmd)
 
-    def show_routes(self, rg_name, route_table, json=False):
+    def _run(self, cmd):
         '''
         Purpose:
-                Gets data about Azure routes in route table
+                Runs command without a shell, all Azure CLI commands go through here so
+                they can be recorded to or replayed from a cassette
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group route-table is associated with
-                * route_table - Route-table to collect route info on
-                * json - If you want the data in json format, default False
+                * cmd - Command to run as list of arguments ie ["az", "group", "show", "-n", name]
         Returns:
-                Azure route information as string or json depending on input
+                Output of command as bytes
         '''
+        cmd = self._scoped(cmd)
+        if self.cassette:
+            out = self.cassette.play(cmd, lambda: self._check_output(cmd))
+        else:
+            out = self._check_output(cmd)
+
+        #Record resources made by create commands ie az network vnet create
+        if self.store and cmd[0] == "az":
+            verbs = list(takewhile(lambda arg: not arg.startswith('-'), cmd[1:]))
+            if verbs and verbs[-1] == "create":
+                ids = self.store.record_output(out)
+                if verbs == ["vm", "create"] and ids:
+                    self._record_vm_resources(cmd, ids[0])
+        return out
 
-        if (json):
-            out = check_output("az network route-table route list -g %s --route-table-name %s" %(rg_name, route_table), shell=True)
-        else: 
-            out = check_output("az network route-table route list -g %s --route-table-name %s -o table" %(rg_name, route_table), shell=True)
-
-        #Check data isn't empty
-        assert not out.isspace(), "Unable get information about routes in route-table %s" %route_table
-        return out.decode('utf-8')
-
-    def add_route_table(self, rg_name, route_table):
+    def _record_vm_resources(self, cmd, vm_id):
         '''
         Purpose:
-                Adds Azure Route-Table
+                Records resources az vm create made along with VM. Its output only holds ID of VM,
+                so OS disk, NIC, NSG and public IP are looked up from VM and its NIC. Resources
+                given with --attach-os-disk, --nics, --nsg or --public-ip-address are left out
+                as they may have existed before
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group route-table is associated with
-                * route_table - Route-table to be added
+                * cmd - az vm create command that was run
+                * vm_id - ID of created VM
         '''
-
         try:
-            #Try to add route table
-            check_output("az network route-table create -g %s -n %s" %(rg_name, route_table), shell=True)
+            vm = jsonlib.loads(self._run(["az", "vm", "show", "--ids", vm_id, "--query",
+                                          "{nics: networkProfile.networkInterfaces[].id, "
+                                          "disk: storageProfile.osDisk.managedDisk.id}", "-o", "json"]))
+            ids = [vm['disk']] if vm.get('disk') and "--attach-os-disk" not in cmd else []
+            if "--nics" not in cmd:
+                for nic_id in vm.get('nics') or []:
+                    ids.append(nic_id)
+                    nic = jsonlib.loads(self._run(["az", "network", "nic", "show", "--ids", nic_id, "--query",
+                                                   "{nsg: networkSecurityGroup.id, "
+                                                   "pips: ipConfigurations[].publicIPAddress.id}", "-o", "json"]))
+                    if nic.get('nsg') and "--nsg" not in cmd:
+                        ids.append(nic['nsg'])
+                    if "--public-ip-address" not in cmd:
+                        ids += [pip_id for pip_id in nic.get('pips') or [] if pip_id]
         except Exception as e:
-            log.error("Unable to add route-table %s: %s" %(route_table,e))
-            raise
-
-    def delete_route_table(self, rg_name, route_table):
+            log.warning("Unable to look up resources created with VM %s: %s" %(vm_id, e))
+            return
+
+        for resource_id in ids:
+            self.store.record(resource_id)
+
+    def _forget(self, rg_name, path=None):
+        '''Marks resource at path (ie Microsoft.Network/virtualNetworks/vnet1) and its children
+        deleted in state store, the whole resource group without path'''
+        if self.store and rg_name:
+            self.store.mark_deleted_path(rg_name, path)
+
+    def _forget_id(self, resource_id):
+        '''Marks resource and its children deleted in state store by ID, see _forget'''
+        parts = resource_id.strip('/').split('/')
+        lowered = [part.lower() for part in parts]
+        path = "/".join(parts[lowered.index('providers') + 1:]) if 'providers' in lowered else None
+        self._forget(_rg_from_id(resource_id), path)
+
+    def _command_timeout(self, cmd, token=None):
+        '''Seconds command may run for - its entry in timeouts or timeout, limited by deadline of token'''
+        verbs = list(takewhile(lambda arg: not arg.startswith('-'), cmd[1:])) if cmd[0] == "az" else []
+        timeout = self.timeout
+        for end in range(len(verbs), 0, -1):
+            if " ".join(verbs[:end]) in self.timeouts:
+                timeout = self.timeouts[" ".join(verbs[:end])]
+                break
+        remaining = (token or self.cancel_token).remaining()
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def _check_output(self, cmd, token=None):
         '''
         Purpose:
-                Delete Azure Route-Table
+                Runs command in its own process group and returns its output. The whole process
+                tree is killed when the command timeout or deadline passes or the token is
+                cancelled, raising AzureDeadlineError or AzureCancelledError with elapsed time
+                and partial state of the resource the command was changing
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group route-table is associated with
-                * route_table - Route-table to be added
+                * cmd - Command to run as list of arguments, already scoped
+                * token - CancelToken command runs under, default cancel_token of object
+        Returns:
+                Output of command as bytes
         '''
-
+        token = token or self.cancel_token
+        start_time = time.time()
+        operation = " ".join(takewhile(lambda arg: not arg.startswith('-'), cmd))
+        token.check(operation, start_time)
+        timeout = self._command_timeout(cmd, token)
+
+        proc = Popen(self._argv(cmd), stdout=PIPE, env=self._env, start_new_session=True)
+        token._register(proc)
         try:
-            #Try to delete route table
-            check_output("az network route-table delete -g %s -n %s" %(rg_name, route_table), shell=True)
-        except Exception as e:
-            log.error("Unable to delete route-table %s: %s" %(route_table,e))
-            raise
+            out, _ = proc.communicate(timeout=timeout)
+        except TimeoutExpired:
+            _kill_tree(proc)
+            proc.communicate()
+            log.error("%s not finished after %.1f seconds, killed" %(operation, time.time() - start_time))
+            raise AzureDeadlineError(operation, time.time() - start_time, self._partial_state(cmd))
+        finally:
+            token._unregister(proc)
+
+        #Command that finished before it could be killed did its work, only a killed one was stopped
+        if token.cancelled and proc.returncode:
+            raise AzureCancelledError(operation, time.time() - start_time, self._partial_state(cmd), token.reason)
+        if proc.returncode:
+            raise CalledProcessError(proc.returncode, self._argv(cmd), out)
+        return out
 
-    def add_route(self, rg_name, route_table, route, prefix, next_hop_add, next_hop_type="VirtualAppliance"):
+    def _partial_state(self, cmd):
         '''
         Purpose:
-                Adds Azure Route
+                Reads state of resource a stopped command was changing, so the error tells what
+                was left behind. Only for commands with resource group and name
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group route-table is associated with
-                * route_table - Route-table route to be added
-                * route - Route to be added
-                * prefix - Address prefix to which route applies
-                * next_hop_type - The type of Azure hop the packet should be sent to.  Allowed\
-                                 values: Internet, None, VirtualAppliance, VirtualNetworkGateway,\
-                                 VnetLocal. Default to VirtualAppliance
-                * next_hop_add - The IP address packets should be forwarded to when using the\
-                                    VirtualAppliance hop type.
+                * cmd - Command that was stopped
+        Returns:
+                List of matching resources (id, type and provisioningState), None if unknown
         '''
+        verbs = list(takewhile(lambda arg: not arg.startswith('-'), cmd[1:]))
+        if cmd[0] != "az" or not verbs or verbs[-1] in ("show", "list", "login", "logout"):
+            return None
+        options = dict(zip(cmd, cmd[1:]))
+        rg_name = options.get("-g") or options.get("--resource-group")
+        name = options.get("-n") or options.get("--name")
+        if not rg_name or not name:
+            return None
 
         try:
-            #Try to create route
-            check_output("az network route-table route create -g %s -n %s --address-prefix "\
-            "%s --next-hop-type %s --route-table-name %s --next-hop-ip-address %s"\
-            %(rg_name, route, prefix, next_hop_type, route_table, next_hop_add), shell=True)
+            out = self._check_output(self._scoped(["az", "resource", "list", "-g", rg_name, "--name", name,
+                                                   "--query", "[].{id:id, type:type, provisioningState:provisioningState}",
+                                                   "-o", "json"]), CancelToken(30))
+            return jsonlib.loads(out.decode('utf-8') or "null")
         except Exception as e:
-            log.error("Unable to add route %s: %s" %(route,e))
-            raise
+            log.info("Unable to read partial state of %s: %s" %(name, e))
+            return None
 
-    def delete_route(self, rg_name, route_table, route):
+    def scope(self, timeout=None):
         '''
         Purpose:
-                Delete Azure Route
+                Makes copy of Azure object whose operations share one deadline and can be
+                cancelled together, without cancelling operations of this object. Cancelling
+                this object cancels the copy too
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group route-table is associated with
-                * route_table - Route-table route to be deleted on
-                * route - Route to be deleted
+                * timeout - Seconds until deadline of every operation run through the copy,
+                            including parallel ones, default None (deadline of this object)
+        Returns:
+                Azure object
         '''
+        scoped = copy.copy(self)
+        scoped.cancel_token = CancelToken(timeout, self.cancel_token)
+        return scoped
 
-        try:
-            #Try to delete route
-            check_output("az network route-table route delete -g %s -n %s --route-table-name %s"\
-                         %(rg_name, route, route_table), shell=True)
-        except Exception as e:
-            log.error("Unable to delete route %s: %s" %(route,e))
-            raise
+    def cancel(self, reason="cancelled"):
+        '''
+        Purpose:
+                Cancels operations of object and copies made from it - running az commands are
+                killed, waits stop and later operations raise AzureCancelledError. Safe to call
+                from any thread
+        Arguments:
+                * self - Azure object
+                * reason - Reason reported in errors, default 'cancelled'
+        '''
+        log.info("Cancelling Azure operations: %s" %reason)
+        self.cancel_token.cancel(reason)
 
-    '''
+    def _output_args(self, json, fields=None, query=None, many=True, base_query=None):
+        '''
+        Purpose:
+                Builds --query and -o arguments of list and show functions so only the fields needed
+                are returned by Azure CLI. Fields are compiled to a JMESPath projection, with tsv
+                output as a list per record so values keep the order of fields
+        Arguments:
+                * self - Azure object
+                * json - JSON output, otherwise table or tsv when fields or query given
+                * fields - List of field paths ie ['name', 'ipAddress'] or dictionary of output name
+                           and field path, default None
+                * query - JMESPath query used instead of fields, default None
+                * many - Output is a list of records, default True
+                * base_query - JMESPath query output is filtered by first, default None
+        Returns:
+                List of arguments
+        '''
+        expression = query or (fields and _fields_query(fields, many, tsv=not json))
+        if base_query and expression:
+            expression = "%s | %s" %(base_query, expression)
+        expression = expression or base_query
+
+        args = ["--query", expression] if expression else []
+        if not json:
+            args += ["-o", "tsv" if fields or query else "table"]
+        return args
+
+    def _scoped(self, cmd):
+        '''Command with subscription of object added, see context'''
+        if not self.subscription or cmd[0] != "az" or len(cmd) < 2 or \
+           cmd[1] in ("login", "logout", "account", "version", "extension", "configure") or \
+           "--subscription" in cmd or "--subscriptions" in cmd:
+            return cmd
+        if cmd[1] == "graph":
+            return list(cmd) + ["--subscriptions", self.subscription]
+        return list(cmd) + ["--subscription", self.subscription]
+
+    def context(self, subscription=None, location=None, rg_name=None):
+        '''
+        Purpose:
+                Makes copy of Azure object with its own CLI context - commands of the copy run in
+                subscription and get location and resource group as Azure CLI defaults through the
+                environment, so nothing has to be switched with az account set or az configure and
+                copies can be used at the same time. Functions creating resources ie create_rg or
+                ensure_vnet use location of the copy when not given one. Login and cassette are shared
+        Arguments:
+                * self - Azure object
+                * subscription - Subscription ID or name commands run in, default None (current)
+                * location - Default location, default None
+                * rg_name - Default resource group, default None
+        Returns:
+                Azure object
+        '''
+        scoped = copy.copy(self)
+        scoped.subscription = subscription or self.subscription
+        scoped.location = location or self.location
+        scoped._env = dict(self._env or os.environ)
+        if location:
+            scoped._env['AZURE_DEFAULTS_LOCATION'] = location
+        if rg_name:
+            scoped._env['AZURE_DEFAULTS_GROUP'] = rg_name
+        scoped._state_cache = {}
+        scoped._state_locks = {}
+        scoped._lock = threading.Lock()
+        return scoped
+
+    def _location(self, location=None):
+        '''Location resources are created in - location given, else location of context, else eastus'''
+        return location or self.location or "eastus"
+
+    ''' 
     ************************************
-    Azure Network Functions
+    Azure Resource Group Functions
     ************************************
     '''
-
-    def delete_public_ip(self, rg_name, vm_name, pip_name=None):
+    def create_rg(self, rg_name, location=None):
         '''
         Purpose:
-                Deletes Azure public IP
+                Creates new resource group
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group PIP is associated with
-                * vm_name - VM associated with PIP important to make sure deleted
-                * pip_name - Name of Public IP to delete -Optional as will use VM name+PublicIP
-                            as default - this is the format for azure generated public IPs 
+                * rg_name - Name of resource group to be created
+                * location - Location for resource group, default None (location of context, else "eastus")
         '''
-        # Check vm Deleted 
-        assert vm_name not in self.list_vm(rg_name), "VM is still present delete before deleting Public IP"
-
-        #If disk name not given get disk name
-        if not pip_name:
-            pip_name = vm_name+"PublicIP"
+        location = self._location(location)
 
         try:
-            #Try to delete public IP
-            check_output("az network public-ip delete -n %s -g %s" %(pip_name, rg_name), shell=True)
+            #Try create resource group
+            self._run(["az", "group", "create", "--name", rg_name, "--location", location])
         except Exception as e:
-            log.error("Unable to delete Public IP %s: %s" %(pip_name,e))
+            log.error("Unable to create rg %s: %s" %(rg_name, e))
             raise
 
-    def list_pip(self, rg_name, json=False):
+    def delete_rg(self, rg_name, no_wait=False):
         '''
         Purpose:
-                Lists Azure Public IPs associated with a resource_group
+                Deletes exisiting resource group
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group public-ip are associated with
-                * json - If you want the data in json format, default False
-        Returns: 
-               Azure public Ips associated with a resource group in string or json
+                * rg_name - Name of resource group to be deleted
+                * no_wait - Return as soon as deletion is accepted instead of waiting for it
+                            to finish, default False
         '''
+
         try:
-            #List public IP
-            if(json):
-                out = check_output("az network public-ip list-g %s" %(rg_name), shell=True)
-            else:
-                out = check_output("az network public-ip list -g %s -o table" %(rg_name), shell=True)
+            #Try to logout
+            cmd = ["az", "group", "delete", "--name", rg_name, "-y"]
+            if no_wait:
+                cmd.append("--no-wait")
+            self._run(cmd)
         except Exception as e:
-            log.error("Unable to list public-ip %s" %(e))
+            log.error("Unable to delete rg %s: %s" %(rg_name, e))
             raise
+        if not no_wait:
+            self._forget(rg_name)
 
-        #Check data isn't empty
-        assert not out.isspace(), "Unable to list public IPs"
-        return out.decode('utf-8')
-
-    def get_public_ip_from_vm(self, pip_name, rg_name):
+    def list_rg(self, tags={'location':'eastus'}, json=False, fields=None, query=None):
         '''
         Purpose:
-                Extract public IP from existing VM 
+                Gets list of Azure resource groups based on passed in tags
         Arguments:
                 * self - Azure object
-                * pip_name - Name of Public IP
-                * rg_name - Name of resource group associated with VM
+                * tags - dictionary containing tag id and tag value default = {'location':'eastus'}
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output of tag filter instead of fields, default None
         Returns:
-                Public IP in string format
+                Azure resource groups as string or json depending on input
         '''
 
-        #Get all public IPs associated with resource group
-        out = self.list_pip(rg_name)
-        assert out, "Unable to get Public IP information: %s" %out.decode('utf-8')
+        # Concantinate all tags into a single string to pass to Azure ClI
+        tag_str = ""
+        for tag in tags:
+            tag_str += "[?%s=='%s']" %(tag, tags[tag])
+
+        out = self._run(["az", "group", "list"] + self._output_args(json, fields, query, base_query=tag_str))
 
-        #Use regex to find public IP
-        m = re.search(r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}) .* %s' %pip_name, out)
-        assert m, "Unable to find public ip in output %s" %out
-        return m.group(1).strip()
+        #Check data isn't empty
+        assert not out.isspace(), "No Resource Groups information collected"
+        return out.decode('utf-8')
 
-    def list_nsg(self, rg_name, json=False):
+    def show_rg(self, rg_name, json=False, fields=None, query=None):
         '''
         Purpose:
-                Lists Azure Network Security Groups associated with a resource_group
+                Gets data about specific Azure resource group
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group nsg are associated with
+                * rg_name - Name of Resource Group you want data about
                 * json - If you want the data in json format, default False
-        Returns: 
-               Azure Network Security Groups associated with a resource group in string or json
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        Returns:
+                Azure resource group information as string or json depending on input
         '''
-        try:
-            #Try to list nsg
-            if(json):
-                out = check_output("az network nsg list -g %s" %(rg_name), shell=True)
-            else:
-                out = check_output("az network nsg list -g %s -o table" %(rg_name), shell=True)
-        except Exception as e:
-            log.error("Unable to list nsg %s" %(e))
-            raise
+
+        out = self._run(["az", "group", "show", "--name", rg_name] +
+                        self._output_args(json, fields, query, many=False))
 
         #Check data isn't empty
-        assert not out.isspace(), "Unable to list network securit groups associated with resource group %s" %rg_name
+        assert not out.isspace(), "No information for Resource Group %s collected" %rg_name
         return out.decode('utf-8')
 
-    def delete_nsg(self, rg_name, vm_name, nsg_name=None):
+    def select_rgs(self, tags=None, name_pattern=None, location=None):
         '''
         Purpose:
-                Delete Azure Network Security Group
+                Gets names of Azure resource groups matching tags, a name pattern and location
+                from a single listing of all resource groups
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group NSG is associated with
-                * vm_name - VM associated with NSG important to make sure deleted
-                * nsg_name - Name of network security group to delete -Optional as will use VM name+NSG
-                            as default - this is the format for azure generated NSGs
+                * tags - dictionary containing tag id and tag value groups must have, a value
+                         of '*' matches any value of the tag, default None
+                * name_pattern - Shell style pattern group names must match ie 'ci-*', default None
+                * location - Location groups must be in, default None
+        Returns:
+                List of resource group names
         '''
-        # Check vm Deleted 
-        assert vm_name not in self.list_vm(rg_name), "VM is still present delete before deleting NSG"
-
-        #If nsg name not given get nsg name
-        if not nsg_name:
-            nsg_name = vm_name+"NSG"
-
-        try:
-            #Try to delete nsg
-            check_output("az network nsg delete -n %s -g %s" %(nsg_name, rg_name), shell=True)
-        except Exception as e:
-            log.error("Unable to delete NSG %s: %s" %(nsg_name,e))
-            raise
-  
-    def list_nic(self, rg_name, json=False):
+        names = []
+        for group in self._iter_az_json(["az", "group", "list"]):
+            group_tags = group.get('tags') or {}
+            if name_pattern and not fnmatch.fnmatchcase(group['name'], name_pattern):
+                continue
+            if location and group.get('location') != location:
+                continue
+            if any(tag not in group_tags or (tags[tag] != '*' and group_tags[tag] != tags[tag])
+                   for tag in tags or {}):
+                continue
+            names.append(group['name'])
+
+        return names
+
+    def delete_rgs(self, tags=None, name_pattern=None, location=None, rg_names=None, dry_run=False,
+                   timeout=3600, poll_interval=15, max_workers=10):
         '''
         Purpose:
-                Lists Azure Network Interface associated with a resource_group
+                Deletes many resource groups at once. Groups are picked by tags and/or name
+                pattern (see select_rgs) or given by name, all deletions are submitted without
+                waiting and then tracked together with one listing of groups per poll, so the
+                teardown takes about as long as the slowest group
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group nics are associated with
-                * json - If you want the data in json format, default False
-        Returns: 
-               Azure Network Interfaces associated with a resource group in string or json
+                * tags - dictionary containing tag id and tag value groups must have, default None
+                * name_pattern - Shell style pattern group names must match ie 'ci-*', default None
+                * location - Location groups must be in, default None
+                * rg_names - List of resource group names to delete instead of selecting them, default None
+                * dry_run - Only report groups which would be deleted, default False
+                * timeout - Seconds to wait for all deletions to finish, default 3600
+                * poll_interval - Seconds between checks of deletion progress, default 15
+                * max_workers - Number of deletion requests submitted at the same time, default 10
+        Returns:
+                Dictionary of RGTeardownResult (name, status, elapsed, error) by group name, status
+                is one of 'selected' (dry run), 'deleted', 'failed' or 'timeout'
         '''
-        try:
-            #List azure nics
-            if(json):
-                out = check_output("az network nic list -g %s" %(rg_name), shell=True)
-            else:
-                out = check_output("az network nic list -g %s -o table" %(rg_name), shell=True)
-        except Exception as e:
-            log.error("Unable to list nic %s" %(e))
-            raise
-
-        #Check data isn't empty
-        assert not out.isspace(), "Unable to list network interfaces associated with resource group %s" %rg_name
-        return out.decode('utf-8')
 
-    def delete_nic(self, rg_name, vm_name, nic_name=None):
-        '''
-        Purpose:
-                Delete Azure Network Interface
-        Arguments:
-                * self - Azure object
-                * rg_name - Resource group NIC is associated with
-                * vm_name - VM associated with NIC important to make sure deleted
-                * nsg_name - Name of network interface to delete -Optional as will use VM name+VMNic
-                            as default - this is the format for azure generated NSGs
-        '''
-        # Check vm Deleted 
-        assert vm_name not in self.list_vm(rg_name), "VM is still present delete before deleting NIC"
+        if rg_names is None:
+            #Protect against deleting every resource group
+            assert tags or name_pattern, "Provide tags or name_pattern to select resource groups to delete"
+            rg_names = self.select_rgs(tags, name_pattern, location)
+
+        log.info("Resource groups selected for deletion: %s" %", ".join(rg_names))
+        if dry_run:
+            return dict((name, RGTeardownResult(name, 'selected', 0, None)) for name in rg_names)
+
+        results = {}
+        start = time.time()
+
+        #Submit all deletions without waiting for them to finish
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = dict((pool.submit(self.delete_rg, name, True), name) for name in rg_names)
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    results[name] = RGTeardownResult(name, 'failed', time.time() - start, str(e))
+
+        #Track all submitted deletions together
+        pending = [name for name in rg_names if name not in results]
+        submitted = time.time() - start
+        for name, waited in self.wait_rgs_deleted(pending, timeout, poll_interval).items():
+            if waited.status == 'done':
+                results[name] = RGTeardownResult(name, 'deleted', submitted + waited.elapsed, None)
+                self._forget(name)
+            elif waited.status == 'failed':
+                results[name] = RGTeardownResult(name, 'failed', submitted + waited.elapsed,
+                                                 "Deletion stopped, group state is %s" %waited.state)
+            else:
+                results[name] = RGTeardownResult(name, 'timeout', submitted + waited.elapsed,
+                                                 "Group still deleting after %s seconds" %timeout)
 
-        #If nic name not given get nsg name
-        if not nic_name:
-            nic_name = vm_name+"VMNic"
+        for name in rg_names:
+            if results[name].status != 'deleted':
+                log.error("Unable to delete rg %s: %s" %(name, results[name].error))
+        log.info("Deleted %d of %d resource groups in %.0f seconds"
+                 %(sum(result.status == 'deleted' for result in results.values()), len(rg_names),
+                   time.time() - start))
+        return results
 
-        try:
-            #Try to delete nic
-            check_output("az network nic delete -n %s -g %s" %(nic_name, rg_name), shell=True)
-        except Exception as e:
-            log.error("Unable to delete NIC %s: %s" %(nic_name,e))
-            raise
-  
     '''
     ************************************
-    Azure Public IP Functions
+    Azure Resource Graph Functions
     ************************************
     '''
-
-    def delete_disk(self, rg_name, vm_name, disk_name=None):
-        '''
-        Purpose:
-                Delete Azure Managed disk
-        Arguments:
-                * self - Azure object
-                * rg_name - Resource group disk is associated with
-                * vm_name - VM associated with Disk important to make sure deleted
-                * disk_name - Name of disk to delete -Optional as will use VM name to 
-                              find name of disk if not given
-                
-        '''
-
-        # Check vm Deleted 
-        assert vm_name not in self.list_vm(rg_name), "VM is still present delete before deleting disk"
-
-        #If disk name not given get disk name
-        if not disk_name:
-            disk_name = self.get_disk_name(rg_name, vm_name)
-
-        try:
-            #Try to delete disk
-            check_output("az disk delete -n %s -g %s --yes" %(disk_name, rg_name), shell=True)
-        except Exception as e:
-            log.error("Unable to delete disk %s: %s" %(disk_name,e))
-            raise
-
-    def list_disk(self, rg_name, json=False):
+    def build_graph_query(self, resource_types=None, rg_names=None, tags=None, locations=None):
         '''
         Purpose:
-                Lists Azure Managed disk associated with a resource_group
+                Builds Resource Graph (KQL) query selecting resources by type, resource group,
+                tag and location. All filters are optional and are combined together
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group disks are associated with
-                * json - If you want the data in json format, default False
-        Returns: 
-               Azure disks associated with a resource group in string or json
+                * resource_types - List of resource types ie ['Microsoft.Compute/disks'], default None
+                * rg_names - List of resource groups to search, default None (all resource groups)
+                * tags - dictionary containing tag id and tag value, default None
+                * locations - List of locations ie ['eastus', 'westus'], default None
+        Returns:
+                KQL query as string
         '''
-        try:
-            #Try to delete route table
-            if(json):
-                out = check_output("az disk list -g %s" %(rg_name), shell=True)
-            else:
-                out = check_output("az disk list -g %s -o table" %(rg_name), shell=True)
-        except Exception as e:
-            log.error("Unable to list disks %s" %(e))
-
-        #Check data isn't empty
-        assert not out.isspace(), "Unable to list disks associated with resource group %s" %rg_name
-        return out.decode('utf-8')
 
-    def get_disk_name(self, rg_name, vm_name):
+        query = "Resources"
+        if resource_types:
+            query += " | where type in~ %s" %_kql_list(resource_types)
+        if rg_names:
+            query += " | where resourceGroup in~ %s" %_kql_list(rg_names)
+        if locations:
+            query += " | where location in~ %s" %_kql_list(locations)
+        for tag in tags or {}:
+            query += " | where tags[%s] =~ %s" %(_kql_str(tag), _kql_str(tags[tag]))
+
+        query += " | project id, name, type, resourceGroup, location, subscriptionId, tags, properties"
+        return query
+
+    def query_resource_graph(self, resource_types=None, rg_names=None, tags=None, locations=None,
+                             subscriptions=None, query=None, page_size=1000):
         '''
         Purpose:
-                Lists Azure Managed disk associated with a resource_group and 
-                extracts the name of the disk based on the name of the VM the 
-                disk is associated with. Disk name will usually be vm_name_OsDisk_1_...
+                Queries Azure Resource Graph for resources across many resource groups and
+                subscriptions at once instead of listing each resource group separately. Results
+                are collected page by page (az graph query --first/--skip-token). Requires the
+                resource-graph extension on older Azure CLI versions
         Arguments:
                 * self - Azure object
-                * rg_name - Resource group disks are associated with
-                * vm_name - Name of the VM
-        Returns: 
-               Name of disk associated with VM name passed in, if potential diskname 
-               is not found will return None
+                * resource_types - List of resource types ie ['Microsoft.Network/publicIPAddresses'], default None
+                * rg_names - List of resource groups to search, default None (all resource groups)
+                * tags - dictionary containing tag id and tag value, default None
+                * locations - List of locations ie ['eastus'], default None
+                * subscriptions - List of subscription IDs to search, default None (all accessible)
+                * query - Custom KQL query to run instead of building one from the filters, default None
+                * page_size - Number of records requested per page, max 1000, default 1000
+        Returns:
+                List of GraphRecord (id, name, type, resource_group, location, subscription_id,
+                tags, properties)
         '''
-        disks = self.list_disk(rg_name)
-
-        #Confirm vm we want is in Disk list
-        assert vm_name in disks, "VM %s is not present in disks %s" %(vm_name, disks)
-
-        #Extract disk name 
-        m = re.search(r"(" + re.escape(vm_name)+ r"_\w*)", disks)
-        try:
-            disk_name = m.group(1).strip()
-        except:
-            #Do not raise exception just continue on
-            log.error("Unable to find VM disk name in disks")
-            disk_name = None
 
-        return disk_name
+        records = list(self.iter_resource_graph(resource_types, rg_names, tags, locations,
+                                                subscriptions, query, page_size))
+        log.info("Resource graph query returned %d records" %len(records))
+        return records
 
     ''' 
     ************************************
-    Azure Storage Functions
+    Azure VNET Functions
     ************************************
     '''
-
-    def create_storage(self, name, rg_name, location="eastus", sku="Standard_LRS"):
+    def create_vnet(self, name, rg_name, add_prefix=None, location=None, subnet_name=None, subnet_prefix=None):
         '''
         Purpose:
-                Creates new Storage Account
+                Creates new Vnet - Either leave defaults for add_prefix, subnet_name and subnet_prefix\
+                                   to use Azure's default prefix or define prefix and add subnet parameters\
+                                   to define a vnet with a subnet
         Arguments:
                 * self - Azure object
-                * name - Azure storage account name
-                * rg_name - Name of resource group to be under
-                * location - Location for resource group, default = "eastus"
-                * sku - Storage Account SKU - defaul to Standard_LRS. accepted values: Premium_LRS,
-                        Standard_GRS,Standard_LRS, Standard_RAGRS, Standard_ZRS
+                * name - Azure vnet name
+                * rg_name - Name of resource group to be created
+                * add_prefix - Address prfix of vnet, optional defaults to Azure default (default = None)
+                * location - Location for resource group, default None (location of context, else "eastus")
+                * subnet_name -Optional name of subnet to add, default = None
+                * subnet_prefix -Optional subnet prefix to add, default = None
         '''
+        location = self._location(location)
 
         try:
-            #Try to create storage account
-            check_output("az storage account create -g %s -n %s -l %s --sku %s"
-                         %(rg_name, name, location, sku), shell=True)
+            #Try to create vnet with or without subnet depending on parameters defined
+            if add_prefix and subnet_prefix and subnet_name:
+                self._run(["az", "network", "vnet", "create", "-g", rg_name, "-n", name, "--location",
+                           location, "--address-prefix", add_prefix, "--subnet-name", subnet_name,
+                           "--subnet-prefix", subnet_prefix])
+            elif add_prefix:
+                self._run(["az", "network", "vnet", "create", "-g", rg_name, "-n", name, "--location",
+                           location, "--address-prefixes", add_prefix])
+            else:
+                self._run(["az", "network", "vnet", "create", "-g", rg_name, "-n", name, "--location",
+                           location])
         except Exception as e:
-            log.error("Unable to create storage %s: %s" %(name, e))
+            log.error("Unable to create vnet %s: %s" %(rg_name, e))
             raise
 
-    def delete_storage(self, name, rg_name):
+    def delete_vnet(self, name, rg_name):
         '''
         Purpose:
-                Deletes exisiting Storage account
+                Deletes exisiting vnet
         Arguments:
                 * self - Azure object
-                * name - Name of Storage account you want to delete
+                * name - Name of VNET you want to delete
                 * rg_name - Name of resource group to be deleted
         '''
 
         try:
             #Try to logout
-            check_output("az storage account delete -n %s -g %s --yes" %(name, rg_name), shell=True)
+            self._run(["az", "network", "vnet", "delete", "-n", name, "-g", rg_name])
         except Exception as e:
-            log.error("Unable to delete storage %s: %s" %(name, e))
+            log.error("Unable to delete vnet %s: %s" %(name, e))
             raise
+        self._forget(rg_name, "Microsoft.Network/virtualNetworks/%s" %name)
 
-    def list_storage(self, rg_name, json=False):
+    def list_vnet(self, rg_name, json=False, fields=None, query=None):
         '''
         Purpose:
-                Gets list of Azure Storage Acounts based on passed in resource group
+                Gets list of Azure Vnets contained in resource group
         Arguments:
                 * self - Azure object
-                * rg_name - resource group you want to find storage accounts associated with
+                * rg _name - resource group you want to find VNETs associated with
                 * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
         Returns:
-                Azure storange accounts as string or json depending on input
+                Azure vnets as string or json depending on input
         '''
 
-        if (json):
-            out = check_output('az storage account list -g %s' %rg_name, shell=True)
-        else: 
-            out = check_output('az storage account list -g %s -o table' %rg_name, shell=True)
+        out = self._run(["az", "network", "vnet", "list", "--resource-group", rg_name] +
+                        self._output_args(json, fields, query))
 
         #Check data isn't empty
-        assert not out.isspace(), "Unable to list storage_accounts associated with resource group %s" %rg_name
+        assert not out.isspace(), "Unable to list VNET information"
         return out.decode('utf-8')
 
-    def show_storage(self, name, rg_name, json=False):
+    def show_vnet(self, name, rg_name, json=False, fields=None, query=None):
         '''
         Purpose:
-                Gets data about Azure Storage account associated to a rg
+                Gets data about specific Azure Vnet associated to a rg
         Arguments:
                 * self - Azure object
-                * name - Name of Storage account you want data about
-                * rg_name - Name of Resource Group associated with
+                * name - Name of Vnet you want data about
+                * rg_name - Name of Resource Group you want data about
                 * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
         Returns:
-                Azure storage account information as string or json depending on input
+                Azure vnet information as string or json depending on input
         '''
 
-        if (json):
-            out = check_output('az storage account show -g %s -n %s' %(rg_name,name), shell=True)
-        else: 
-            out = check_output('az storage account show -g %s -n %s -o table' %(rg_name,name), shell=True)
+        out = self._run(["az", "network", "vnet", "show", "-g", rg_name, "-n", name] +
+                        self._output_args(json, fields, query, many=False))
 
         #Check data isn't empty
-        assert not out.isspace(), "Unable to get information about Storage Account %s" %name
+        assert not out.isspace(), "Unable get information about VNET %s" %name
         return out.decode('utf-8')
 
-    def get_storage_keys(self, storage_name, rg_name):
+    def add_vnet_subnet(self, name, rg_name, vnet_name, address_prefix, route_table=None):
         '''
         Purpose:
-                Gets data about Azure Storage Keys
+                Creates new subnet and attaches it to a vnet
         Arguments:
                 * self - Azure object
-                * storage_name - Name of Storage account you want data about
-                * rg_name - Name of Resource Group associated with
-        Returns:
-                Dictionary of Azure storage keys in format {"keyname":"key",...}
+                * name - Azure subnet name
+                * rg_name - Name of resource group to be created unerder
+                * vnet_name - Name of subnet
+                * address_prefix - subnet Prefix to add
+                * route_table - Optional Route-table you want to associate it with, default None
         '''
-        out = check_output('az storage account keys list -n %s -g %s' %(storage_name, rg_name),
-                           shell=True)
-
-        #Check data isn't empty
-        assert not out.isspace(), "Unable to get Storage Account Key information"
-
-        #Decode and format output so it is represented by a list instead of byte string
-        out= out.decode('utf-8')
-        out = ast.literal_eval(out)
 
-        # Extract keyname and key value
-        keys = {}
-        for key in out:
-            keys[key['keyName']] = key['value']
-
-        return(keys)
+        try:
+            #Try to create subnet and attach to a vnet
+            if route_table:
+                self._run(["az", "network", "vnet", "subnet", "create", "-g", rg_name, "-n", name,
+                           "--vnet-name", vnet_name, "--address-prefix", address_prefix,
+                           "--route-table", route_table])
+            else:
+                self._run(["az", "network", "vnet", "subnet", "create", "-g", rg_name, "-n", name,
+                           "--vnet-name", vnet_name, "--address-prefix", address_prefix])
+        except Exception as e:
+            log.error("Unable to create vnet subnet %s: %s" %(name, e))
+            raise
 
-    def create_storage_container(self, name, rg_name, storage_name):
+    def delete_vnet_subnet(self, name, rg_name, vnet_name):
         '''
         Purpose:
-                Creates storage container in existing Azure storage. First 
-                gets keys from storage to use in authenticating container
-                will use first key found
+                Delete subnet attached to a vnet
         Arguments:
                 * self - Azure object
-                * name - Name of container to be created
-                * storage_name - Name of Storage account 
-                * rg_name - Name of Resource Group associated with storage
+                * name - Azure subnet name to delete
+                * rg_name - Name of resource group
+                * vnet_name - Name of vnet subnet belongs to
         '''
-        #Get key information from storage
-        keys = self.get_storage_keys(storage_name, rg_name)
-        #Get abritray key from list
-        key = list(keys.values())[0]
 
         try:
-            #Try to create storage account
-            check_output("az storage container create -n %s --account-name %s --account-key %s"
-                         %(name, storage_name, key), shell=True)
+            #Try to delete a subnet
+            self._run(["az", "network", "vnet", "subnet", "delete", "-g", rg_name, "-n", name,
+                       "--vnet-name", vnet_name])
         except Exception as e:
-            log.error("Unable to create storage container %s: %s" %(name, e))
+            log.error("Unable to delete subnet %s: %s" %(name, e))
+            raise
+        self._forget(rg_name, "Microsoft.Network/virtualNetworks/%s/subnets/%s" %(vnet_name, name))
 
-    def list_storage_container(self, rg_name, storage_name, json=False):
+    def list_vnet_subnets(self, name, rg_name, json=False, fields=None, query=None):
         '''
         Purpose:
-                Creates storage container in existing Azure storage. First 
-                gets keys from storage to use in authenticating container
-                will use first key found
+                Gets data about Azure subnet
         Arguments:
                 * self - Azure object
-                * storage_name - Name of Storage account 
-                * rg_name - Name of Resource Group associated with storage
+                * name - Name of Vnet you want subnet data about
+                * rg_name - Name of Resource Group subnet is associated with
                 * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
         Returns:
-                Azure storange accounts as string or json depending on input
+                List of Azure subnets associated with vnet in string or Json format
         '''
-        #Get key information from storage
-        keys = self.get_storage_keys(storage_name, rg_name)
-        #Get abritray key from list
-        key = list(keys.values())[0]
 
-        if (json):
-            out = check_output('az storage container list --account-name %s --account-key %s'
-                             %(storage_name, key), shell=True)
-        else: 
-            out = check_output('az storage container list --account-name %s --account-key %s -o table'
-                             %(storage_name, key), shell=True)
+        out = self._run(["az", "network", "vnet", "subnet", "list", "-g", rg_name, "--vnet-name", name] +
+                        self._output_args(json, fields, query))
 
         #Check data isn't empty
-        assert not out.isspace(), "Unable to list Storage Account information"
+        assert not out.isspace(), "Unable to list VNET Subnets information"
         return out.decode('utf-8')
-  
-    def delete_storage_container(self, name, rg_name, storage_name):
+
+    def show_vnet_subnet(self, name, rg_name, vnet_name, json=False, fields=None, query=None):
         '''
         Purpose:
-                Deletes storage container in existing Azure storage. First 
-                gets keys from storage to use in authenticating container
-                will use first key found
+                Gets data about a specific Azure subnet associated to a vnet
         Arguments:
                 * self - Azure object
-                * name - Name of container to be created
-                * storage_name - Name of Storage account 
-                * rg_name - Name of Resource Group associated with storage
-        '''
-        #Get key information from storage
-        keys = self.get_storage_keys(storage_name, rg_name)
+                * name - Name of subnet you want data about
+                * rg_name - Name of Resource Group vnet is associated with
+                * vnet_name - Name of VNet subnet is associated with
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        Returns:
+                Azure subnet information as string or json depending on input
+        '''
+
+        out = self._run(["az", "network", "vnet", "subnet", "show", "-g", rg_name, "-n", name,
+                         "--vnet-name", vnet_name] + self._output_args(json, fields, query, many=False))
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable to get information about Subnet VNET %s" %name
+        return out.decode('utf-8')
+
+    def plan_subnets(self, rg_name):
+        '''
+        Purpose:
+                Builds address planner for vnets in resource group - vnet and subnet prefixes are read
+                once, after that free prefixes are found locally (see AddressPlanner)
+        Arguments:
+                * self - Azure object
+                * rg_name - Name of resource group holding the vnets
+        Returns:
+                AddressPlanner with address space and used subnet prefixes of every vnet
+        '''
+
+        planner = AddressPlanner()
+        for vnet in jsonlib.loads(self.list_vnet(rg_name, json=True) or "[]"):
+            props = _props(vnet)
+            used = []
+            for subnet in props.get("subnets") or []:
+                subnet_props = _props(subnet)
+                used.extend(subnet_props.get("addressPrefixes") or [])
+                if subnet_props.get("addressPrefix"):
+                    used.append(subnet_props["addressPrefix"])
+            planner.add_vnet(vnet["name"], (props.get("addressSpace") or {}).get("addressPrefixes") or [], used)
+        return planner
+
+    def add_planned_subnet(self, name, rg_name, vnet_name, prefix_length, planner, route_table=None):
+        '''
+        Purpose:
+                Creates new subnet using next free prefix of requested size from address planner,
+                prefix is given back to planner if subnet can't be created
+        Arguments:
+                * self - Azure object
+                * name - Azure subnet name
+                * rg_name - Name of resource group
+                * vnet_name - Name of vnet to add subnet to
+                * prefix_length - Size of subnet prefix ie 24 for a /24
+                * planner - AddressPlanner from plan_subnets
+                * route_table - Optional Route-table you want to associate it with, default None
+        Returns:
+                Prefix of created subnet as string
+        '''
+
+        prefix = planner.allocate(vnet_name, prefix_length)
+        try:
+            self.add_vnet_subnet(name, rg_name, vnet_name, str(prefix), route_table)
+        except Exception:
+            planner.release(vnet_name, prefix)
+            raise
+        log.info("Subnet %s created with prefix %s" %(name, prefix))
+        return str(prefix)
+ 
+    ''' 
+    ************************************
+    Azure Deployment Functions
+    ************************************
+    '''
+    def create_parameter_file(self, parameter_template, testbed_file, output_file_path, yaml_object= "azure"):
+        '''
+        Purpose:
+                Method to create parameter file from information in testbed YAML file and parameter template
+                file. Combines values from testbed YAML and places them in appropriate placeholders
+                in parameter template file. This outputed parameter file can then be passed into the 
+                deployment methods to be used with deployment templates 
+        Arguments:
+                * self - Azure object
+                * parameter_template - Parameter template file to use
+                * testbed_file - Testbed YAML file holding data for parameter template
+                * output_file_path - Path of output file
+                * yaml_object - Object in the YAML file the dictionary containing variable to be placed 
+                                in the parameter_template live under ie testbed[azure] or testbed[asa]
+                                default=Azure if the variables aren't under any object and be called by 
+                                testbed[parameter]
+        '''
+        
+        new_parameters = ""
+        #Open files
+        with open(testbed_file, 'r') as testbed_yaml:
+            testbed = yaml.safe_load(testbed_yaml)
+        parameters = open(parameter_template, 'r')
+        new_param_file = open(output_file_path, 'w+')
+
+        #Get specific object in testbed YAML file - Will usually be 'azure'
+        if yaml_object:
+            testbed = testbed[yaml_object]
+
+        #Check each line in parameter template for place holder
+        #if placeholder found update with relevant data from testbed file
+        lines = parameters.readlines()
+        for line in lines:
+            if '[' and ']' in line:
+                m = re.search(r'\[(\w*)\]', line)
+                new_line = line.replace(m.group(0), '"'+ testbed[m.group(1)]+ '"')
+                line = new_line
+            #Write new parameter file
+            new_parameters += (line)
+            new_param_file.write(line)
+
+        #Close all files
+        new_param_file.close()
+        parameters.close()
+
+    def _ledger_outputs(self, ledger, key, force):
+        '''
+        Purpose:
+                Looks up deployment in ledger and checks it still exists in Azure as the same
+                run - a later deployment of the same template file has the same name but a
+                different correlation ID
+        Arguments:
+                * self - Azure object
+                * ledger - DeploymentLedger
+                * key - Hash of deployment, see DeploymentLedger.key
+                * force - Ignore ledger entry and deploy again
+        Returns:
+                Recorded outputs if deployment can be skipped, otherwise None
+        '''
+        entry = ledger.get(key)
+        if not entry or force:
+            return None
+
+        try:
+            current = jsonlib.loads(self._run(["az", "group", "deployment", "show", "-g", entry['rg_name'],
+                                               "-n", entry['deployment'], "--query",
+                                               "{state: properties.provisioningState, "
+                                               "correlationId: properties.correlationId}",
+                                               "-o", "json"]).decode('utf-8') or "{}")
+        except Exception as e:
+            current = {}
+            log.info("Recorded deployment %s not found: %s" %(entry['deployment'], e))
+
+        if current.get('state') != 'Succeeded' or not entry.get('correlation_id') or \
+           current.get('correlationId') != entry['correlation_id']:
+            if current.get('state') == 'Succeeded':
+                log.info("Deployment %s in %s was replaced by another run" %(entry['deployment'], entry['rg_name']))
+            ledger.forget(key)
+            return None
+
+        log.info("Deployment %s in %s unchanged, skipping" %(entry['deployment'], entry['rg_name']))
+        return entry['outputs'] or {}
+
+    def _deploy_template(self, rg_name, template_file, parameter_file, ledger=None, key=None):
+        '''
+        Purpose:
+                Runs template deployment and records it in ledger
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource Group name
+                * template_file - path to azure template file to use for deployment
+                * parameter_file - path to file containing parameters needed for deployment
+                * ledger - DeploymentLedger to record deployment in, default None
+                * key - Hash of deployment, see DeploymentLedger.key, default None
+        Returns:
+                Deployment outputs as dictionary
+        '''
+        out = self._run(["az", "group", "deployment", "create", "-g", rg_name, "--template-file",
+                         template_file, "--parameters", parameter_file])
+        deployment = jsonlib.loads(out.decode('utf-8') or "{}")
+        outputs = _props(deployment).get('outputs') or {}
+        if ledger:
+            ledger.record(key, rg_name, deployment.get('name'), outputs, _props(deployment).get('correlationId'))
+        return outputs
+
+    def deploy_from_template_custom_image(self, resource_group, storage_name, image_path, template_file,
+                                            parameter_file, location=None, storage_container_name="images",
+                                            ledger=None, force=False):
+        '''
+        Purpose:
+                Creates new deployment using custom image - Have to create a resource group and storage container to 
+                store custom image then copy over the custom image to the new storage container. Will then attempt to 
+                deploy template passed in. Note if this fails please remember to delete resource group in any cleanup done
+        Arguments:
+                * self - Azure object
+                * resource_group - Name of resource group to created
+                * storage_name - Name of storage container to be created
+                * image_path - Path to custom image to be copied to storage container and then deployed
+                * template_file - path to file to use for deployment
+                * parameter_file - Parameter file to be combined with Template file for deployment
+                * location - Location of deployment default None (location of context, else "eastus")
+                * storage_container_name - Name of storage container - defaults to 'images', which is what is defined 
+                                           in template file - do not change to different value unless you know 
+                                           what you are doing and have matching value in template file
+                * ledger - DeploymentLedger to skip unchanged deployments with, default None
+                * force - Deploy even if ledger shows deployment is unchanged, default False
+        Returns:
+                Deployment outputs as dictionary
+        '''
+        location = self._location(location)
+        key = None
+        if ledger:
+            #Image is identified by path, size and modification time instead of hashing whole VHD
+            image = os.stat(image_path)
+            key = ledger.key(template_file, parameter_file, resource_group, storage_name, storage_container_name,
+                             os.path.abspath(image_path), image.st_size, image.st_mtime)
+            outputs = self._ledger_outputs(ledger, key, force)
+            if outputs is not None:
+                return outputs
+
+        try:
+            # Create Resource Group
+            self.create_rg(resource_group, location)
+            log.info("Resource Group %s Created" %resource_group)
+
+            # Create Storage and Storage Container
+            self.create_storage(storage_name, resource_group, location)
+            log.info("Storage %s Created" %storage_name)
+
+            self.create_storage_container(storage_container_name, resource_group, storage_name)
+            log.info("Storage Container %s Created" %storage_container_name)
+
+            # Copy custom image onto storage container 
+            self.upload_vhd_to_container(storage_container_name, storage_name, resource_group, image_path)
+            log.info("Image %s uploaded to Storage container %s" %(image_path, storage_container_name))
+
+        except Exception as e:
+            log.error("Unable to set up the resource group and storage to deploy template to: %s" %e)
+            raise
+
+        # Deploy template
+        try:
+            #Try create deployment
+            log.info("Image on Azure, now deploying Template, can take a few minutes")
+            outputs = self._deploy_template(resource_group, template_file, parameter_file, ledger, key)
+            log.info("Template deployed")
+        except Exception as e:
+            log.error("Unable to deploy template %s" %e)
+            raise
+
+        return outputs
+
+    def deploy_from_template_mp_image(self, rg_name, location, template_file, parameter_file, ledger=None, force=False):
+        '''
+        Purpose:
+                Creates new deployment using Marketplace Image, will check if resource group is created
+                if not will create one. If this fails please remember to delete resource group created
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource Group name
+                * template_file - path to azure template file to use for deployment
+                * parameter_file - path to file containing parameters needed for deployment
+                * ledger - DeploymentLedger to skip unchanged deployments with, default None
+                * force - Deploy even if ledger shows deployment is unchanged, default False
+        Returns:
+                Deployment outputs as dictionary
+        '''
+        key = None
+        if ledger:
+            key = ledger.key(template_file, parameter_file, rg_name)
+            outputs = self._ledger_outputs(ledger, key, force)
+            if outputs is not None:
+                return outputs
+
+        #Check if resource group exists - If not create it
+        try:
+            # See if able to get resource group information
+            self.show_rg(rg_name)
+            log.info("Resource group %s already exists" %rg_name)
+        except:
+            # If unable to get rg information make new one then continue
+            log.info("Creating Resoucre group %s" %rg_name)
+            self.create_rg(rg_name, location)
+
+        # Deploy template
+        try:
+            #Try create deployment
+            return self._deploy_template(rg_name, template_file, parameter_file, ledger, key)
+        except Exception as e:
+            log.error("Unable to deploy template: %s" %(e))
+            raise
+
+    def deploy_topology(self, rg_name, topology, testbed_file=None, work_dir=None, yaml_object="azure",
+                        location=None, values=None, ledger=None, force=False):
+        '''
+        Purpose:
+                Deploys whole topology (vnets, subnets, route tables and VMs) as one template
+                deployment, so ARM creates independent resources in parallel instead of running
+                one az create per resource. Template and parameter file are generated from
+                topology, parameter placeholders are filled from testbed file the same way as
+                create_parameter_file. Creates resource group if it doesn't exist
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource Group name
+                * topology - TopologyTemplate or dictionary of specs, see TopologyTemplate
+                * testbed_file - Testbed YAML file holding parameter values ie adminUsername, default None
+                * work_dir - Directory template file is written to, default current directory. Parameter
+                             file holds credentials so is written to a private temporary directory
+                             removed once deployment finished
+                * yaml_object - Object in testbed YAML parameters live under, default 'azure'
+                * location - Location of resource group if it is created, default None (location of context, else "eastus")
+                * values - Dictionary of parameter values used instead of testbed file, default None
+                * ledger - DeploymentLedger to skip unchanged deployments with, default None
+                * force - Deploy even if ledger shows deployment is unchanged, default False
+        Returns:
+                Deployment outputs as dictionary, <vm>PrivateIp and <vm>PublicIp of each VM
+        '''
+        location = self._location(location)
+        if not isinstance(topology, TopologyTemplate):
+            topology = TopologyTemplate(topology)
+        work_dir = work_dir or os.getcwd()
+        template_file = os.path.join(work_dir, "%s_topology.json" %rg_name)
+        secret_dir = tempfile.mkdtemp(prefix="azure_lib-")
+        parameter_file = os.path.join(secret_dir, "%s_topology.parameters.json" %rg_name)
+
+        try:
+            if testbed_file and not values:
+                topology.write(template_file, parameter_file + ".template")
+                self.create_parameter_file(parameter_file + ".template", testbed_file, parameter_file, yaml_object)
+            else:
+                topology.write(template_file, parameter_file, values)
+
+            log.info("Deploying %d VMs, %d vnets and %d route tables to %s in one deployment"
+                     %(len(topology.vms), len(topology.vnets), len(topology.route_tables), rg_name))
+            return self.deploy_from_template_mp_image(rg_name, location, template_file, parameter_file, ledger, force)
+        finally:
+            shutil.rmtree(secret_dir, ignore_errors=True)
+
+    '''
+    ************************************
+    Azure VM Functions
+    ************************************
+    '''
+
+    def deploy_linux(self, name, rg_name, vnet_name, subnet_name, username="automation-admin", pw="Cisco-123123"):
+        '''
+        Purpose:
+                Creates basic linux VM
+        Arguments:
+                * self - Azure object
+                * name - Name of Linux VM
+                * rg_name - Name of resource group associated with Linux VM
+                * vnet_name - Name of Vnet 
+                * subnet_name - Name of subnet in Vnet
+                * username - Username of VM defaul = automation-admin
+                * pw - Password of VM deault = Cisco-123123 
+        Returns:
+                Output from successful deployment - Includes public and private IP addreses in dictionary
+        '''
+        #Deploy Linux 
+        try:
+            #Try create deployment
+            out = self._run(["az", "vm", "create", "-n", name, "-g", rg_name, "--admin-username",
+                             username, "--admin-password", pw, "--image", "UbuntuLTS", "--vnet-name",
+                             vnet_name, "--subnet", subnet_name])
+            out = out.decode('utf-8')
+        except Exception as e:
+            log.error("Unable to deploy Linux: %s" %( e))
+            raise
+
+        #Confirm VM running is seen in output
+        assert  "VM running" in out, "Linux Deployment not sucessful: %s" %out
+        return out
+
+    def delete_vm(self, name, rg_name):
+        '''
+        Purpose:
+                Deletes existing VM only, leaving its disk, NIC, NSG and public IP
+        Arguments:
+                * self - Azure object
+                * name - Name of VM
+                * rg_name - Name of resource group associated with VM
+        '''
+        try:
+            self._run(["az", "vm", "delete", "-n", name, "-g", rg_name, "--yes"])
+        except Exception as e:
+            log.error("Unable to delete VM %s: %s" %(name, e))
+            raise
+        self._forget(rg_name, "Microsoft.Compute/virtualMachines/%s" %name)
+
+    def delete_linux(self, name, rg_name):
+        '''
+        Purpose:
+                Deletes existing linux VM
+        Arguments:
+                * self - Azure object
+                * name - Name of Linux VM
+                * rg_name - Name of resource group associated with Linux VM
+        '''
+        #Delete Linux VM and all things associated with it 
+        log.info("Deleting Linux VM %s" %name)
+        try:
+            self.delete_vm(name, rg_name)
+        except Exception as e:
+            log.error("Unable to delete Linux: %s" %( e))
+            raise
+
+        log.info("Try to delete remaining resources associated with linux %s" %name)
+        try:
+            #delete associated disk
+            self.delete_disk(rg_name, name)
+            log.info("Deleted disk")
+
+            #delete associated NIC
+            self.delete_nic(rg_name, name)
+            log.info("Deleted network interface")
+
+            #delete associated NSG
+            self.delete_nsg(rg_name, name)
+            log.info("Deleted network security group")
+
+            #delete associated Public IP
+            self.delete_public_ip(rg_name, name)
+            log.info("Deleted public IP")
+
+            #Check all resources with name are deleted
+            output= self.list_resources(rg_name)
+            assert name not in output, "Some resources with name %s remaining: %s" %(name,output)
+            log.info("All additional resources sucessfully deleted")
+
+        except Exception as e:
+            log.error("Unable to delete all resources associated with Linux %s : %s" %(name, e))
+            raise
+
+    def list_vm(self, rg_name, json=False, fields=None, query=None):
+        '''
+        Purpose:
+                Lists Azure VM associated with a resource_group
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group VMs are associated with
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        '''
+        try:
+            #Try to delete route table
+            out = self._run(["az", "vm", "list", "-g", rg_name] + self._output_args(json, fields, query))
+        except Exception as e:
+            log.error("Unable to list vms %s" %(e))
+            raise
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable to list VMs"
+        return out.decode('utf-8')
+
+    def list_resources(self, rg_name, json=False, fields=None, query=None):
+        '''
+        Purpose:
+                Lists Azure resources associated with resource_group
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group resources are associated with
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        '''
+        try:
+            #Try to delete route table
+            out = self._run(["az", "resource", "list", "-g", rg_name] +
+                            self._output_args(json, fields, query))
+        except Exception as e:
+            log.error("Unable to list resources %s" %(e))
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable to list Resources associated with resource group %s" %rg_name
+        return out.decode('utf-8')
+
+    '''
+    ************************************
+    Azure Route-Table and Route Functions
+    ************************************
+    '''
+
+    def show_all_route_tables(self, rg_name, json=False, fields=None, query=None):
+        '''
+        Purpose:
+                Gets data about Azure route tables associated with resource group
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group you want route-tables in
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        Returns:
+                Azure route-table information as string or json depending on input
+        '''
+
+        out = self._run(["az", "network", "route-table", "list", "-g", rg_name] +
+                        self._output_args(json, fields, query))
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable to list route tables associated with resource group %s" %rg_name
+        return out.decode('utf-8')
+
+    def show_route_table(self, rg_name, route_table, json=False, fields=None, query=None):
+        '''
+        Purpose:
+                Gets data about specific Azure route table, To see route information have json=True
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group route-table is associated with
+                * route_table - Route-table to collect info on
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        Returns:
+                Azure route-table information as string or json depending on input
+        '''
+
+        out = self._run(["az", "network", "route-table", "show", "-g", rg_name, "-n", route_table] +
+                        self._output_args(json, fields, query, many=False))
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable get information about route-table %s" %route_table
+        return out.decode('utf-8')
+
+    def show_routes(self, rg_name, route_table, json=False, fields=None, query=None):
+        '''
+        Purpose:
+                Gets data about Azure routes in route table
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group route-table is associated with
+                * route_table - Route-table to collect route info on
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        Returns:
+                Azure route information as string or json depending on input
+        '''
+
+        out = self._run(["az", "network", "route-table", "route", "list", "-g", rg_name,
+                         "--route-table-name", route_table] + self._output_args(json, fields, query))
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable get information about routes in route-table %s" %route_table
+        return out.decode('utf-8')
+
+    def add_route_table(self, rg_name, route_table):
+        '''
+        Purpose:
+                Adds Azure Route-Table
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group route-table is associated with
+                * route_table - Route-table to be added
+        '''
+
+        try:
+            #Try to add route table
+            self._run(["az", "network", "route-table", "create", "-g", rg_name, "-n", route_table])
+        except Exception as e:
+            log.error("Unable to add route-table %s: %s" %(route_table,e))
+            raise
+
+    def delete_route_table(self, rg_name, route_table):
+        '''
+        Purpose:
+                Delete Azure Route-Table
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group route-table is associated with
+                * route_table - Route-table to be added
+        '''
+
+        try:
+            #Try to delete route table
+            self._run(["az", "network", "route-table", "delete", "-g", rg_name, "-n", route_table])
+        except Exception as e:
+            log.error("Unable to delete route-table %s: %s" %(route_table,e))
+            raise
+        self._forget(rg_name, "Microsoft.Network/routeTables/%s" %route_table)
+
+    def add_route(self, rg_name, route_table, route, prefix, next_hop_add, next_hop_type="VirtualAppliance"):
+        '''
+        Purpose:
+                Adds Azure Route
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group route-table is associated with
+                * route_table - Route-table route to be added
+                * route - Route to be added
+                * prefix - Address prefix to which route applies
+                * next_hop_type - The type of Azure hop the packet should be sent to.  Allowed\
+                                 values: Internet, None, VirtualAppliance, VirtualNetworkGateway,\
+                                 VnetLocal. Default to VirtualAppliance
+                * next_hop_add - The IP address packets should be forwarded to when using the\
+                                    VirtualAppliance hop type.
+        '''
+
+        try:
+            #Try to create route
+            cmd = ["az", "network", "route-table", "route", "create", "-g", rg_name, "-n", route,
+                   "--address-prefix", prefix, "--next-hop-type", next_hop_type,
+                   "--route-table-name", route_table]
+            #Next hop address only used by VirtualAppliance hop type
+            if next_hop_add:
+                cmd += ["--next-hop-ip-address", next_hop_add]
+            self._run(cmd)
+        except Exception as e:
+            log.error("Unable to add route %s: %s" %(route,e))
+            raise
+
+    def delete_route(self, rg_name, route_table, route):
+        '''
+        Purpose:
+                Delete Azure Route
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group route-table is associated with
+                * route_table - Route-table route to be deleted on
+                * route - Route to be deleted
+        '''
+
+        try:
+            #Try to delete route
+            self._run(["az", "network", "route-table", "route", "delete", "-g", rg_name, "-n", route,
+                       "--route-table-name", route_table])
+        except Exception as e:
+            log.error("Unable to delete route %s: %s" %(route,e))
+            raise
+        self._forget(rg_name, "Microsoft.Network/routeTables/%s/routes/%s" %(route_table, route))
+
+    def replace_routes(self, rg_name, route_table, routes):
+        '''
+        Purpose:
+                Replaces all routes of route table with a single update of the route table
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group route-table is associated with
+                * route_table - Route-table to update
+                * routes - List of Route (name, prefix, next_hop_type, next_hop_add)
+        '''
+        route_list = []
+        for route in routes:
+            properties = {'addressPrefix': route.prefix, 'nextHopType': route.next_hop_type}
+            if route.next_hop_add:
+                properties['nextHopIpAddress'] = route.next_hop_add
+            route_list.append(dict(properties, name=route.name))
+
+        try:
+            #Generic update replaces whole routes collection in one write
+            self._run(["az", "network", "route-table", "update", "-g", rg_name, "-n", route_table,
+                       "--set", "routes=%s" %jsonlib.dumps(route_list)])
+        except Exception as e:
+            log.error("Unable to replace routes of route-table %s: %s" %(route_table, e))
+            raise
+
+    def diff_routes(self, rg_name, route_table, routes):
+        '''
+        Purpose:
+                Compares desired routes with routes currently in route table, read once as json
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group route-table is associated with
+                * route_table - Route-table to compare
+                * routes - List of desired routes as Route, tuples (name, prefix, next_hop_type,
+                           next_hop_add) or dictionaries with those keys. next_hop_type defaults
+                           to VirtualAppliance (also when None) and next_hop_add to None
+        Returns:
+                RouteDiff (adds, updates, deletes, unchanged) - lists of Route, deletes are
+                current routes not in desired routes
+        '''
+        desired = []
+        for route in routes:
+            if isinstance(route, dict):
+                route = Route(**route)
+            elif not isinstance(route, Route):
+                route = Route(*route)
+            if not route.next_hop_type:
+                route = route._replace(next_hop_type="VirtualAppliance")
+            desired.append(route)
+
+        current = {}
+        for route in jsonlib.loads(self.show_routes(rg_name, route_table, json=True)):
+            properties = _props(route)
+            current[route['name'].lower()] = Route(route['name'], properties.get('addressPrefix'),
+                                                   properties.get('nextHopType'),
+                                                   properties.get('nextHopIpAddress'))
+
+        diff = RouteDiff([], [], [], [])
+        for route in desired:
+            actual = current.pop(route.name.lower(), None)
+            if not actual:
+                diff.adds.append(route)
+            elif (actual.prefix == route.prefix and (actual.next_hop_type or "").lower() == route.next_hop_type.lower()
+                  and (actual.next_hop_add or None) == (route.next_hop_add or None)):
+                diff.unchanged.append(route)
+            else:
+                diff.updates.append(route)
+        diff.deletes.extend(current.values())
+
+        return diff
+
+    def reconcile_routes(self, rg_name, route_table, routes, bulk=False, dry_run=False, max_workers=10):
+        '''
+        Purpose:
+                Makes routes of route table match desired routes, only adding, updating and
+                deleting the routes which differ. Deletes are applied concurrently first, so a
+                renamed route doesn't clash with its old prefix, then adds and updates. With
+                bulk=True everything is one update of the whole route table
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group route-table is associated with
+                * route_table - Route-table to reconcile
+                * routes - List of desired routes, see diff_routes
+                * bulk - Replace all routes with one route table update, default False
+                * dry_run - Only work out the changes without applying them, default False
+                * max_workers - Number of route changes applied at the same time, default 10
+        Returns:
+                RouteDiff (adds, updates, deletes, unchanged)
+        '''
+        diff = self.diff_routes(rg_name, route_table, routes)
+        log.info("Route-table %s: %d to add, %d to update, %d to delete, %d unchanged"
+                 %(route_table, len(diff.adds), len(diff.updates), len(diff.deletes), len(diff.unchanged)))
+
+        if dry_run or not (diff.adds or diff.updates or diff.deletes):
+            return diff
+
+        if bulk:
+            self.replace_routes(rg_name, route_table, diff.adds + diff.updates + diff.unchanged)
+            return diff
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(self.delete_route, rg_name, route_table, route.name)
+                       for route in diff.deletes]
+            for future in as_completed(futures):
+                if future.exception():
+                    errors.append(future.exception())
+
+            #Create overwrites existing route so is used for updates as well
+            if not errors:
+                futures = [pool.submit(self.add_route, rg_name, route_table, route.name, route.prefix,
+                                       route.next_hop_add, route.next_hop_type)
+                           for route in diff.adds + diff.updates]
+                for future in as_completed(futures):
+                    if future.exception():
+                        errors.append(future.exception())
+
+        if errors:
+            log.error("Unable to apply %d route changes to route-table %s" %(len(errors), route_table))
+            raise errors[0]
+        return diff
+
+    '''
+    ************************************
+    Azure Network Functions
+    ************************************
+    '''
+
+    def delete_public_ip(self, rg_name, vm_name, pip_name=None):
+        '''
+        Purpose:
+                Deletes Azure public IP
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group PIP is associated with
+                * vm_name - VM associated with PIP important to make sure deleted
+                * pip_name - Name of Public IP to delete -Optional as will use VM name+PublicIP
+                            as default - this is the format for azure generated public IPs 
+        '''
+        # Check vm Deleted 
+        assert vm_name not in self.list_vm(rg_name), "VM is still present delete before deleting Public IP"
+
+        #If disk name not given get disk name
+        if not pip_name:
+            pip_name = vm_name+"PublicIP"
+
+        try:
+            #Try to delete public IP
+            self._run(["az", "network", "public-ip", "delete", "-n", pip_name, "-g", rg_name])
+        except Exception as e:
+            log.error("Unable to delete Public IP %s: %s" %(pip_name,e))
+            raise
+        self._forget(rg_name, "Microsoft.Network/publicIPAddresses/%s" %pip_name)
+
+    def list_pip(self, rg_name, json=False, fields=None, query=None):
+        '''
+        Purpose:
+                Lists Azure Public IPs associated with a resource_group
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group public-ip are associated with
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        Returns: 
+               Azure public Ips associated with a resource group in string or json
+        '''
+        try:
+            #List public IP
+            out = self._run(["az", "network", "public-ip", "list", "-g", rg_name] +
+                            self._output_args(json, fields, query))
+        except Exception as e:
+            log.error("Unable to list public-ip %s" %(e))
+            raise
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable to list public IPs"
+        return out.decode('utf-8')
+
+    def get_public_ip_from_vm(self, pip_name, rg_name):
+        '''
+        Purpose:
+                Extract public IP from existing VM 
+        Arguments:
+                * self - Azure object
+                * pip_name - Name of Public IP
+                * rg_name - Name of resource group associated with VM
+        Returns:
+                Public IP in string format
+        '''
+
+        #Only address of the public IP is returned
+        out = self.list_pip(rg_name, query="[?name==%s].ipAddress" %_jmes_str(pip_name)).strip()
+        assert out, "Unable to find public ip %s in resource group %s" %(pip_name, rg_name)
+        return out.split()[0]
+
+    def list_nsg(self, rg_name, json=False, fields=None, query=None):
+        '''
+        Purpose:
+                Lists Azure Network Security Groups associated with a resource_group
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group nsg are associated with
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        Returns: 
+               Azure Network Security Groups associated with a resource group in string or json
+        '''
+        try:
+            #Try to list nsg
+            out = self._run(["az", "network", "nsg", "list", "-g", rg_name] +
+                            self._output_args(json, fields, query))
+        except Exception as e:
+            log.error("Unable to list nsg %s" %(e))
+            raise
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable to list network securit groups associated with resource group %s" %rg_name
+        return out.decode('utf-8')
+
+    def delete_nsg(self, rg_name, vm_name, nsg_name=None):
+        '''
+        Purpose:
+                Delete Azure Network Security Group
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group NSG is associated with
+                * vm_name - VM associated with NSG important to make sure deleted
+                * nsg_name - Name of network security group to delete -Optional as will use VM name+NSG
+                            as default - this is the format for azure generated NSGs
+        '''
+        # Check vm Deleted 
+        assert vm_name not in self.list_vm(rg_name), "VM is still present delete before deleting NSG"
+
+        #If nsg name not given get nsg name
+        if not nsg_name:
+            nsg_name = vm_name+"NSG"
+
+        try:
+            #Try to delete nsg
+            self._run(["az", "network", "nsg", "delete", "-n", nsg_name, "-g", rg_name])
+        except Exception as e:
+            log.error("Unable to delete NSG %s: %s" %(nsg_name,e))
+            raise
+        self._forget(rg_name, "Microsoft.Network/networkSecurityGroups/%s" %nsg_name)
+  
+    def list_nic(self, rg_name, json=False, fields=None, query=None):
+        '''
+        Purpose:
+                Lists Azure Network Interface associated with a resource_group
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group nics are associated with
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        Returns: 
+               Azure Network Interfaces associated with a resource group in string or json
+        '''
+        try:
+            #List azure nics
+            out = self._run(["az", "network", "nic", "list", "-g", rg_name] +
+                            self._output_args(json, fields, query))
+        except Exception as e:
+            log.error("Unable to list nic %s" %(e))
+            raise
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable to list network interfaces associated with resource group %s" %rg_name
+        return out.decode('utf-8')
+
+    def delete_nic(self, rg_name, vm_name, nic_name=None):
+        '''
+        Purpose:
+                Delete Azure Network Interface
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group NIC is associated with
+                * vm_name - VM associated with NIC important to make sure deleted
+                * nsg_name - Name of network interface to delete -Optional as will use VM name+VMNic
+                            as default - this is the format for azure generated NSGs
+        '''
+        # Check vm Deleted 
+        assert vm_name not in self.list_vm(rg_name), "VM is still present delete before deleting NIC"
+
+        #If nic name not given get nsg name
+        if not nic_name:
+            nic_name = vm_name+"VMNic"
+
+        try:
+            #Try to delete nic
+            self._run(["az", "network", "nic", "delete", "-n", nic_name, "-g", rg_name])
+        except Exception as e:
+            log.error("Unable to delete NIC %s: %s" %(nic_name,e))
+            raise
+        self._forget(rg_name, "Microsoft.Network/networkInterfaces/%s" %nic_name)
+  
+    '''
+    ************************************
+    Azure Public IP Functions
+    ************************************
+    '''
+
+    def delete_disk(self, rg_name, vm_name, disk_name=None):
+        '''
+        Purpose:
+                Delete Azure Managed disk
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group disk is associated with
+                * vm_name - VM associated with Disk important to make sure deleted
+                * disk_name - Name of disk to delete -Optional as will use VM name to 
+                              find name of disk if not given
+                
+        '''
+
+        # Check vm Deleted 
+        assert vm_name not in self.list_vm(rg_name), "VM is still present delete before deleting disk"
+
+        #If disk name not given get disk name
+        if not disk_name:
+            disk_name = self.get_disk_name(rg_name, vm_name)
+
+        try:
+            #Try to delete disk
+            self._run(["az", "disk", "delete", "-n", disk_name, "-g", rg_name, "--yes"])
+        except Exception as e:
+            log.error("Unable to delete disk %s: %s" %(disk_name,e))
+            raise
+        self._forget(rg_name, "Microsoft.Compute/disks/%s" %disk_name)
+
+    def list_disk(self, rg_name, json=False, fields=None, query=None):
+        '''
+        Purpose:
+                Lists Azure Managed disk associated with a resource_group
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group disks are associated with
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        Returns: 
+               Azure disks associated with a resource group in string or json
+        '''
+        try:
+            #Try to delete route table
+            out = self._run(["az", "disk", "list", "-g", rg_name] + self._output_args(json, fields, query))
+        except Exception as e:
+            log.error("Unable to list disks %s" %(e))
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable to list disks associated with resource group %s" %rg_name
+        return out.decode('utf-8')
+
+    def get_disk_name(self, rg_name, vm_name):
+        '''
+        Purpose:
+                Lists Azure Managed disk associated with a resource_group and 
+                extracts the name of the disk based on the name of the VM the 
+                disk is associated with. Disk name will usually be vm_name_OsDisk_1_...
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group disks are associated with
+                * vm_name - Name of the VM
+        Returns: 
+               Name of disk associated with VM name passed in
+        '''
+        #Only names of the VM's disks are returned
+        disks = self.list_disk(rg_name, query="[?starts_with(name, %s)].name" %_jmes_str(vm_name + "_")).split()
+
+        #Confirm vm we want is in Disk list
+        assert disks, "VM %s is not present in disks of %s" %(vm_name, rg_name)
+        return disks[0]
+
+    ''' 
+    ************************************
+    Azure Storage Functions
+    ************************************
+    '''
+
+    def create_storage(self, name, rg_name, location=None, sku="Standard_LRS"):
+        '''
+        Purpose:
+                Creates new Storage Account
+        Arguments:
+                * self - Azure object
+                * name - Azure storage account name
+                * rg_name - Name of resource group to be under
+                * location - Location for resource group, default None (location of context, else "eastus")
+                * sku - Storage Account SKU - defaul to Standard_LRS. accepted values: Premium_LRS,
+                        Standard_GRS,Standard_LRS, Standard_RAGRS, Standard_ZRS
+        '''
+        location = self._location(location)
+
+        try:
+            #Try to create storage account
+            self._run(["az", "storage", "account", "create", "-g", rg_name, "-n", name, "-l", location,
+                       "--sku", sku])
+        except Exception as e:
+            log.error("Unable to create storage %s: %s" %(name, e))
+            raise
+
+    def delete_storage(self, name, rg_name):
+        '''
+        Purpose:
+                Deletes exisiting Storage account
+        Arguments:
+                * self - Azure object
+                * name - Name of Storage account you want to delete
+                * rg_name - Name of resource group to be deleted
+        '''
+
+        try:
+            #Try to logout
+            self._run(["az", "storage", "account", "delete", "-n", name, "-g", rg_name, "--yes"])
+        except Exception as e:
+            log.error("Unable to delete storage %s: %s" %(name, e))
+            raise
+        self._forget(rg_name, "Microsoft.Storage/storageAccounts/%s" %name)
+
+    def list_storage(self, rg_name, json=False, fields=None, query=None):
+        '''
+        Purpose:
+                Gets list of Azure Storage Acounts based on passed in resource group
+        Arguments:
+                * self - Azure object
+                * rg_name - resource group you want to find storage accounts associated with
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        Returns:
+                Azure storange accounts as string or json depending on input
+        '''
+
+        out = self._run(["az", "storage", "account", "list", "-g", rg_name] +
+                        self._output_args(json, fields, query))
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable to list storage_accounts associated with resource group %s" %rg_name
+        return out.decode('utf-8')
+
+    def show_storage(self, name, rg_name, json=False, fields=None, query=None):
+        '''
+        Purpose:
+                Gets data about Azure Storage account associated to a rg
+        Arguments:
+                * self - Azure object
+                * name - Name of Storage account you want data about
+                * rg_name - Name of Resource Group associated with
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        Returns:
+                Azure storage account information as string or json depending on input
+        '''
+
+        out = self._run(["az", "storage", "account", "show", "-g", rg_name, "-n", name] +
+                        self._output_args(json, fields, query, many=False))
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable to get information about Storage Account %s" %name
+        return out.decode('utf-8')
+
+    def get_storage_keys(self, storage_name, rg_name):
+        '''
+        Purpose:
+                Gets data about Azure Storage Keys
+        Arguments:
+                * self - Azure object
+                * storage_name - Name of Storage account you want data about
+                * rg_name - Name of Resource Group associated with
+        Returns:
+                Dictionary of Azure storage keys in format {"keyname":"key",...}
+        '''
+        out = self._run(["az", "storage", "account", "keys", "list", "-n", storage_name, "-g", rg_name])
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable to get Storage Account Key information"
+
+        #Decode and format output so it is represented by a list instead of byte string
+        out= out.decode('utf-8')
+        out = ast.literal_eval(out)
+
+        #Keep storage keys out of recorded cassettes
+        if self.cassette:
+            self.cassette.add_secrets(key['value'] for key in out)
+
+        # Extract keyname and key value
+        keys = {}
+        for key in out:
+            keys[key['keyName']] = key['value']
+
+        return(keys)
+
+    def create_storage_container(self, name, rg_name, storage_name):
+        '''
+        Purpose:
+                Creates storage container in existing Azure storage. First 
+                gets keys from storage to use in authenticating container
+                will use first key found
+        Arguments:
+                * self - Azure object
+                * name - Name of container to be created
+                * storage_name - Name of Storage account 
+                * rg_name - Name of Resource Group associated with storage
+        Returns:
+                True if container exists afterwards, False if it couldn't be created
+        '''
+        #Get key information from storage
+        keys = self.get_storage_keys(storage_name, rg_name)
+        #Get abritray key from list
+        key = list(keys.values())[0]
+
+        try:
+            #Try to create storage account
+            self._run(["az", "storage", "container", "create", "-n", name, "--account-name",
+                       storage_name, "--account-key", key])
+        except Exception as e:
+            log.error("Unable to create storage container %s: %s" %(name, e))
+            return False
+        return True
+
+    def list_storage_container(self, rg_name, storage_name, json=False, fields=None, query=None):
+        '''
+        Purpose:
+                Creates storage container in existing Azure storage. First 
+                gets keys from storage to use in authenticating container
+                will use first key found
+        Arguments:
+                * self - Azure object
+                * storage_name - Name of Storage account 
+                * rg_name - Name of Resource Group associated with storage
+                * json - If you want the data in json format, default False
+                * fields - List of fields to return ie ['name', 'location'], or dictionary of output name
+                           and field path ie {'ip': 'ipAddress'}, output is tsv unless json, default None
+                * query - JMESPath query run on output instead of fields, default None
+        Returns:
+                Azure storange accounts as string or json depending on input
+        '''
+        #Get key information from storage
+        keys = self.get_storage_keys(storage_name, rg_name)
+        #Get abritray key from list
+        key = list(keys.values())[0]
+
+        out = self._run(["az", "storage", "container", "list", "--account-name", storage_name,
+                         "--account-key", key] + self._output_args(json, fields, query))
+
+        #Check data isn't empty
+        assert not out.isspace(), "Unable to list Storage Account information"
+        return out.decode('utf-8')
+  
+    def delete_storage_container(self, name, rg_name, storage_name):
+        '''
+        Purpose:
+                Deletes storage container in existing Azure storage. First 
+                gets keys from storage to use in authenticating container
+                will use first key found
+        Arguments:
+                * self - Azure object
+                * name - Name of container to be created
+                * storage_name - Name of Storage account 
+                * rg_name - Name of Resource Group associated with storage
+        '''
+        #Get key information from storage
+        keys = self.get_storage_keys(storage_name, rg_name)
+        #Get abritray key from list
+        key = list(keys.values())[0]
+
+        try:
+            #Try to create storage account
+            self._run(["az", "storage", "container", "delete", "-n", name, "--account-name",
+                       storage_name, "--account-key", key])
+        except Exception as e:
+            log.error("Unable to delete storage container %s: %s" %(name, e))
+
+    def upload_vhd_to_container(self, container_name, storage_name, rg_name, file_path, manifest_dir=None):
+        '''
+        Purpose:
+                Uploads VHD file to existing container, Checks container exists
+                then gets storage key, will use first key found. Then creates a blob named 
+                after file (or just blob.vhd if error) to be uploaded which then will contain the file.
+                With manifest_dir only blocks changed since last upload are sent, see
+                upload_vhd_incremental
+        Arguments:
+                * self - Azure object
+                * container_name - Name of container for file to be uploaded to
+                * storage_name - Name of Storage account 
+                * rg_name - Name of Resource Group associated with storage
+                * file_path - path of file to upload - has to be accesible by Kick
+                * manifest_dir - Directory of block hash manifests for incremental upload, default None
+        Returns:
+                BlobTransfer if uploaded incrementally, None otherwise
+        '''
+
+        #Check container exists
+        assert container_name in self.list_storage_container(rg_name,storage_name), \
+               "Container %s does not currently exist, please create first" %container_name
+
+        if manifest_dir:
+            return self.upload_vhd_incremental(container_name, storage_name, rg_name, file_path, manifest_dir)
+
+        #Get key information from storage
+        keys = self.get_storage_keys(storage_name, rg_name)
         #Get abritray key from list
         key = list(keys.values())[0]
 
+        #Extract blob name from path - will be file name 
+        m = re.search(r'^.*[\/\\](.*)', file_path)
+        if not m:
+            #Unable to extract name - just call it blob.vhd
+            blob_name = "blob.vhd"
+        else:
+            blob_name = m.group(1).strip()
+
+        try:
+            #Try to upload file
+            self._run(["az", "storage", "blob", "upload", "-n", blob_name, "-c", container_name,
+                       "--account-name", storage_name, "--account-key", key, "-f", file_path, "-t",
+                       "page"])
+        except Exception as e:
+            log.error("Unable to upload file %s: %s" %(file_path, e))
+
+    '''
+    ************************************
+    Azure Blob Transfer Functions
+    ************************************
+    '''
+
+    def _blob_url(self, storage_name, rg_name, container_name, blob_name, permissions="r", hours=12):
+        '''
+        Purpose:
+                Builds URL of blob with a SAS token so blob can be read and written over REST
+        Arguments:
+                * self - Azure object
+                * storage_name - Name of Storage account
+                * rg_name - Name of Resource Group associated with storage
+                * container_name - Name of container holding blob
+                * blob_name - Name of blob
+                * permissions - SAS permissions ie 'r' or 'rw', default 'r'
+                * hours - Hours SAS token is valid for, default 12
+        Returns:
+                Tuple of blob endpoint ie https://name.blob.core.windows.net and path with SAS query string
+        '''
+        key = list(self.get_storage_keys(storage_name, rg_name).values())[0]
+        endpoint = self.show_storage(storage_name, rg_name, fields='primaryEndpoints.blob').strip().rstrip('/')
+        expiry = time.strftime("%Y-%m-%dT%H:%MZ", time.gmtime(time.time() + hours * 3600))
+        sas = self._run(["az", "storage", "blob", "generate-sas", "--account-name", storage_name, "--account-key",
+                         key, "-c", container_name, "-n", blob_name, "--permissions", permissions, "--expiry",
+                         expiry, "--https-only", "-o", "tsv"]).decode('utf-8').strip().strip('"')
+
+        #Keep SAS tokens out of recorded cassettes
+        if self.cassette:
+            self.cassette.add_secrets([sas])
+        return endpoint, "/%s/%s?%s" %(quote(container_name), quote(blob_name), sas)
+
+    def _blob_request(self, pool, method, path, headers=None, body=None, query=None, retries=4):
+        '''
+        Purpose:
+                Sends Blob service request, throttling and server errors are retried with backoff
+        Arguments:
+                * self - Azure object
+                * pool - _HttpPool of blob endpoint
+                * method - HTTP method
+                * path - Blob path with SAS query string, see _blob_url
+                * headers - Dictionary of request headers, default None
+                * body - Request body as bytes, default None
+                * query - Extra query string ie 'comp=pagelist', default None
+                * retries - Number of retries, default 4
+        Returns:
+                Tuple of status, dictionary of lowercase response headers and body as bytes
+        '''
+        headers = dict(headers or {}, **{'x-ms-version': '2021-08-06'})
+        if query:
+            path = "%s&%s" %(path, query)
+        start_time = time.time()
+        for attempt in range(retries + 1):
+            self.cancel_token.check("%s %s" %(method, path.split('?')[0]), start_time)
+            try:
+                status, response_headers, data = pool.request(method, path, body, headers)
+            except (http.client.HTTPException, OSError) as e:
+                if attempt == retries:
+                    raise
+                log.debug("Retrying blob request after %s" %e)
+            else:
+                if status < 400:
+                    return status, response_headers, data
+                if (status != 429 and status < 500) or attempt == retries:
+                    raise AzureRestError(status, response_headers.get('x-ms-error-code'),
+                                         data.decode('utf-8', 'replace')[:500])
+            self.cancel_token.sleep(min(2 ** attempt, 30))
+
+    def get_page_ranges(self, pool, path, size, segment_size=1024 ** 3, max_workers=8):
+        '''
+        Purpose:
+                Gets ranges of page blob holding data, blob is split in segments queried at the
+                same time so large sparse blobs are mapped quickly
+        Arguments:
+                * self - Azure object
+                * pool - _HttpPool of blob endpoint
+                * path - Blob path with SAS query string, see _blob_url
+                * size - Size of blob in bytes
+                * segment_size - Bytes covered by one query, multiple of 512, default 1 GiB
+                * max_workers - Number of queries run at the same time, default 8
+        Returns:
+                Sorted list of (start, end) byte ranges, end exclusive, adjacent ranges merged
+        '''
+
+        def segment(start):
+            ranges = []
+            marker = None
+            while True:
+                query = "comp=pagelist" + ("&marker=%s" %quote(marker) if marker else "")
+                _, _, data = self._blob_request(pool, "GET", path, query=query, headers={
+                    'x-ms-range': "bytes=%d-%d" %(start, min(start + segment_size, size) - 1)})
+                page_list = ElementTree.fromstring(data)
+                for page_range in page_list.iter('PageRange'):
+                    ranges.append((int(page_range.find('Start').text), int(page_range.find('End').text) + 1))
+                marker = page_list.findtext('NextMarker')
+                if not marker:
+                    return ranges
+
+        with ThreadPoolExecutor(max_workers=max_workers) as query_pool:
+            segments = list(query_pool.map(segment, range(0, size, segment_size)))
+
+        merged = []
+        for start, end in sorted(page_range for ranges in segments for page_range in ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def download_blob(self, storage_name, rg_name, container_name, blob_name, file_path, max_workers=8,
+                      chunk_size=4 * 1024 ** 2, resume=True):
+        '''
+        Purpose:
+                Downloads blob with many ranged requests at once over pooled keep-alive connections.
+                For page blobs (ie VHDs) only pages holding data are fetched and written into a
+                sparse file of the blob size, the empty rest never crosses the network. Every chunk
+                is checked against its MD5 from the service and the blob is pinned by ETag, whole
+                file is checked against blob Content-MD5 if it has one. Byte ranges of finished chunks
+                are logged next to the file (file_path.progress) so an interrupted download resumes,
+                even with another chunk_size - only chunks wholly covered by them are skipped
+        Arguments:
+                * self - Azure object
+                * storage_name - Name of Storage account
+                * rg_name - Name of Resource Group associated with storage
+                * container_name - Name of container holding blob
+                * blob_name - Name of blob
+                * file_path - Path of file to write
+                * max_workers - Number of ranges downloaded at the same time, default 8
+                * chunk_size - Bytes per request, up to 4 MiB gets a service MD5, default 4 MiB
+                * resume - Continue previous interrupted download of same blob version, default True
+        Returns:
+                BlobTransfer (path, size, transferred, skipped, elapsed), skipped counts bytes
+                not downloaded (empty pages or resumed)
+        '''
+        start_time = time.time()
+        endpoint, path = self._blob_url(storage_name, rg_name, container_name, blob_name)
+        pool = _HttpPool(endpoint, max_workers)
+        progress_path = file_path + ".progress"
+        try:
+            _, properties, _ = self._blob_request(pool, "HEAD", path)
+            size = int(properties['content-length'])
+            etag = properties.get('etag')
+            if properties.get('x-ms-blob-type') == 'PageBlob':
+                ranges = self.get_page_ranges(pool, path, size, max_workers=max_workers)
+            else:
+                ranges = [(0, size)] if size else []
+
+            #Continue earlier download only if it was of the same blob version
+            done = []
+            header = jsonlib.dumps({'etag': etag, 'size': size})
+            if resume and os.path.exists(progress_path) and os.path.exists(file_path) and \
+               os.path.getsize(file_path) == size:
+                with open(progress_path) as progress:
+                    lines = progress.read().splitlines()
+                if lines and lines[0] == header:
+                    done = sorted(tuple(int(offset) for offset in line.split('-'))
+                                  for line in lines[1:] if re.match(r'^\d+-\d+$', line))
+            if not done:
+                with open(file_path, 'wb') as new_file:
+                    #Sparse until written, holes read back as zeros
+                    new_file.truncate(size)
+                with open(progress_path, 'w') as progress:
+                    progress.write(header + "\n")
+
+            chunks = [(offset, min(offset + chunk_size, end)) for start, end in ranges
+                      for offset in range(start, end, chunk_size)]
+            #Merge written ranges so a chunk spanning several of them is seen as covered
+            merged = []
+            for start, end in done:
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            starts = [start for start, _ in merged]
+
+            def covered(chunk):
+                index = bisect.bisect_right(starts, chunk[0]) - 1
+                return index >= 0 and merged[index][1] >= chunk[1]
+
+            todo = [chunk for chunk in chunks if not covered(chunk)]
+            log.info("Downloading %s: %d of %d bytes hold data, %d chunks left"
+                     %(blob_name, sum(end - start for start, end in ranges), size, len(todo)))
+
+            fd = os.open(file_path, os.O_WRONLY)
+            progress = open(progress_path, 'a')
+            lock = threading.Lock()
+
+            def fetch(chunk):
+                start, end = chunk
+                headers = {'x-ms-range': "bytes=%d-%d" %(start, end - 1)}
+                if etag:
+                    headers['If-Match'] = etag
+                if end - start <= 4 * 1024 ** 2:
+                    headers['x-ms-range-get-content-md5'] = 'true'
+                for attempt in range(3):
+                    _, response_headers, data = self._blob_request(pool, "GET", path, headers)
+                    expected = response_headers.get('content-md5')
+                    if len(data) == end - start and (not expected or
+                       base64.b64encode(hashlib.md5(data).digest()).decode() == expected):
+                        break
+                    log.warning("Chunk %d-%d of %s corrupted, fetching again" %(start, end, blob_name))
+                else:
+                    raise IOError("Chunk %d-%d of %s failed integrity check" %(start, end, blob_name))
+                os.pwrite(fd, data, start)
+                with lock:
+                    progress.write("%d-%d\n" %(start, end))
+                    progress.flush()
+                return end - start
+
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers) as transfer:
+                    transferred = sum(transfer.map(fetch, todo))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+                progress.close()
+
+            if properties.get('content-md5'):
+                digest = hashlib.md5()
+                with open(file_path, 'rb') as downloaded:
+                    for block in iter(lambda: downloaded.read(chunk_size), b''):
+                        digest.update(block)
+                if base64.b64encode(digest.digest()).decode() != properties['content-md5']:
+                    raise IOError("Downloaded %s doesn't match blob Content-MD5" %file_path)
+            os.remove(progress_path)
+        finally:
+            pool.close()
+
+        elapsed = time.time() - start_time
+        log.info("Downloaded %s to %s, %d bytes in %.1f seconds" %(blob_name, file_path, transferred, elapsed))
+        return BlobTransfer(file_path, size, transferred, size - transferred, elapsed)
+
+    def _manifest_path(self, manifest_dir, storage_name, container_name, blob_name):
+        '''
+        Purpose:
+                Gets path of block hash manifest kept for blob, see upload_vhd_incremental
+        Arguments:
+                * self - Azure object
+                * manifest_dir - Directory holding manifests
+                * storage_name - Name of Storage account
+                * container_name - Name of container holding blob
+                * blob_name - Name of blob
+        Returns:
+                Path of manifest file
+        '''
+        name = "%s.%s.%s.json" %(storage_name, container_name, re.sub(r'[^\w.-]', '_', blob_name))
+        return os.path.join(manifest_dir, name)
+
+    def upload_vhd_incremental(self, container_name, storage_name, rg_name, file_path, manifest_dir,
+                               blob_name=None, base_blob=None, block_size=1024 ** 2, max_workers=8):
+        '''
+        Purpose:
+                Uploads VHD as page blob sending only blocks that changed since the last upload.
+                A manifest of block hashes of every uploaded blob is kept in manifest_dir, the new
+                image is hashed in parallel over a memory map and compared to the manifest of the
+                base blob. The base is copied server side to blob_name (or snapshotted when it is
+                blob_name itself, so the previous version is kept) and only changed blocks are
+                written into it, blocks that became empty are cleared. Without a manifest matching
+                the base blob ETag a new page blob is created and only blocks holding data are sent
+        Arguments:
+                * self - Azure object
+                * container_name - Name of container for blob
+                * storage_name - Name of Storage account
+                * rg_name - Name of Resource Group associated with storage
+                * file_path - Path of VHD to upload, size must be multiple of 512
+                * manifest_dir - Directory to keep block hash manifests in, created if missing
+                * blob_name - Name of blob to write, default file name
+                * base_blob - Name of previous blob to start from, default blob_name
+                * block_size - Bytes per hashed block, multiple of 512 up to 4 MiB, default 1 MiB
+                * max_workers - Number of blocks hashed or uploaded at the same time, default 8
+        Returns:
+                BlobTransfer (path, size, transferred, skipped, elapsed), skipped counts bytes
+                not sent (unchanged or empty blocks)
+        '''
+        start_time = time.time()
+        if block_size % 512 or not 0 < block_size <= 4 * 1024 ** 2:
+            log.error("Block size %d isn't a multiple of 512 up to 4 MiB" %block_size)
+            raise ValueError("Block size %d isn't a multiple of 512 up to 4 MiB" %block_size)
+        blob_name = blob_name or os.path.basename(file_path) or "blob.vhd"
+        base_blob = base_blob or blob_name
+
+        size, digests = _hash_blocks(file_path, block_size, max_workers)
+        if size % 512:
+            log.error("Size of %s isn't a multiple of 512 bytes, can't be a page blob" %file_path)
+            raise ValueError("Size of %s isn't a multiple of 512 bytes" %file_path)
+
+        if not os.path.isdir(manifest_dir):
+            os.makedirs(manifest_dir)
+        manifest_path = self._manifest_path(manifest_dir, storage_name, container_name, blob_name)
+        base_manifest_path = self._manifest_path(manifest_dir, storage_name, container_name, base_blob)
+        manifest = None
+        if os.path.exists(base_manifest_path):
+            with open(base_manifest_path, 'r') as manifest_file:
+                manifest = jsonlib.load(manifest_file)
+
+        endpoint, path = self._blob_url(storage_name, rg_name, container_name, blob_name, permissions="rcw")
+        pool = _HttpPool(endpoint, max_workers)
+        try:
+            #Manifest is only trusted if base blob is still the version it describes
+            base_etag = None
+            if manifest and manifest.get('block_size') == block_size:
+                base_path = path if base_blob == blob_name else \
+                    self._blob_url(storage_name, rg_name, container_name, base_blob)[1]
+                try:
+                    _, properties, _ = self._blob_request(pool, "HEAD", base_path)
+                except AzureRestError as e:
+                    if e.status != 404:
+                        raise
+                else:
+                    if properties.get('etag') == manifest.get('etag'):
+                        base_etag = properties['etag']
+                if not base_etag:
+                    log.info("Base blob %s changed since manifest was written, uploading whole image" %base_blob)
+
+            if base_etag and base_blob == blob_name:
+                _, headers, _ = self._blob_request(pool, "PUT", path, query="comp=snapshot",
+                                                   headers={'If-Match': base_etag})
+                log.info("Kept previous version of %s as snapshot %s" %(blob_name, headers.get('x-ms-snapshot')))
+            elif base_etag:
+                #Server side copy, pinned to version manifest describes
+                self._blob_request(pool, "PUT", path, headers={
+                    'x-ms-copy-source': endpoint + base_path, 'x-ms-source-if-match': base_etag})
+                while True:
+                    _, headers, _ = self._blob_request(pool, "HEAD", path)
+                    if headers.get('x-ms-copy-status') != 'pending':
+                        break
+                    self.cancel_token.sleep(2)
+                if headers.get('x-ms-copy-status') not in (None, 'success'):
+                    log.error("Copy of %s to %s failed: %s" %(base_blob, blob_name,
+                                                              headers.get('x-ms-copy-status-description')))
+                    raise AzureRestError(409, 'CopyFailed', headers.get('x-ms-copy-status-description'))
+
+            if base_etag:
+                old_digests = manifest['digests']
+                if manifest['size'] != size:
+                    self._blob_request(pool, "PUT", path, query="comp=properties",
+                                       headers={'x-ms-blob-content-length': str(size)})
+            else:
+                #New page blob reads as zeros, only blocks holding data are sent
+                old_digests = []
+                self._blob_request(pool, "PUT", path, headers={
+                    'x-ms-blob-type': 'PageBlob', 'x-ms-blob-content-length': str(size)})
+
+            #Blocks past the old end read as zeros after resize
+            old_digests = old_digests + [None] * (len(digests) - len(old_digests))
+            changed = [index for index, value in enumerate(digests) if value != old_digests[index]]
+
+            #Adjacent changed blocks go in one request, up to the 4 MiB Put Page limit for data
+            writes = []
+            for index in changed:
+                start = index * block_size
+                end = min(start + block_size, size)
+                clear = digests[index] is None
+                if writes and writes[-1][1] == start and writes[-1][2] == clear and \
+                   (clear or end - writes[-1][0] <= 4 * 1024 ** 2):
+                    writes[-1] = (writes[-1][0], end, clear)
+                else:
+                    writes.append((start, end, clear))
+            log.info("Uploading %s: %d of %d blocks changed" %(blob_name, len(changed), len(digests)))
+
+            with open(file_path, 'rb') as image, \
+                 mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ) if size else io.BytesIO() as view:
+
+                def write(page_write):
+                    start, end, clear = page_write
+                    headers = {'x-ms-range': "bytes=%d-%d" %(start, end - 1)}
+                    if clear:
+                        headers.update({'x-ms-page-write': 'clear'})
+                        self._blob_request(pool, "PUT", path, headers, query="comp=page")
+                        return 0
+                    data = view[start:end]
+                    headers.update({'x-ms-page-write': 'update',
+                                    'Content-MD5': base64.b64encode(hashlib.md5(data).digest()).decode()})
+                    self._blob_request(pool, "PUT", path, headers, body=data, query="comp=page")
+                    return end - start
+
+                with ThreadPoolExecutor(max_workers=max_workers) as transfer:
+                    transferred = sum(transfer.map(write, writes))
+
+            _, properties, _ = self._blob_request(pool, "HEAD", path)
+        finally:
+            pool.close()
+
+        with open(manifest_path + '.tmp', 'w') as manifest_file:
+            jsonlib.dump({'blob': blob_name, 'etag': properties.get('etag'), 'size': size,
+                          'block_size': block_size, 'digests': digests}, manifest_file)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+        elapsed = time.time() - start_time
+        log.info("Uploaded %s to %s, %d of %d bytes sent in %.1f seconds"
+                 %(file_path, blob_name, transferred, size, elapsed))
+        return BlobTransfer(file_path, size, transferred, size - transferred, elapsed)
+
+    '''
+    ************************************
+    Azure Streaming List Functions
+    ************************************
+    '''
+
+    def _iter_az_json(self, cmd):
+        '''
+        Purpose:
+                Runs Azure CLI command returning a JSON list and yields each record as soon as
+                it is parsed from the command output, instead of waiting for the whole output.
+                If the caller stops early the az process is killed
+        Arguments:
+                * self - Azure object
+                * cmd - Azure CLI command to run as list of arguments
+        Returns:
+                Generator of records as dictionaries
+        '''
+        if self.cassette:
+            #Recorded output is already complete
+            for record in _iter_json_array(io.BytesIO(self._run(cmd))):
+                yield record
+            return
+
+        start_time = time.time()
+        operation = " ".join(takewhile(lambda arg: not arg.startswith('-'), cmd))
+        self.cancel_token.check(operation, start_time)
+        timeout = self._command_timeout(cmd)
+        proc = Popen(self._argv(self._scoped(cmd)), stdout=PIPE, env=self._env, start_new_session=True)
+        self.cancel_token._register(proc)
+        expired = []
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, lambda: expired.append(True) or _kill_tree(proc))
+            timer.daemon = True
+            timer.start()
+        finished = False
+        try:
+            for record in _iter_json_array(proc.stdout):
+                yield record
+            finished = True
+        except ValueError:
+            #Output not valid JSON - report command failure first if there was one
+            finished = True
+            proc.stdout.read()
+            if expired:
+                raise AzureDeadlineError(operation, time.time() - start_time)
+            self.cancel_token.check(operation, start_time)
+            if proc.wait():
+                log.error("Unable to run %s" %" ".join(cmd))
+                raise CalledProcessError(proc.returncode, cmd)
+            raise
+        finally:
+            if timer:
+                timer.cancel()
+            if not finished:
+                #Caller stopped early - rest of output not needed
+                _kill_tree(proc)
+            self.cancel_token._unregister(proc)
+            proc.stdout.close()
+            proc.wait()
+
+        if proc.returncode:
+            if expired:
+                raise AzureDeadlineError(operation, time.time() - start_time)
+            self.cancel_token.check(operation, start_time)
+            log.error("Unable to run %s" %" ".join(cmd))
+            raise CalledProcessError(proc.returncode, cmd)
+
+    def iter_rg(self, tags={'location':'eastus'}):
+        '''
+        Purpose:
+                Streams Azure resource groups based on passed in tags, see list_rg
+        Arguments:
+                * self - Azure object
+                * tags - dictionary containing tag id and tag value default = {'location':'eastus'}
+        Returns:
+                Generator of resource groups as dictionaries
+        '''
+
+        # Concantinate all tags into a single string to pass to Azure ClI
+        tag_str = ""
+        for tag in tags:
+            tag_str += "[?%s=='%s']" %(tag, tags[tag])
+
+        cmd = ["az", "group", "list"]
+        if tag_str:
+            cmd += ["--query", tag_str]
+        return self._iter_az_json(cmd)
+
+    def iter_vnet(self, rg_name):
+        '''
+        Purpose:
+                Streams Azure Vnets contained in resource group, see list_vnet
+        Arguments:
+                * self - Azure object
+                * rg_name - resource group you want to find VNETs associated with
+        Returns:
+                Generator of vnets as dictionaries
+        '''
+        return self._iter_az_json(["az", "network", "vnet", "list", "--resource-group", rg_name])
+
+    def iter_vm(self, rg_name):
+        '''
+        Purpose:
+                Streams Azure VMs associated with a resource group, see list_vm
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group VMs are associated with
+        Returns:
+                Generator of VMs as dictionaries
+        '''
+        return self._iter_az_json(["az", "vm", "list", "-g", rg_name])
+
+    def iter_resources(self, rg_name):
+        '''
+        Purpose:
+                Streams Azure resources associated with a resource group, see list_resources
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group resources are associated with
+        Returns:
+                Generator of resources as dictionaries
+        '''
+        return self._iter_az_json(["az", "resource", "list", "-g", rg_name])
+
+    def iter_route_tables(self, rg_name):
+        '''
+        Purpose:
+                Streams Azure route tables associated with a resource group, see show_all_route_tables
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group you want route-tables in
+        Returns:
+                Generator of route tables as dictionaries
+        '''
+        return self._iter_az_json(["az", "network", "route-table", "list", "-g", rg_name])
+
+    def iter_routes(self, rg_name, route_table):
+        '''
+        Purpose:
+                Streams Azure routes in route table, see show_routes
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group route-table is associated with
+                * route_table - Route-table to collect route info on
+        Returns:
+                Generator of routes as dictionaries
+        '''
+        return self._iter_az_json(["az", "network", "route-table", "route", "list", "-g", rg_name,
+                                   "--route-table-name", route_table])
+
+    def iter_pip(self, rg_name):
+        '''
+        Purpose:
+                Streams Azure Public IPs associated with a resource group, see list_pip
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group public-ip are associated with
+        Returns:
+                Generator of public IPs as dictionaries
+        '''
+        return self._iter_az_json(["az", "network", "public-ip", "list", "-g", rg_name])
+
+    def iter_nsg(self, rg_name):
+        '''
+        Purpose:
+                Streams Azure Network Security Groups associated with a resource group, see list_nsg
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group nsg are associated with
+        Returns:
+                Generator of network security groups as dictionaries
+        '''
+        return self._iter_az_json(["az", "network", "nsg", "list", "-g", rg_name])
+
+    def iter_nic(self, rg_name):
+        '''
+        Purpose:
+                Streams Azure Network Interfaces associated with a resource group, see list_nic
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group nics are associated with
+        Returns:
+                Generator of network interfaces as dictionaries
+        '''
+        return self._iter_az_json(["az", "network", "nic", "list", "-g", rg_name])
+
+    def iter_disk(self, rg_name):
+        '''
+        Purpose:
+                Streams Azure Managed disks associated with a resource group, see list_disk
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group disks are associated with
+        Returns:
+                Generator of disks as dictionaries
+        '''
+        return self._iter_az_json(["az", "disk", "list", "-g", rg_name])
+
+    def iter_storage(self, rg_name):
+        '''
+        Purpose:
+                Streams Azure Storage Accounts associated with a resource group, see list_storage
+        Arguments:
+                * self - Azure object
+                * rg_name - resource group you want to find storage accounts associated with
+        Returns:
+                Generator of storage accounts as dictionaries
+        '''
+        return self._iter_az_json(["az", "storage", "account", "list", "-g", rg_name])
+
+    def iter_resource_graph(self, resource_types=None, rg_names=None, tags=None, locations=None,
+                            subscriptions=None, query=None, page_size=1000):
+        '''
+        Purpose:
+                Streams Resource Graph query results page by page so records of the first page
+                can be used while later pages are still being requested, see query_resource_graph
+        Arguments:
+                * self - Azure object
+                * resource_types - List of resource types, default None
+                * rg_names - List of resource groups to search, default None (all resource groups)
+                * tags - dictionary containing tag id and tag value, default None
+                * locations - List of locations, default None
+                * subscriptions - List of subscription IDs to search, default None (all accessible)
+                * query - Custom KQL query to run instead of building one from the filters, default None
+                * page_size - Number of records requested per page, max 1000, default 1000
+        Returns:
+                Generator of GraphRecord
+        '''
+
+        if not query:
+            query = self.build_graph_query(resource_types, rg_names, tags, locations)
+
+        skip_token = None
+        while True:
+            cmd = ["az", "graph", "query", "-q", query, "--first", str(page_size)]
+            if subscriptions:
+                cmd += ["--subscriptions"] + list(subscriptions)
+            if skip_token:
+                cmd += ["--skip-token", skip_token]
+            try:
+                out = self._run(cmd)
+            except Exception as e:
+                log.error("Unable to query resource graph: %s" %e)
+                raise
+
+            page = jsonlib.loads(out.decode('utf-8'))
+            #Older CLI versions return just the list of rows
+            if isinstance(page, list):
+                page = {'data': page}
+
+            for row in page.get('data', []):
+                yield GraphRecord(row.get('id'), row.get('name'), row.get('type'),
+                                  row.get('resourceGroup'), row.get('location'),
+                                  row.get('subscriptionId'), row.get('tags') or {},
+                                  row.get('properties') or {})
+
+            skip_token = page.get('skip_token') or page.get('skipToken')
+            if not skip_token:
+                break
+
+    '''
+    ************************************
+    Azure Inventory Functions
+    ************************************
+    '''
+
+    def load_inventory(self, rg_name=None, subscriptions=None, inventory=None):
+        '''
+        Purpose:
+                Loads VMs, NICs, disks, public IPs, NSGs, route tables and storage accounts into
+                compact in-memory inventory. With a resource group the lists are streamed
+                concurrently, without one a single Resource Graph query covers all resource groups
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group to load, default None (all resource groups)
+                * subscriptions - List of subscription IDs to load when no rg_name given, default None
+                * inventory - ResourceInventory to add records to, default None (new inventory)
+        Returns:
+                ResourceInventory
+        '''
+
+        if inventory is None:
+            inventory = ResourceInventory()
+
+        if rg_name:
+            iterators = (self.iter_vm(rg_name), self.iter_nic(rg_name), self.iter_disk(rg_name),
+                         self.iter_pip(rg_name), self.iter_nsg(rg_name), self.iter_route_tables(rg_name),
+                         self.iter_storage(rg_name))
+            with ThreadPoolExecutor(max_workers=len(iterators)) as pool:
+                for records in [pool.submit(list, iterator) for iterator in iterators]:
+                    inventory.update(records.result())
+        else:
+            inventory.update(self.iter_resource_graph(resource_types=[cls.TYPE for cls in RESOURCE_CLASSES.values()],
+                                                      subscriptions=subscriptions))
+
+        log.info("Inventory holds %d resources" %len(inventory))
+        return inventory
+
+    def _activity_events(self, rg_name, start_time, max_events):
+        '''
+        Purpose:
+                Gets events of activity log since start_time
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group, None for whole subscription
+                * start_time - Epoch seconds to read log from
+                * max_events - Most events returned
+        Returns:
+                List of events as dictionaries of id, resourceId, operation, status and time
+        '''
+        cmd = ["az", "monitor", "activity-log", "list", "--start-time",
+               time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start_time)), "--max-events", str(max_events),
+               "--query", "[].{id:eventDataId, resourceId:resourceId, operation:operationName.value, "
+               "status:status.value, time:eventTimestamp}", "-o", "json"]
+        if rg_name:
+            cmd += ["-g", rg_name]
+        return jsonlib.loads(self._run(cmd).decode('utf-8') or "[]")
+
+    def _show_resources(self, resource_ids):
+        '''
+        Purpose:
+                Gets current state of resources with one az resource show, one at a time if
+                any of them is not found. Only not found (exit status 3 of Azure CLI) means a
+                resource no longer exists, any other failure ie throttling is raised
+        Arguments:
+                * self - Azure object
+                * resource_ids - List of resource IDs
+        Returns:
+                Dictionary of resource by lowercase ID, None for resources that no longer exist
+        '''
+        try:
+            out = jsonlib.loads(self._run(["az", "resource", "show", "--ids"] + list(resource_ids) +
+                                          ["-o", "json"]).decode('utf-8') or "[]")
+        except CalledProcessError as e:
+            if e.returncode != 3:
+                raise
+            if len(resource_ids) == 1:
+                return {resource_ids[0].lower(): None}
+            found = {}
+            for resource_id in resource_ids:
+                found.update(self._show_resources([resource_id]))
+            return found
+
+        records = out if isinstance(out, list) else [out]
+        found = dict((resource_id.lower(), None) for resource_id in resource_ids)
+        found.update((record['id'].lower(), record) for record in records if record)
+        return found
+
+    def refresh_inventory(self, inventory, rg_name=None, overlap=300, max_events=1000, batch_size=20,
+                          max_workers=8):
+        '''
+        Purpose:
+                Keeps inventory of resource group (or subscription) fresh without listing everything
+                again. The first refresh loads it with load_inventory, later refreshes read the
+                activity log since the previous one and read again only resources written, deleted
+                or acted on since - changes to child resources (ie subnets or routes) refresh their
+                parent. Deleted resources are removed. The log is read from overlap seconds before
+                the previous refresh as events show up late, events already applied are skipped. If
+                the log holds max_events or more events everything is listed again instead
+        Arguments:
+                * self - Azure object
+                * inventory - ResourceInventory to refresh
+                * rg_name - Resource group, default None (all resource groups of subscription)
+                * overlap - Seconds the log is read from before previous refresh, default 300
+                * max_events - Events above which a full listing is made, default 1000
+                * batch_size - Resource IDs read per az resource show, default 20
+                * max_workers - Number of reads run at the same time, default 8
+        Returns:
+                InventoryRefresh (full, events, updated, removed, elapsed)
+        '''
+        start_time = time.time()
+        scope = (rg_name or "").lower()
+        cursor = inventory.cursors.get(scope)
+
+        events = []
+        if cursor:
+            since, applied = cursor
+            events = self._activity_events(rg_name, since - overlap, max_events)
+        if not cursor or len(events) >= max_events:
+            #First refresh or too much changed - list everything
+            current = self.load_inventory(rg_name, inventory=ResourceInventory())
+            stale = [record.id for record in inventory
+                     if (not rg_name or (record.resource_group or '').lower() == scope) and record.id not in current]
+            for resource_id in stale:
+                inventory.remove(resource_id)
+            inventory.update(current)
+            inventory.cursors[scope] = (start_time, set())
+            return InventoryRefresh(True, len(events), len(current), len(stale), time.time() - start_time)
+
+        #Latest event of each top level resource decides if it is read again or removed
+        changed = {}
+        for event in sorted(events, key=lambda event: event.get('time') or ''):
+            resource_id = event.get('resourceId')
+            if not resource_id or event.get('status') != 'Succeeded' or event.get('id') in applied:
+                continue
+            top_id = _top_from_id(resource_id)
+            if _type_from_id(top_id).lower() not in RESOURCE_CLASSES and top_id not in inventory:
+                continue
+            deleted = (event.get('operation') or '').lower().endswith('/delete') and \
+                      top_id.lower() == resource_id.rstrip('/').lower()
+            changed[top_id.lower()] = (top_id, deleted)
+
+        #Read everything before changing inventory so a failed read leaves it and the cursor as they were
+        to_read = [top_id for top_id, deleted in changed.values() if not deleted]
+        batches = [to_read[index:index + batch_size] for index in range(0, len(to_read), batch_size)]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(self._show_resources, batches))
+
+        removed = [top_id for top_id, deleted in changed.values() if deleted]
+        for top_id in removed:
+            inventory.remove(top_id)
+        updated = 0
+        for found in results:
+            for resource_id, record in found.items():
+                if record:
+                    inventory.add(record)
+                    updated += 1
+                elif inventory.remove(resource_id):
+                    removed.append(resource_id)
+
+        inventory.cursors[scope] = (start_time, set(event.get('id') for event in events))
+        log.info("Inventory refreshed from %d events, %d resources read again and %d removed"
+                 %(len(events), updated, len(removed)))
+        return InventoryRefresh(False, len(events), updated, len(removed), time.time() - start_time)
+
+    def watch_inventory(self, inventory, rg_name=None, interval=60, **kwargs):
+        '''
+        Purpose:
+                Refreshes inventory every interval seconds in a background thread until stopped,
+                see refresh_inventory. Failed refreshes are logged and tried again next interval
+        Arguments:
+                * self - Azure object
+                * inventory - ResourceInventory to keep fresh
+                * rg_name - Resource group, default None (all resource groups of subscription)
+                * interval - Seconds between refreshes, default 60
+                * kwargs - Other arguments of refresh_inventory
+        Returns:
+                threading.Event, set it to stop watching
+        '''
+        stop = threading.Event()
+
+        def watch():
+            while not stop.is_set() and not self.cancel_token.cancelled:
+                try:
+                    self.refresh_inventory(inventory, rg_name, **kwargs)
+                except Exception as e:
+                    log.warning("Unable to refresh inventory of %s: %s" %(rg_name or "subscription", e))
+                stop.wait(interval)
+
+        thread = threading.Thread(target=watch, name="inventory-%s" %(rg_name or "subscription"))
+        thread.daemon = True
+        thread.start()
+        return stop
+
+    '''
+    ************************************
+    Azure Fan-out Functions
+    ************************************
+    '''
+
+    def fan_out(self, operation, targets, max_workers=10):
+        '''
+        Purpose:
+                Runs operation against many (subscription, location, resource group) targets at the
+                same time, each in its own CLI context (see context), and collects result or error of
+                every target - a failing target doesn't stop the others
+        Arguments:
+                * self - Azure object
+                * operation - Function called as operation(context, target) ie
+                              lambda az, target: az.list_vm(target.rg_name, json=True)
+                * targets - List of FanOutTarget or (subscription, location, rg_name) tuples
+                * max_workers - Number of targets run at the same time, default 10
+        Returns:
+                Dictionary of FanOutResult (target, ok, result, error, elapsed) by FanOutTarget
+        '''
+        targets = [FanOutTarget(*target) for target in targets]
+        results = {}
+
+        def run(target):
+            start = time.time()
+            try:
+                result = operation(self.context(target.subscription, target.location, target.rg_name), target)
+                return FanOutResult(target, True, result, None, time.time() - start)
+            except Exception as e:
+                log.error("Operation failed for %s: %s" %("/".join(filter(None, target)), e))
+                return FanOutResult(target, False, None, e, time.time() - start)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for result in pool.map(run, targets):
+                results[result.target] = result
+
+        log.info("Operation succeeded for %d of %d targets" %(sum(result.ok for result in results.values()),
+                                                               len(targets)))
+        return results
+
+    '''
+    ************************************
+    Azure Waiter Functions
+    ************************************
+    '''
+
+    def _wait_all(self, keys, query, check, timeout, poll_interval, max_interval, max_workers=10):
+        '''
+        Purpose:
+                Waits for many resources in one shared polling loop. Keys are tuples ending with the
+                resource name, keys sharing everything before the name form a batch checked with one
+                query per poll. Polling backs off while nothing changes and speeds up again once any
+                resource changes state
+        Arguments:
+                * self - Azure object
+                * keys - List of tuples ie (rg_name, vm_name)
+                * query - Function taking batch tuple and returning dictionary of lower case name and state
+                * check - Function taking state (None if resource not found) and returning 'done',
+                          'failed' or None to keep waiting
+                * timeout - Seconds to wait for all resources
+                * poll_interval - Seconds between first polls and after any state change
+                * max_interval - Longest time between polls when nothing changes
+                * max_workers - Number of batch queries run at the same time, default 10
+        Returns:
+                Dictionary of WaitResult (key, status, state, elapsed) by key, status is 'done',
+                'failed' or 'timeout'
+        '''
+        start = time.time()
+        results = {}
+        last_states = {}
+        batches = {}
+        for key in keys:
+            batches.setdefault(tuple(key[:-1]), set()).add(tuple(key))
+
+        interval = poll_interval
+        while batches:
+            states = {}
+            with ThreadPoolExecutor(max_workers=min(len(batches), max_workers)) as pool:
+                futures = dict((pool.submit(query, batch), batch) for batch in batches)
+                for future in as_completed(futures):
+                    try:
+                        states[futures[future]] = future.result()
+                    except Exception as e:
+                        #Check batch again on next poll
+                        log.warning("Unable to check state of %s: %s" %("/".join(futures[future]) or "batch", e))
+
+            changed = False
+            for batch in states:
+                for key in list(batches[batch]):
+                    state = states[batch].get(key[-1].lower())
+                    if key not in last_states or last_states[key] != state:
+                        changed = True
+                        last_states[key] = state
+                    status = check(state)
+                    if status:
+                        results[key] = WaitResult(key, status, state, time.time() - start)
+                        batches[batch].discard(key)
+                if not batches[batch]:
+                    del batches[batch]
+
+            #Stop waiting if cancelled, error carries last state seen of each resource
+            self.cancel_token.check("Wait for %d resources" %len(keys), start,
+                                    dict(("/".join(key), state) for key, state in last_states.items()))
+            if batches and time.time() - start >= timeout:
+                for key in set().union(*batches.values()):
+                    results[key] = WaitResult(key, 'timeout', last_states.get(key), time.time() - start)
+                break
+            if batches:
+                interval = poll_interval if changed else min(interval * 1.5, max_interval)
+                self.cancel_token.sleep(max(0, min(interval, timeout - (time.time() - start))))
+
+        return results
+
+    def wait_vms(self, vms, state="running", timeout=1800, poll_interval=5, max_interval=60, settle=30):
+        '''
+        Purpose:
+                Waits for VMs to reach power state, VMs of a resource group are checked together
+                with one az vm list -d per poll. VMs that failed provisioning, or rest in another
+                stable power state (ie deallocated when waiting for running) once settle seconds
+                have passed, are failed without waiting for timeout
+        Arguments:
+                * self - Azure object
+                * vms - List of (rg_name, vm_name) tuples
+                * state - Power state to wait for ie 'running', 'deallocated' or 'stopped', default 'running'
+                * timeout - Seconds to wait for all VMs, default 1800
+                * poll_interval - Seconds between first polls and after any state change, default 5
+                * max_interval - Longest time between polls when nothing changes, default 60
+                * settle - Seconds VMs just told to change power state get to leave their old one,
+                           default 30
+        Returns:
+                Dictionary of WaitResult (key, status, state, elapsed) by (rg_name, vm_name), state
+                is power state ie 'VM running' or 'ProvisioningState/failed'
+        '''
+        start = time.time()
+
+        def query(batch):
+            return dict((vm['name'].lower(), "ProvisioningState/failed" if vm['provisioning'] == 'Failed' else vm['state'])
+                        for vm in self._iter_az_json(["az", "vm", "list", "-d", "-g", batch[0], "--query",
+                                                      "[].{name:name, state:powerState, provisioning:provisioningState}"]))
+
+        def check(power_state):
+            if power_state == "VM " + state:
+                return 'done'
+            if power_state == "ProvisioningState/failed":
+                return 'failed'
+            if power_state in ("VM running", "VM stopped", "VM deallocated") and time.time() - start >= settle:
+                return 'failed'
+            return None
+
+        results = self._wait_all(vms, query, check, timeout, poll_interval, max_interval)
+        log.info("%d of %d VMs %s" %(sum(result.status == 'done' for result in results.values()), len(vms), state))
+        return results
+
+    def wait_deployments(self, deployments, timeout=3600, poll_interval=10, max_interval=60):
+        '''
+        Purpose:
+                Waits for deployments to succeed, deployments of a resource group are checked
+                together with one deployment listing per poll
+        Arguments:
+                * self - Azure object
+                * deployments - List of (rg_name, deployment_name) tuples
+                * timeout - Seconds to wait for all deployments, default 3600
+                * poll_interval - Seconds between first polls and after any state change, default 10
+                * max_interval - Longest time between polls when nothing changes, default 60
+        Returns:
+                Dictionary of WaitResult (key, status, state, elapsed) by (rg_name, deployment_name),
+                status is 'failed' for Failed or Canceled deployments
+        '''
+
+        def query(batch):
+            return dict((deployment['name'].lower(), deployment['state']) for deployment in self._iter_az_json(
+                ["az", "group", "deployment", "list", "-g", batch[0], "--query",
+                 "[].{name:name, state:properties.provisioningState}"]))
+
+        def check(provisioning_state):
+            if provisioning_state == 'Succeeded':
+                return 'done'
+            if provisioning_state in ('Failed', 'Canceled'):
+                return 'failed'
+            return None
+
+        return self._wait_all(deployments, query, check, timeout, poll_interval, max_interval)
+
+    def wait_blob_copies(self, blobs, timeout=7200, poll_interval=10, max_interval=120):
+        '''
+        Purpose:
+                Waits for server side blob copies to complete, blobs of a container are checked
+                together with one blob listing per poll
+        Arguments:
+                * self - Azure object
+                * blobs - List of (rg_name, storage_name, container_name, blob_name) tuples
+                * timeout - Seconds to wait for all copies, default 7200
+                * poll_interval - Seconds between first polls and after any progress, default 10
+                * max_interval - Longest time between polls when nothing changes, default 120
+        Returns:
+                Dictionary of WaitResult (key, status, state, elapsed) by blob tuple, state is copy
+                status and progress ie 'pending 1024/4096'
+        '''
+        keys = {}
+
+        def query(batch):
+            rg_name, storage_name, container_name = batch
+            if storage_name not in keys:
+                keys[storage_name] = list(self.get_storage_keys(storage_name, rg_name).values())[0]
+            return dict((blob['name'].lower(), "%s %s" %(blob['status'], blob['progress']) if blob['status'] == 'pending'
+                         else blob['status']) for blob in self._iter_az_json(
+                ["az", "storage", "blob", "list", "-c", container_name, "--account-name", storage_name,
+                 "--account-key", keys[storage_name], "--query",
+                 "[].{name:name, status:properties.copy.status, progress:properties.copy.progress}"]))
+
+        def check(copy_state):
+            if copy_state == 'success':
+                return 'done'
+            if copy_state in ('failed', 'aborted'):
+                return 'failed'
+            return None
+
+        return self._wait_all(blobs, query, check, timeout, poll_interval, max_interval)
+
+    def wait_rgs_deleted(self, rg_names, timeout=3600, poll_interval=15, max_interval=60):
+        '''
+        Purpose:
+                Waits for resource groups to be deleted, all groups are checked together with one
+                listing of groups per poll
+        Arguments:
+                * self - Azure object
+                * rg_names - List of resource group names
+                * timeout - Seconds to wait for all groups, default 3600
+                * poll_interval - Seconds between first polls and after any state change, default 15
+                * max_interval - Longest time between polls when nothing changes, default 60
+        Returns:
+                Dictionary of WaitResult (key, status, state, elapsed) by group name, status is
+                'failed' when group is no longer being deleted
+        '''
+
+        def query(batch):
+            return dict((group['name'].lower(), group['state']) for group in self._iter_az_json(
+                ["az", "group", "list", "--query", "[].{name:name, state:properties.provisioningState}"]))
+
+        def check(group_state):
+            if group_state is None:
+                return 'done'
+            #Azure rolls back state of group if deletion fails
+            if group_state != 'Deleting':
+                return 'failed'
+            return None
+
+        results = self._wait_all([(name,) for name in rg_names], query, check, timeout, poll_interval, max_interval)
+        return dict((key[0], result._replace(key=key[0])) for key, result in results.items())
+
+    '''
+    ************************************
+    Azure Cleanup Functions
+    ************************************
+    '''
+
+    def _delete_ids(self, resource_ids, max_workers=10):
+        '''
+        Purpose:
+                Deletes resources by ID concurrently using az resource delete
+        Arguments:
+                * self - Azure object
+                * resource_ids - List of Azure resource IDs to delete
+                * max_workers - Number of deletions run at the same time, default 10
+        Returns:
+                Tuple of list of deleted IDs and dictionary of failed IDs {"id":"error",...}
+        '''
+        deleted = []
+        failed = {}
+        if not resource_ids:
+            return deleted, failed
+
+        def delete(resource_id):
+            self._run(["az", "resource", "delete", "--ids", resource_id])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = dict((pool.submit(delete, resource_id), resource_id) for resource_id in resource_ids)
+            for future in as_completed(futures):
+                resource_id = futures[future]
+                try:
+                    future.result()
+                    log.info("Deleted %s" %resource_id)
+                    deleted.append(resource_id)
+                    self._forget_id(resource_id)
+                except Exception as e:
+                    log.error("Unable to delete %s: %s" %(resource_id, e))
+                    failed[resource_id] = str(e)
+
+        return deleted, failed
+
+    def find_orphans(self, rg_name=None, subscriptions=None):
+        '''
+        Purpose:
+                Finds unattached disks, NICs, public IPs and NSGs by their attachment references
+                (not by name). Public IPs and NSGs only used by orphaned NICs are orphans as well.
+                With a resource group the four resource lists are collected concurrently, without
+                one a single Resource Graph query covers all resource groups
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group to search, default None (all resource groups)
+                * subscriptions - List of subscription IDs to search when no rg_name given, default None
+        Returns:
+                Dictionary of orphaned resource IDs in format {"disks":[...], "nics":[...],
+                "public_ips":[...], "nsgs":[...]}
+        '''
+
+        #Build inventory of the four resource types
+        if rg_name:
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                futures = [pool.submit(list, iterator) for iterator in
+                           (self.iter_disk(rg_name), self.iter_nic(rg_name), self.iter_pip(rg_name),
+                            self.iter_nsg(rg_name))]
+                disks, nics, pips, nsgs = [future.result() for future in futures]
+        else:
+            disks, nics, pips, nsgs = [], [], [], []
+            by_type = {'microsoft.compute/disks': disks,
+                       'microsoft.network/networkinterfaces': nics,
+                       'microsoft.network/publicipaddresses': pips,
+                       'microsoft.network/networksecuritygroups': nsgs}
+            for record in self.iter_resource_graph(resource_types=list(by_type), subscriptions=subscriptions):
+                #Graph records keep attachment fields under properties like ARM does
+                by_type[record.type.lower()].append({'id': record.id, 'properties': record.properties})
+
+        def ref(value):
+            return value.get('id', '').lower() if value else ''
+
+        orphans = {'disks': [], 'nics': [], 'public_ips': [], 'nsgs': []}
+
+        for disk in disks:
+            if _props(disk).get('diskState') == 'Unattached' and not disk.get('managedBy'):
+                orphans['disks'].append(disk['id'])
+
+        orphan_nics = set()
+        for nic in nics:
+            if not _props(nic).get('virtualMachine') and not _props(nic).get('privateEndpoint'):
+                orphans['nics'].append(nic['id'])
+                orphan_nics.add(nic['id'].lower())
+
+        def owned_by_orphan_nic(reference):
+            #IP configuration IDs are children of the NIC ID
+            return reference.split('/ipconfigurations/')[0] in orphan_nics
+
+        for pip in pips:
+            ip_config = ref(_props(pip).get('ipConfiguration'))
+            if _props(pip).get('natGateway'):
+                continue
+            if not ip_config or owned_by_orphan_nic(ip_config):
+                orphans['public_ips'].append(pip['id'])
+
+        for nsg in nsgs:
+            if _props(nsg).get('subnets'):
+                continue
+            if all(ref(nic) in orphan_nics for nic in _props(nsg).get('networkInterfaces') or []):
+                orphans['nsgs'].append(nsg['id'])
+
+        return orphans
+
+    def sweep_orphans(self, rg_name=None, subscriptions=None, dry_run=True, max_workers=10):
+        '''
+        Purpose:
+                Finds orphaned disks, NICs, public IPs and NSGs (see find_orphans) and deletes
+                them concurrently in dependency order - NICs and disks first, then the public IPs
+                and NSGs NICs were holding on to. Default is a dry run that only reports what
+                would be deleted
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group to sweep, default None (all resource groups)
+                * subscriptions - List of subscription IDs to sweep when no rg_name given, default None
+                * dry_run - Only report orphans without deleting them, default True
+                * max_workers - Number of deletions run at the same time, default 10
+        Returns:
+                SweepReport (orphans, deleted, failed, dry_run)
+        '''
+        orphans = self.find_orphans(rg_name, subscriptions)
+
+        for kind in orphans:
+            for resource_id in orphans[kind]:
+                log.info("Orphaned %s: %s" %(kind, resource_id))
+
+        if dry_run:
+            log.info("Dry run - %d orphaned resources found, nothing deleted"
+                     %sum(len(ids) for ids in orphans.values()))
+            return SweepReport(orphans, [], {}, True)
+
+        #NICs hold references to public IPs and NSGs so have to go first
+        deleted, failed = self._delete_ids(orphans['nics'] + orphans['disks'], max_workers)
+        second_deleted, second_failed = self._delete_ids(orphans['public_ips'] + orphans['nsgs'], max_workers)
+        deleted += second_deleted
+        failed.update(second_failed)
+
+        log.info("Sweep deleted %d orphaned resources, %d failed" %(len(deleted), len(failed)))
+        return SweepReport(orphans, deleted, failed, False)
+
+    def teardown_recorded(self, workflow=None, older_than=None, dry_run=False, max_workers=10):
+        '''
+        Purpose:
+                Deletes resources recorded in state store by workflow and/or age without listing
+                anything in Azure. Deletion is planned from recorded data (see StateStore.plan_teardown),
+                each wave is deleted in parallel and recorded resource groups are deleted together
+                at the end
+        Arguments:
+                * self - Azure object
+                * workflow - Only resources created by workflow, default None
+                * older_than - Only resources created more than this many hours ago, default None
+                * dry_run - Only report planned waves without deleting anything, default False
+                * max_workers - Number of deletions run at the same time, default 10
+        Returns:
+                TeardownReport (waves, deleted, failed, dry_run), waves are lists of resource IDs
+        '''
+        assert self.store, "No state store to tear down resources from"
+        assert workflow or older_than is not None, "Provide workflow or older_than to select resources"
+
+        resources = self.store.resources(workflow=workflow, older_than=older_than)
+        waves = self.store.plan_teardown(resources)
+        planned = [[resource.id for resource in wave] for wave in waves]
+        log.info("Teardown of %d recorded resources planned in %d waves" %(len(resources), len(waves)))
+        if dry_run:
+            return TeardownReport(planned, [], {}, True)
+
+        deleted, failed = [], {}
+        for wave in waves:
+            if wave[0].type == 'Microsoft.Resources/resourceGroups':
+                groups = dict((resource.resource_group, resource.id) for resource in wave)
+                for name, result in self.delete_rgs(rg_names=list(groups), max_workers=max_workers).items():
+                    if result.status == 'deleted':
+                        deleted.append(groups[name])
+                    else:
+                        failed[groups[name]] = result.error
+            else:
+                wave_deleted, wave_failed = self._delete_ids([resource.id for resource in wave], max_workers)
+                deleted += wave_deleted
+                failed.update(wave_failed)
+
+        #Resources inside deleted groups and children of deleted parents went with them
+        gone = set(resource_id.lower() for resource_id in deleted)
+        gone_groups = set(_rg_from_id(resource_id).lower() for resource_id in deleted
+                          if _type_from_id(resource_id) == 'Microsoft.Resources/resourceGroups')
+        self.store.mark_deleted(resource.id for resource in resources
+                                if resource.id.lower() in gone or (resource.parent or '').lower() in gone
+                                or (resource.resource_group or '').lower() in gone_groups)
+
+        log.info("Teardown deleted %d resources, %d failed" %(len(deleted), len(failed)))
+        return TeardownReport(planned, deleted, failed, False)
+
+    '''
+    ************************************
+    Azure Idempotent Functions
+    ************************************
+    '''
+
+    def _actual_state(self, kind, rg_name=None, storage_name=None):
+        '''
+        Purpose:
+                Gets actual state of all resources of one kind in a resource group with a single
+                listing and caches it, so ensure functions only read each listing once
+        Arguments:
+                * self - Azure object
+                * kind - One of 'rg', 'vnet', 'route_table', 'storage' or 'container'
+                * rg_name - Resource group of resources, default None (kind 'rg')
+                * storage_name - Storage account of containers, default None
+        Returns:
+                Dictionary of resources by lowercase name
+        '''
+        key = (kind, (rg_name or "").lower(), (storage_name or "").lower())
+        with self._state_lock(kind, rg_name, storage_name):
+            if key not in self._state_cache:
+                if kind == 'rg':
+                    records = jsonlib.loads(self.list_rg(tags={}, json=True))
+                elif kind == 'vnet':
+                    records = jsonlib.loads(self.list_vnet(rg_name, json=True))
+                elif kind == 'route_table':
+                    records = jsonlib.loads(self.show_all_route_tables(rg_name, json=True))
+                elif kind == 'storage':
+                    records = jsonlib.loads(self.list_storage(rg_name, json=True))
+                elif kind == 'container':
+                    records = jsonlib.loads(self.list_storage_container(rg_name, storage_name, json=True))
+                else:
+                    raise ValueError("Unknown kind of resource %s" %kind)
+                self._state_cache[key] = dict((record['name'].lower(), record) for record in records)
+
+            return self._state_cache[key]
+
+    def _state_lock(self, kind, rg_name=None, storage_name=None, name=None):
+        '''
+        Purpose:
+                Gets lock of cached actual state. Without name it is the lock of one kind of
+                resource, held only while its listing is read so threads sharing the object list
+                it once. With name it is the lock of one resource, held while an ensure function
+                checks and changes it so the same resource isn't created twice while different
+                resources are created at the same time
+        Arguments:
+                * self - Azure object
+                * kind - Kind of resource, see _actual_state
+                * rg_name - Resource group of resources, default None
+                * storage_name - Storage account of containers, default None
+                * name - Name of resource, default None (whole kind)
+        Returns:
+                threading.RLock
+        '''
+        key = (kind, (rg_name or "").lower(), (storage_name or "").lower(), (name or "").lower())
+        with self._lock:
+            return self._state_locks.setdefault(key, threading.RLock())
+
+    def invalidate_state(self, kind=None, rg_name=None):
+        '''
+        Purpose:
+                Drops cached actual state used by ensure functions, ie after resources were
+                changed outside of this object
+        Arguments:
+                * self - Azure object
+                * kind - Only drop this kind of resource, default None (all kinds)
+                * rg_name - Only drop resources of this resource group, default None (all groups)
+        '''
+        with self._lock:
+            for key in list(self._state_cache):
+                if (kind is None or key[0] == kind) and (rg_name is None or key[1] == rg_name.lower()):
+                    self._state_cache.pop(key, None)
+
+    def ensure_rg(self, rg_name, location=None):
+        '''
+        Purpose:
+                Creates resource group only if it doesn't exist yet
+        Arguments:
+                * self - Azure object
+                * rg_name - Name of resource group
+                * location - Location for resource group, default None (location of context, else "eastus")
+        Returns:
+                True if resource group was created, False if it already existed
+        '''
+        location = self._location(location)
+        with self._state_lock('rg', name=rg_name):
+            groups = self._actual_state('rg')
+            group = groups.get(rg_name.lower())
+            if group:
+                if group.get('location') != location:
+                    log.warning("Resource group %s is in %s not %s, location cannot be changed"
+                                %(rg_name, group.get('location'), location))
+                return False
+
+            self.create_rg(rg_name, location)
+            groups[rg_name.lower()] = {'name': rg_name, 'location': location}
+            return True
+
+    def ensure_vnet(self, name, rg_name, add_prefix=None, location=None):
+        '''
+        Purpose:
+                Creates vnet if it doesn't exist, or adds address prefix to existing vnet
+                if it doesn't have it yet
+        Arguments:
+                * self - Azure object
+                * name - Azure vnet name
+                * rg_name - Name of resource group
+                * add_prefix - Address prefix vnet should have, default None (Azure default)
+                * location - Location for vnet, default None (location of context, else "eastus")
+        Returns:
+                True if vnet was created or changed, False if nothing had to be done
+        '''
+        location = self._location(location)
+        with self._state_lock('vnet', rg_name, name=name):
+            vnets = self._actual_state('vnet', rg_name)
+            vnet = vnets.get(name.lower())
+            if not vnet:
+                self.create_vnet(name, rg_name, add_prefix, location)
+                #Vnet created without prefix gets the Azure default one
+                vnets[name.lower()] = {'name': name, 'addressSpace': {'addressPrefixes': [add_prefix or "10.0.0.0/16"]},
+                                       'subnets': []}
+                return True
+
+            prefixes = (_props(vnet).get('addressSpace') or {}).get('addressPrefixes') or []
+            if not add_prefix or add_prefix in prefixes:
+                return False
+
+            try:
+                self._run(["az", "network", "vnet", "update", "-g", rg_name, "-n", name, "--address-prefixes"]
+                          + prefixes + [add_prefix])
+            except Exception as e:
+                log.error("Unable to update vnet %s: %s" %(name, e))
+                raise
+            prefixes.append(add_prefix)
+            return True
+
+    def ensure_subnet(self, name, rg_name, vnet_name, address_prefix, route_table=None):
+        '''
+        Purpose:
+                Creates subnet if it doesn't exist in vnet, or updates its address prefix and
+                route table if they differ. Vnet has to exist already
+        Arguments:
+                * self - Azure object
+                * name - Azure subnet name
+                * rg_name - Name of resource group
+                * vnet_name - Name of vnet
+                * address_prefix - Subnet prefix
+                * route_table - Optional Route-table subnet should be associated with, default None
+        Returns:
+                True if subnet was created or changed, False if nothing had to be done
+        '''
+        with self._state_lock('vnet', rg_name, name=vnet_name):
+            vnet = self._actual_state('vnet', rg_name).get(vnet_name.lower())
+            assert vnet, "Vnet %s does not exist in resource group %s" %(vnet_name, rg_name)
+            subnets = _props(vnet).setdefault('subnets', [])
+            subnet = next((s for s in subnets if s['name'].lower() == name.lower()), None)
+
+            if not subnet:
+                self.add_vnet_subnet(name, rg_name, vnet_name, address_prefix, route_table)
+            else:
+                properties = _props(subnet)
+                prefixes = properties.get('addressPrefixes') or [properties.get('addressPrefix')]
+                current_table = ((properties.get('routeTable') or {}).get('id') or "").rsplit('/', 1)[-1]
+                if address_prefix in prefixes and (not route_table or current_table.lower() == route_table.lower()):
+                    return False
+
+                cmd = ["az", "network", "vnet", "subnet", "update", "-g", rg_name, "-n", name,
+                       "--vnet-name", vnet_name, "--address-prefix", address_prefix]
+                if route_table:
+                    cmd += ["--route-table", route_table]
+                try:
+                    self._run(cmd)
+                except Exception as e:
+                    log.error("Unable to update subnet %s: %s" %(name, e))
+                    raise
+                subnets.remove(subnet)
+
+            subnets.append({'name': name, 'addressPrefix': address_prefix,
+                            'routeTable': {'id': route_table} if route_table else None})
+            return True
+
+    def ensure_route_table(self, rg_name, route_table):
+        '''
+        Purpose:
+                Creates route table only if it doesn't exist yet
+        Arguments:
+                * self - Azure object
+                * rg_name - Resource group route-table is associated with
+                * route_table - Route-table name
+        Returns:
+                True if route table was created, False if it already existed
+        '''
+        with self._state_lock('route_table', rg_name, name=route_table):
+            tables = self._actual_state('route_table', rg_name)
+            if route_table.lower() in tables:
+                return False
+
+            self.add_route_table(rg_name, route_table)
+            tables[route_table.lower()] = {'name': route_table, 'routes': []}
+            return True
+
+    def ensure_storage(self, name, rg_name, location=None, sku="Standard_LRS"):
+        '''
+        Purpose:
+                Creates storage account if it doesn't exist, or changes its SKU if it differs
+        Arguments:
+                * self - Azure object
+                * name - Azure storage account name
+                * rg_name - Name of resource group
+                * location - Location for storage account, default None (location of context, else "eastus")
+                * sku - Storage Account SKU, default Standard_LRS
+        Returns:
+                True if storage account was created or changed, False if nothing had to be done
+        '''
+        location = self._location(location)
+        with self._state_lock('storage', rg_name, name=name):
+            accounts = self._actual_state('storage', rg_name)
+            account = accounts.get(name.lower())
+            if not account:
+                self.create_storage(name, rg_name, location, sku)
+                accounts[name.lower()] = {'name': name, 'location': location, 'sku': {'name': sku}}
+                return True
+
+            if (account.get('sku') or {}).get('name') == sku:
+                return False
+
+            try:
+                self._run(["az", "storage", "account", "update", "-g", rg_name, "-n", name, "--sku", sku])
+            except Exception as e:
+                log.error("Unable to update storage %s: %s" %(name, e))
+                raise
+            account['sku'] = {'name': sku}
+            return True
+
+    def ensure_storage_container(self, name, rg_name, storage_name):
+        '''
+        Purpose:
+                Creates storage container only if it doesn't exist yet
+        Arguments:
+                * self - Azure object
+                * name - Name of container
+                * rg_name - Name of Resource Group associated with storage
+                * storage_name - Name of Storage account
+        Returns:
+                True if container was created, False if it already existed
+        '''
+        with self._state_lock('container', rg_name, storage_name, name):
+            containers = self._actual_state('container', rg_name, storage_name)
+            if name.lower() in containers:
+                return False
+
+            created = self.create_storage_container(name, rg_name, storage_name)
+            assert created, "Unable to create storage container %s in %s" %(name, storage_name)
+            containers[name.lower()] = {'name': name}
+            return True
+
+
+class AzureRestError(Exception):
+    '''
+    Error response from Azure Resource Manager REST API
+
+    Initial Arguments:
+            * status: HTTP status code
+            * code: ARM error code ie ResourceGroupNotFound
+            * message: ARM error message
+    '''
+
+    def __init__(self, status, code, message):
+        super(AzureRestError, self).__init__("%s %s: %s" %(status, code, message))
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+def _retry_after(headers, default):
+    '''Seconds to wait given by Retry-After header as seconds or HTTP date, default if missing or unreadable'''
+    value = headers.get('retry-after')
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return default
+
+class _HttpPool():
+    '''
+    Pool of keep-alive HTTP(S) connections to a single host, safe to share between threads
+
+    Initial Arguments:
+            * url: URL of host ie https://management.azure.com
+            * size: Number of idle connections kept open, default 10
+            * timeout: Socket timeout in seconds, default 60
+    '''
+
+    def __init__(self, url, size=10, timeout=60):
+        '''Pool __init__ only records host, connections are opened when first needed'''
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        '''
+        Purpose:
+                Sends request on an idle connection (or a new one) and reads the whole response,
+                a connection closed by the server while idle is replaced once
+        Arguments:
+                * self - Pool object
+                * method - HTTP method
+                * path - Path and query string of request
+                * body - Request body as bytes, default None
+                * headers - Dictionary of request headers, default None
+        Returns:
+                Tuple of status, dictionary of lowercase response headers and body as bytes
+        '''
+        try:
+            conn, reused = self._idle.get_nowait(), True
+        except queue.Empty:
+            conn, reused = self._connect(), False
+
+        while True:
+            try:
+                conn.request(method, path, body, headers or {})
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError) as e:
+                conn.close()
+                if not reused:
+                    raise
+                #Idle connection dropped by server - retry once on a fresh one
+                log.debug("Reconnecting to %s: %s" %(self.host, e))
+                conn, reused = self._connect(), False
+            except BaseException:
+                #Timeout or anything else leaves connection in unknown state, never reuse it
+                conn.close()
+                raise
+
+        if response.will_close or self._idle.qsize() >= self.size:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+        return response.status, dict((k.lower(), v) for k, v in response.getheaders()), data
+
+    def close(self):
+        '''Closes all idle connections'''
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class AzureARM(AzureCLI):
+    '''
+    Alternative AzureCLI backend which talks to Azure Resource Manager over REST for the core
+    operations on resource groups, vnets, subnets, route tables, NICs, NSGs, public IPs, disks,
+    storage accounts and VMs, instead of starting az for every call. Requests share a pool of
+    keep-alive HTTPS connections and a cached bearer token, long running operations are polled
+    until they finish. Operations not implemented here still use the Azure CLI. Show and list
+    functions always return JSON, there is no table output over REST.
+
+    Initial Arguments:
+            * appid, dirid, key, username, pw, cassette: see AzureCLI. With Application-ID,
+              Directory-ID and Auth-Key the token is requested directly, otherwise it is
+              taken from the Azure CLI login (az account get-access-token)
+            * subscription: Subscription ID to work in, default None (from Azure CLI account)
+            * token: Bearer token to use instead of requesting one ie for a stub server, default None
+            * endpoint: Resource Manager URL, default https://management.azure.com
+            * authority: Azure AD URL used to request tokens, default https://login.microsoftonline.com
+            * pool_size: Number of keep-alive connections kept open, default 10
+            * poll_interval: Default seconds between polls of long running operations, default 5
+            * lro_timeout: Seconds to wait for a long running operation, default 3600
+            * store: see AzureCLI, resources created by PUT are recorded as well
+            * config_dir: see AzureCLI, used when logging in with Username and Password
+            * timeout, timeouts: see AzureCLI, limit az commands only, requests stop at deadline of scope
+    '''
+
+    API_VERSIONS = {'resourcegroups': '2021-04-01',
+                    'resources': '2021-04-01',
+                    'Microsoft.Network': '2023-05-01',
+                    'Microsoft.Compute': '2023-03-01',
+                    'Microsoft.Compute/disks': '2023-04-02',
+                    'Microsoft.Storage': '2023-01-01',
+                    'Microsoft.Insights': '2015-04-01'}
+
+    def __init__(self, appid=None, dirid=None, key=None, username=None, pw=None, cassette=None,
+                 subscription=None, token=None, endpoint="https://management.azure.com",
+                 authority="https://login.microsoftonline.com", pool_size=10, poll_interval=5,
+                 lro_timeout=3600, store=None, config_dir=None, timeout=None, timeouts=None):
+        '''Azure REST __init__ sets up connection pools, no connection is made until first call'''
+        if token:
+            #Static token - credentials not needed
+            appid, dirid, key = appid or "token", dirid or "token", key or "token"
+        super(AzureARM, self).__init__(appid, dirid, key, username, pw, cassette, store, config_dir, timeout,
+                                       timeouts)
+
+        self.subscription = subscription
+        self.endpoint = endpoint.rstrip('/')
+        self.authority = authority.rstrip('/')
+        self.poll_interval = poll_interval
+        self.lro_timeout = lro_timeout
+        self._static_token = token
+        self._token = token
+        self._token_expires = float('inf') if token else 0
+        self._token_lock = threading.Lock()
+        self._pool = _HttpPool(self.endpoint, pool_size)
+        self._rg_locations = {}
+
+    '''
+    ************************************
+    Azure REST Connectivity Functions
+    ************************************
+    '''
+
+    def _login(self):
+        '''
+        Purpose:
+                Gets bearer token for Resource Manager. With Application-ID, Directory-ID and
+                Auth-Key no Azure CLI login is needed, with Username and Password logs into the
+                Azure CLI first and uses its token. Called once by login_azure_cli
+        Arguments:
+                * self - Azure object
+        '''
+        if not self._static_token and not getattr(self, 'appid', None):
+            super(AzureARM, self)._login()
+
+        self._get_token()
+        log.info("Logged into Azure Resource Manager")
+        self.is_logged_in = True
+
+    def disconnect_azure(self):
+        '''
+        Purpose:
+                Drops cached token and closes pooled connections, logs out of Azure CLI if
+                it was used to login
+        Arguments:
+                * self - Azure object
+        '''
+        with self._login_lock:
+            with self._token_lock:
+                self._token = self._static_token
+                self._token_expires = float('inf') if self._static_token else 0
+            self._pool.close()
+            if not self._static_token and not getattr(self, 'appid', None):
+                super(AzureARM, self).disconnect_azure()
+            self.is_logged_in = False
+
+    def context(self, subscription=None, location=None, rg_name=None):
+        '''See AzureCLI.context, token and connection pool are shared'''
+        scoped = super(AzureARM, self).context(subscription, location, rg_name)
+        scoped._rg_locations = {}
+        return scoped
+
+    def _get_token(self):
+        '''
+        Purpose:
+                Returns cached bearer token, requesting a new one when it is about to expire
+        Arguments:
+                * self - Azure object
+        Returns:
+                Bearer token as string
+        '''
+        with self._token_lock:
+            #Refresh 5 minutes before expiry
+            if self._token and time.time() < self._token_expires - 300:
+                return self._token
+
+            if getattr(self, 'appid', None):
+                authority = _HttpPool(self.authority, 1)
+                body = urlencode({'grant_type': 'client_credentials', 'client_id': self.appid,
+                                  'client_secret': self.key,
+                                  'resource': 'https://management.core.windows.net/'}).encode('utf-8')
+                status, headers, data = authority.request(
+                    "POST", "/%s/oauth2/token" %self.dirid, body,
+                    {'Content-Type': 'application/x-www-form-urlencoded'})
+                authority.close()
+                token = jsonlib.loads(data.decode('utf-8') or "{}")
+                if status != 200:
+                    log.error("Unable to get token for App-ID %s: %s" %(self.appid, data))
+                    raise AzureRestError(status, token.get('error'), token.get('error_description'))
+                self._token = token['access_token']
+                self._token_expires = float(token['expires_on'])
+            else:
+                out = self._run(["az", "account", "get-access-token", "--resource",
+                                 "https://management.core.windows.net/"])
+                token = jsonlib.loads(out.decode('utf-8'))
+                self._token = token['accessToken']
+                if token.get('expires_on'):
+                    self._token_expires = float(token['expires_on'])
+                else:
+                    self._token_expires = time.mktime(time.strptime(token['expiresOn'][:19], "%Y-%m-%d %H:%M:%S"))
+                if not self.subscription:
+                    self.subscription = token.get('subscription')
+
+            return self._token
+
+    def _request(self, method, path, body=None, api_version=None):
+        '''
+        Purpose:
+                Sends one request to Resource Manager, retrying throttled and server busy
+                responses after the delay Azure asks for
+        Arguments:
+                * self - Azure object
+                * method - HTTP method
+                * path - Resource path or full URL (ie nextLink or operation URL)
+                * body - Request body as dictionary, default None
+                * api_version - API version added to path if it doesn't have one, default None
+        Returns:
+                Tuple of status, dictionary of lowercase headers and decoded JSON body
+        '''
+        if path.startswith('http'):
+            parts = urlsplit(path)
+            path = parts.path + ("?" + parts.query if parts.query else "")
+        if api_version and 'api-version=' not in path:
+            path += ("&" if "?" in path else "?") + "api-version=" + api_version
+
+        data = jsonlib.dumps(body).encode('utf-8') if body is not None else None
+        start_time = time.time()
+        for attempt in range(5):
+            self.cancel_token.check("%s %s" %(method, path.split('?')[0]), start_time)
+            headers = {'Authorization': 'Bearer %s' %self._get_token(),
+                       'Content-Type': 'application/json'}
+            status, response_headers, response = self._pool.request(method, path, data, headers)
+            if status not in (429, 500, 502, 503, 504) or attempt == 4:
+                break
+            delay = _retry_after(response_headers, 2 ** attempt)
+            log.info("Resource Manager returned %s for %s %s, retrying in %s seconds" %(status, method, path, delay))
+            self.cancel_token.sleep(delay)
+
+        result = jsonlib.loads(response.decode('utf-8')) if response.strip() else None
+        if status >= 400:
+            error = (result or {}).get('error') or {}
+            raise AzureRestError(status, error.get('code'), error.get('message', response.decode('utf-8', 'replace')))
+        return status, response_headers, result
+
+    def _wait_operation(self, status, headers, result, path, api_version):
+        '''
+        Purpose:
+                Polls long running operation until it has finished using the
+                Azure-AsyncOperation or Location header, or provisioningState of the resource
+        Arguments:
+                * self - Azure object
+                * status - Status of request starting the operation
+                * headers - Headers of request starting the operation
+                * result - Body of request starting the operation
+                * path - Path of resource the operation is working on
+                * api_version - API version of resource
+        Returns:
+                Final resource or operation result as dictionary
+        '''
+        start = time.time()
+
+        def wait(headers, state=None):
+            if time.time() - start > self.lro_timeout:
+                raise AzureRestError(408, 'OperationTimeout', "Operation on %s not finished after %s seconds"
+                                     %(path, self.lro_timeout))
+            self.cancel_token.check("Operation on %s" %path, start, state)
+            self.cancel_token.sleep(_retry_after(headers, self.poll_interval))
+            self.cancel_token.check("Operation on %s" %path, start, state)
+
+        if headers.get('azure-asyncoperation'):
+            operation_url = headers['azure-asyncoperation']
+            operation = result
+            while True:
+                wait(headers, operation)
+                _, headers, operation = self._request("GET", operation_url)
+                state = (operation or {}).get('status', '')
+                if state.lower() == 'succeeded':
+                    break
+                if state.lower() in ('failed', 'canceled', 'cancelled'):
+                    error = operation.get('error') or {}
+                    raise AzureRestError(status, error.get('code', state), error.get('message', "Operation %s" %state))
+            if result is not None:
+                _, _, result = self._request("GET", path, api_version=api_version)
+            return result
+
+        if status == 202 and headers.get('location'):
+            location = headers['location']
+            while True:
+                wait(headers, result)
+                status, headers, result = self._request("GET", location)
+                if status != 202:
+                    return result
+
+        #Operation reported through provisioningState of resource
+        while result and (result.get('properties') or {}).get('provisioningState') not in \
+                (None, 'Succeeded', 'Failed', 'Canceled'):
+            wait(headers, result)
+            _, headers, result = self._request("GET", path, api_version=api_version)
+        if result and (result.get('properties') or {}).get('provisioningState') in ('Failed', 'Canceled'):
+            raise AzureRestError(status, 'Provisioning' + result['properties']['provisioningState'],
+                                 "Provisioning of %s %s" %(path, result['properties']['provisioningState']))
+        return result
+
+    def _api_version(self, path):
+        '''Picks API version for resource path from its provider'''
+        if '/providers/' not in path:
+            return self.API_VERSIONS['resources' if path.endswith('/resources') else 'resourcegroups']
+        provider = path.split('/providers/')[-1]
+        for prefix in sorted(self.API_VERSIONS, key=len, reverse=True):
+            if provider.lower().startswith(prefix.lower()):
+                return self.API_VERSIONS[prefix]
+        raise ValueError("No API version known for %s" %path)
+
+    def arm_get(self, path):
+        '''
+        Purpose:
+                Gets resource from Resource Manager
+        Arguments:
+                * self - Azure object
+                * path - Resource path ie /subscriptions/.../resourceGroups/rg
+        Returns:
+                Resource as dictionary
+        '''
+        return self._request("GET", path, api_version=self._api_version(path))[2]
+
+    def arm_list(self, path):
+        '''
+        Purpose:
+                Lists resources from Resource Manager following nextLink pages
+        Arguments:
+                * self - Azure object
+                * path - Collection path ie /subscriptions/.../resourceGroups/rg/providers/Microsoft.Network/virtualNetworks
+        Returns:
+                List of resources as dictionaries
+        '''
+        api_version = self._api_version(path)
+        values = []
+        while path:
+            page = self._request("GET", path, api_version=api_version)[2] or {}
+            values.extend(page.get('value', []))
+            path = page.get('nextLink')
+        return values
+
+    def arm_put(self, path, body, wait=True):
+        '''
+        Purpose:
+                Creates or updates resource and waits for it to be provisioned
+        Arguments:
+                * self - Azure object
+                * path - Resource path
+                * body - Resource as dictionary
+                * wait - Wait for long running operation to finish, default True
+        Returns:
+                Resource as dictionary
+        '''
+        api_version = self._api_version(path)
+        status, headers, result = self._request("PUT", path, body, api_version)
+        if self.store:
+            self.store.record_output(result)
+        if not wait:
+            return result
+        return self._wait_operation(status, headers, result, path, api_version)
+
+    def arm_delete(self, path, wait=True):
+        '''
+        Purpose:
+                Deletes resource and waits for deletion to finish
+        Arguments:
+                * self - Azure object
+                * path - Resource path
+                * wait - Wait for long running operation to finish, default True
+        '''
+        api_version = self._api_version(path)
+        status, headers, result = self._request("DELETE", path, api_version=api_version)
+        if wait and status in (201, 202):
+            self._wait_operation(status, headers, None, path, api_version)
+        if wait:
+            self._forget_id(path)
+
+    def arm_post(self, path, body=None):
+        '''
+        Purpose:
+                Runs action on resource ie listKeys
+        Arguments:
+                * self - Azure object
+                * path - Resource action path
+                * body - Request body as dictionary, default None
+        Returns:
+                Result of action as dictionary
+        '''
+        api_version = self._api_version(path)
+        status, headers, result = self._request("POST", path, body, api_version)
+        if status == 202:
+            result = self._wait_operation(status, headers, None, path, api_version)
+        return result
+
+    def _sub_path(self):
+        '''Path of subscription, looked up from Azure CLI account when not given'''
+        if not self.subscription:
+            self._get_token()
+            if not self.subscription:
+                out = self._run(["az", "account", "show", "--query", "id", "-o", "tsv"])
+                self.subscription = out.decode('utf-8').strip()
+        return "/subscriptions/%s" %self.subscription
+
+    def _rg_path(self, rg_name):
+        return "%s/resourceGroups/%s" %(self._sub_path(), quote(rg_name, safe=''))
+
+    def _path(self, rg_name, resource_type, *names):
+        '''Builds resource path ie _path(rg, 'Microsoft.Network/virtualNetworks', vnet, 'subnets', subnet)'''
+        path = "%s/providers/%s" %(self._rg_path(rg_name), resource_type)
+        for name in names:
+            path += "/" + quote(name, safe='')
+        return path
+
+    def _rg_location(self, rg_name):
+        '''Location of resource group, cached as it cannot change'''
+        if rg_name not in self._rg_locations:
+            self._rg_locations[rg_name] = self.arm_get(self._rg_path(rg_name))['location']
+        return self._rg_locations[rg_name]
+
+    def _dumps(self, value, json=True, fields=None, query=None):
+        '''
+        Output of REST list and show functions - fields and query are applied locally to records
+        with properties lifted like in Azure CLI output, output is tsv if they are given without json
+        '''
+        if fields or query:
+            many = isinstance(value, list)
+            records = [_flatten(record) for record in value] if many else _flatten(value)
+            if query:
+                if not jmespath:
+                    raise ImportError("jmespath is needed to run queries over REST, install it with pip")
+                value = jmespath.search(query, records)
+            else:
+                value = _select_fields(records, fields, many)
+            if not json:
+                return _tsv(value)
+        out = jsonlib.dumps(value, indent=2)
+        #Check data isn't empty
+        assert not out.isspace(), "No information collected"
+        return out
+
+    '''
+    ************************************
+    Azure REST Resource Group Functions
+    ************************************
+    '''
+
+    def create_rg(self, rg_name, location=None):
+        '''See AzureCLI.create_rg'''
+        location = self._location(location)
         try:
-            #Try to create storage account
-            check_output("az storage container delete -n %s --account-name %s --account-key %s"
-                         %(name, storage_name, key), shell=True)
+            self.arm_put(self._rg_path(rg_name), {'location': location})
         except Exception as e:
-            log.error("Unable to delete storage container %s: %s" %(name, e))
+            log.error("Unable to create rg %s: %s" %(rg_name, e))
+            raise
+
+    def delete_rg(self, rg_name, no_wait=False):
+        '''See AzureCLI.delete_rg'''
+        try:
+            self.arm_delete(self._rg_path(rg_name), wait=not no_wait)
+        except Exception as e:
+            log.error("Unable to delete rg %s: %s" %(rg_name, e))
+            raise
+
+    def list_rg(self, tags={'location':'eastus'}, json=False, fields=None, query=None):
+        '''See AzureCLI.list_rg'''
+        groups = self.arm_list("%s/resourcegroups" %self._sub_path())
+        #Same property filters as the JMESPath query used by Azure CLI version
+        groups = [group for group in groups if all(str(group.get(tag)) == str(tags[tag]) for tag in tags)]
+        return self._dumps(groups, json, fields, query)
+
+    def show_rg(self, rg_name, json=False, fields=None, query=None):
+        '''See AzureCLI.show_rg'''
+        return self._dumps(self.arm_get(self._rg_path(rg_name)), json, fields, query)
+
+    def list_resources(self, rg_name, json=False, fields=None, query=None):
+        '''See AzureCLI.list_resources'''
+        return self._dumps(self.arm_list("%s/resources" %self._rg_path(rg_name)), json, fields, query)
+
+    '''
+    ************************************
+    Azure REST VNET Functions
+    ************************************
+    '''
 
-    def upload_vhd_to_container(self, container_name, storage_name, rg_name, file_path):
+    def create_vnet(self, name, rg_name, add_prefix=None, location=None, subnet_name=None, subnet_prefix=None):
+        '''See AzureCLI.create_vnet'''
+        location = self._location(location)
+        #Same default address space as Azure CLI
+        vnet = {'location': location,
+                'properties': {'addressSpace': {'addressPrefixes': [add_prefix or "10.0.0.0/16"]}}}
+        if add_prefix and subnet_prefix and subnet_name:
+            vnet['properties']['subnets'] = [{'name': subnet_name, 'properties': {'addressPrefix': subnet_prefix}}]
+
+        try:
+            self.arm_put(self._path(rg_name, 'Microsoft.Network/virtualNetworks', name), vnet)
+        except Exception as e:
+            log.error("Unable to create vnet %s: %s" %(rg_name, e))
+            raise
+
+    def delete_vnet(self, name, rg_name):
+        '''See AzureCLI.delete_vnet'''
+        try:
+            self.arm_delete(self._path(rg_name, 'Microsoft.Network/virtualNetworks', name))
+        except Exception as e:
+            log.error("Unable to delete vnet %s: %s" %(name, e))
+            raise
+
+    def list_vnet(self, rg_name, json=False, fields=None, query=None):
+        '''See AzureCLI.list_vnet'''
+        return self._dumps(self.arm_list(self._path(rg_name, 'Microsoft.Network/virtualNetworks')),
+                           json, fields, query)
+
+    def show_vnet(self, name, rg_name, json=False, fields=None, query=None):
+        '''See AzureCLI.show_vnet'''
+        return self._dumps(self.arm_get(self._path(rg_name, 'Microsoft.Network/virtualNetworks', name)),
+                           json, fields, query)
+
+    def add_vnet_subnet(self, name, rg_name, vnet_name, address_prefix, route_table=None):
+        '''See AzureCLI.add_vnet_subnet'''
+        subnet = {'properties': {'addressPrefix': address_prefix}}
+        if route_table:
+            subnet['properties']['routeTable'] = {'id': self._path(rg_name, 'Microsoft.Network/routeTables', route_table)}
+
+        try:
+            self.arm_put(self._path(rg_name, 'Microsoft.Network/virtualNetworks', vnet_name, 'subnets', name), subnet)
+        except Exception as e:
+            log.error("Unable to create vnet subnet %s: %s" %(name, e))
+            raise
+
+    def delete_vnet_subnet(self, name, rg_name, vnet_name):
+        '''See AzureCLI.delete_vnet_subnet'''
+        try:
+            self.arm_delete(self._path(rg_name, 'Microsoft.Network/virtualNetworks', vnet_name, 'subnets', name))
+        except Exception as e:
+            log.error("Unable to delete subnet %s: %s" %(name, e))
+            raise
+
+    def list_vnet_subnets(self, name, rg_name, json=False, fields=None, query=None):
+        '''See AzureCLI.list_vnet_subnets'''
+        return self._dumps(self.arm_list(self._path(rg_name, 'Microsoft.Network/virtualNetworks', name, 'subnets')),
+                           json, fields, query)
+
+    def show_vnet_subnet(self, name, rg_name, vnet_name, json=False, fields=None, query=None):
+        '''See AzureCLI.show_vnet_subnet'''
+        return self._dumps(self.arm_get(self._path(rg_name, 'Microsoft.Network/virtualNetworks', vnet_name,
+                                                   'subnets', name)), json, fields, query)
+
+    '''
+    ************************************
+    Azure REST VM Functions
+    ************************************
+    '''
+
+    def deploy_linux(self, name, rg_name, vnet_name, subnet_name, username="automation-admin", pw="Cisco-123123"):
         '''
         Purpose:
-                Uploads VHD file to existing container, Checks container exists
-                then gets storage key, will use first key found. Then creates a blob named 
-                after file (or just blob.vhd if error) to be uploaded which then will contain the file.
+                Creates basic linux VM the same way az vm create does - public IP, NSG allowing
+                SSH and NIC named after VM, Ubuntu LTS image with managed OS disk
         Arguments:
                 * self - Azure object
-                * container_name - Name of container for file to be uploaded to
-                * storage_name - Name of Storage account 
-                * rg_name - Name of Resource Group associated with storage
-                * file_path - path of file to upload - has to be accesible by Kick
+                * name - Name of Linux VM
+                * rg_name - Name of resource group associated with Linux VM
+                * vnet_name - Name of Vnet
+                * subnet_name - Name of subnet in Vnet
+                * username - Username of VM defaul = automation-admin
+                * pw - Password of VM deault = Cisco-123123
+        Returns:
+                Output from successful deployment - Includes public and private IP addreses in dictionary
         '''
+        location = self._rg_location(rg_name)
+        try:
+            pip = self.arm_put(self._path(rg_name, 'Microsoft.Network/publicIPAddresses', name + "PublicIP"),
+                               {'location': location, 'sku': {'name': 'Standard'},
+                                'properties': {'publicIPAllocationMethod': 'Static'}})
+            nsg = self.arm_put(self._path(rg_name, 'Microsoft.Network/networkSecurityGroups', name + "NSG"),
+                               {'location': location, 'properties': {'securityRules': [
+                                   {'name': 'default-allow-ssh',
+                                    'properties': {'priority': 1000, 'protocol': 'Tcp', 'access': 'Allow',
+                                                   'direction': 'Inbound', 'sourceAddressPrefix': '*',
+                                                   'sourcePortRange': '*', 'destinationAddressPrefix': '*',
+                                                   'destinationPortRange': '22'}}]}})
+            subnet_id = self._path(rg_name, 'Microsoft.Network/virtualNetworks', vnet_name, 'subnets', subnet_name)
+            nic = self.arm_put(self._path(rg_name, 'Microsoft.Network/networkInterfaces', name + "VMNic"),
+                               {'location': location, 'properties': {
+                                   'networkSecurityGroup': {'id': nsg['id']},
+                                   'ipConfigurations': [{'name': 'ipconfig' + name, 'properties': {
+                                       'subnet': {'id': subnet_id},
+                                       'privateIPAllocationMethod': 'Dynamic',
+                                       'publicIPAddress': {'id': pip['id']}}}]}})
+            vm_path = self._path(rg_name, 'Microsoft.Compute/virtualMachines', name)
+            vm = self.arm_put(vm_path, {'location': location, 'properties': {
+                'hardwareProfile': {'vmSize': 'Standard_DS1_v2'},
+                'storageProfile': {'imageReference': {'publisher': 'Canonical', 'offer': 'UbuntuServer',
+                                                      'sku': '18.04-LTS', 'version': 'latest'},
+                                   'osDisk': {'createOption': 'FromImage'}},
+                'osProfile': {'computerName': name, 'adminUsername': username, 'adminPassword': pw,
+                              'linuxConfiguration': {'disablePasswordAuthentication': False}},
+                'networkProfile': {'networkInterfaces': [{'id': nic['id']}]}}})
+
+            #OS disk is made by ARM along with VM, only its ID in VM tells it exists
+            os_disk = (_props(vm or {}).get('storageProfile') or {}).get('osDisk') or {}
+            disk_id = (os_disk.get('managedDisk') or {}).get('id')
+            if self.store and disk_id:
+                self.store.record(disk_id)
+
+            view = self._request("GET", vm_path + "/instanceView", api_version=self._api_version(vm_path))[2]
+            pip = self.arm_get(self._path(rg_name, 'Microsoft.Network/publicIPAddresses', name + "PublicIP"))
+        except Exception as e:
+            log.error("Unable to deploy Linux: %s" %( e))
+            raise
 
-        #Check container exists
-        assert container_name in self.list_storage_container(rg_name,storage_name), \
-               "Container %s does not currently exist, please create first" %container_name
+        power = [status['displayStatus'] for status in view.get('statuses', [])
+                 if status.get('code', '').startswith('PowerState/')]
+        out = self._dumps({'id': vm_path, 'location': location, 'resourceGroup': rg_name,
+                           'powerState': power[0] if power else "",
+                           'privateIpAddress': nic['properties']['ipConfigurations'][0]['properties'].get('privateIPAddress'),
+                           'publicIpAddress': pip['properties'].get('ipAddress')})
 
-        #Get key information from storage
-        keys = self.get_storage_keys(storage_name, rg_name)
-        #Get abritray key from list
-        key = list(keys.values())[0]
+        #Confirm VM running is seen in output
+        assert  "VM running" in out, "Linux Deployment not sucessful: %s" %out
+        return out
 
-        #Extract blob name from path - will be file name 
-        m = re.search(r'^.*[\/\\](.*)', file_path)
-        if not m:
-            #Unable to extract name - just call it blob.vhd
-            blob_name = "blob.vhd"
-        else:
-            blob_name = m.group(1).strip()
+    def delete_vm(self, name, rg_name):
+        '''See AzureCLI.delete_vm'''
+        try:
+            self.arm_delete(self._path(rg_name, 'Microsoft.Compute/virtualMachines', name))
+        except Exception as e:
+            log.error("Unable to delete VM %s: %s" %(name, e))
+            raise
+
+    def list_vm(self, rg_name, json=False, fields=None, query=None):
+        '''See AzureCLI.list_vm'''
+        return self._dumps(self.arm_list(self._path(rg_name, 'Microsoft.Compute/virtualMachines')),
+                           json, fields, query)
+
+    '''
+    ************************************
+    Azure REST Route-Table and Route Functions
+    ************************************
+    '''
+
+    def show_all_route_tables(self, rg_name, json=False, fields=None, query=None):
+        '''See AzureCLI.show_all_route_tables'''
+        return self._dumps(self.arm_list(self._path(rg_name, 'Microsoft.Network/routeTables')),
+                           json, fields, query)
+
+    def show_route_table(self, rg_name, route_table, json=False, fields=None, query=None):
+        '''See AzureCLI.show_route_table'''
+        return self._dumps(self.arm_get(self._path(rg_name, 'Microsoft.Network/routeTables', route_table)),
+                           json, fields, query)
 
+    def show_routes(self, rg_name, route_table, json=False, fields=None, query=None):
+        '''See AzureCLI.show_routes'''
+        return self._dumps(self.arm_list(self._path(rg_name, 'Microsoft.Network/routeTables', route_table, 'routes')),
+                           json, fields, query)
+
+    def add_route_table(self, rg_name, route_table):
+        '''See AzureCLI.add_route_table'''
         try:
-            #Try to upload file
-            check_output("az storage blob upload  -n %s -c %s --account-name %s --account-key %s -f %s -t page"
-                         %(blob_name, container_name, storage_name, key, file_path), shell=True)
+            self.arm_put(self._path(rg_name, 'Microsoft.Network/routeTables', route_table),
+                         {'location': self._rg_location(rg_name)})
         except Exception as e:
-            log.error("Unable to upload file %s: %s" %(file_path, e))
-       
+            log.error("Unable to add route-table %s: %s" %(route_table,e))
+            raise
+
+    def delete_route_table(self, rg_name, route_table):
+        '''See AzureCLI.delete_route_table'''
+        try:
+            self.arm_delete(self._path(rg_name, 'Microsoft.Network/routeTables', route_table))
+        except Exception as e:
+            log.error("Unable to delete route-table %s: %s" %(route_table,e))
+            raise
+
+    def add_route(self, rg_name, route_table, route, prefix, next_hop_add, next_hop_type="VirtualAppliance"):
+        '''See AzureCLI.add_route'''
+        properties = {'addressPrefix': prefix, 'nextHopType': next_hop_type}
+        if next_hop_add:
+            properties['nextHopIpAddress'] = next_hop_add
+
+        try:
+            self.arm_put(self._path(rg_name, 'Microsoft.Network/routeTables', route_table, 'routes', route),
+                         {'properties': properties})
+        except Exception as e:
+            log.error("Unable to add route %s: %s" %(route,e))
+            raise
+
+    def delete_route(self, rg_name, route_table, route):
+        '''See AzureCLI.delete_route'''
+        try:
+            self.arm_delete(self._path(rg_name, 'Microsoft.Network/routeTables', route_table, 'routes', route))
+        except Exception as e:
+            log.error("Unable to delete route %s: %s" %(route,e))
+            raise
+
+    def replace_routes(self, rg_name, route_table, routes):
+        '''See AzureCLI.replace_routes'''
+        path = self._path(rg_name, 'Microsoft.Network/routeTables', route_table)
+        try:
+            table = self.arm_get(path)
+            table['properties']['routes'] = []
+            for route in routes:
+                properties = {'addressPrefix': route.prefix, 'nextHopType': route.next_hop_type}
+                if route.next_hop_add:
+                    properties['nextHopIpAddress'] = route.next_hop_add
+                table['properties']['routes'].append({'name': route.name, 'properties': properties})
+            self.arm_put(path, table)
+        except Exception as e:
+            log.error("Unable to replace routes of route-table %s: %s" %(route_table, e))
+            raise
+
+    '''
+    ************************************
+    Azure REST Network Functions
+    ************************************
+    '''
+
+    def delete_public_ip(self, rg_name, vm_name, pip_name=None):
+        '''See AzureCLI.delete_public_ip'''
+        # Check vm Deleted
+        assert vm_name not in self.list_vm(rg_name), "VM is still present delete before deleting Public IP"
+        pip_name = pip_name or vm_name + "PublicIP"
+        try:
+            self.arm_delete(self._path(rg_name, 'Microsoft.Network/publicIPAddresses', pip_name))
+        except Exception as e:
+            log.error("Unable to delete Public IP %s: %s" %(pip_name,e))
+            raise
+
+    def list_pip(self, rg_name, json=False, fields=None, query=None):
+        '''See AzureCLI.list_pip'''
+        return self._dumps(self.arm_list(self._path(rg_name, 'Microsoft.Network/publicIPAddresses')),
+                           json, fields, query)
+
+    def get_public_ip_from_vm(self, pip_name, rg_name):
+        '''See AzureCLI.get_public_ip_from_vm'''
+        pip = self.arm_get(self._path(rg_name, 'Microsoft.Network/publicIPAddresses', pip_name))
+        ip = pip['properties'].get('ipAddress')
+        assert ip, "Unable to find public ip in output %s" %pip
+        return ip
+
+    def list_nsg(self, rg_name, json=False, fields=None, query=None):
+        '''See AzureCLI.list_nsg'''
+        return self._dumps(self.arm_list(self._path(rg_name, 'Microsoft.Network/networkSecurityGroups')),
+                           json, fields, query)
+
+    def delete_nsg(self, rg_name, vm_name, nsg_name=None):
+        '''See AzureCLI.delete_nsg'''
+        # Check vm Deleted
+        assert vm_name not in self.list_vm(rg_name), "VM is still present delete before deleting NSG"
+        nsg_name = nsg_name or vm_name + "NSG"
+        try:
+            self.arm_delete(self._path(rg_name, 'Microsoft.Network/networkSecurityGroups', nsg_name))
+        except Exception as e:
+            log.error("Unable to delete NSG %s: %s" %(nsg_name,e))
+            raise
+
+    def list_nic(self, rg_name, json=False, fields=None, query=None):
+        '''See AzureCLI.list_nic'''
+        return self._dumps(self.arm_list(self._path(rg_name, 'Microsoft.Network/networkInterfaces')),
+                           json, fields, query)
+
+    def delete_nic(self, rg_name, vm_name, nic_name=None):
+        '''See AzureCLI.delete_nic'''
+        # Check vm Deleted
+        assert vm_name not in self.list_vm(rg_name), "VM is still present delete before deleting NIC"
+        nic_name = nic_name or vm_name + "VMNic"
+        try:
+            self.arm_delete(self._path(rg_name, 'Microsoft.Network/networkInterfaces', nic_name))
+        except Exception as e:
+            log.error("Unable to delete NIC %s: %s" %(nic_name,e))
+            raise
+
+    def delete_disk(self, rg_name, vm_name, disk_name=None):
+        '''See AzureCLI.delete_disk'''
+        # Check vm Deleted
+        assert vm_name not in self.list_vm(rg_name), "VM is still present delete before deleting disk"
+        disk_name = disk_name or self.get_disk_name(rg_name, vm_name)
+        try:
+            self.arm_delete(self._path(rg_name, 'Microsoft.Compute/disks', disk_name))
+        except Exception as e:
+            log.error("Unable to delete disk %s: %s" %(disk_name,e))
+            raise
+
+    def list_disk(self, rg_name, json=False, fields=None, query=None):
+        '''See AzureCLI.list_disk'''
+        return self._dumps(self.arm_list(self._path(rg_name, 'Microsoft.Compute/disks')), json, fields, query)
+
+    def get_disk_name(self, rg_name, vm_name):
+        '''See AzureCLI.get_disk_name'''
+        disks = [disk['name'] for disk in self.arm_list(self._path(rg_name, 'Microsoft.Compute/disks'))
+                 if disk['name'].startswith(vm_name + "_")]
+        assert disks, "VM %s is not present in disks of %s" %(vm_name, rg_name)
+        return disks[0]
+
+    '''
+    ************************************
+    Azure REST Storage Functions
+    ************************************
+    '''
+
+    def create_storage(self, name, rg_name, location=None, sku="Standard_LRS"):
+        '''See AzureCLI.create_storage'''
+        location = self._location(location)
+        try:
+            self.arm_put(self._path(rg_name, 'Microsoft.Storage/storageAccounts', name),
+                         {'location': location, 'sku': {'name': sku}, 'kind': 'StorageV2'})
+        except Exception as e:
+            log.error("Unable to create storage %s: %s" %(name, e))
+            raise
+
+    def delete_storage(self, name, rg_name):
+        '''See AzureCLI.delete_storage'''
+        try:
+            self.arm_delete(self._path(rg_name, 'Microsoft.Storage/storageAccounts', name))
+        except Exception as e:
+            log.error("Unable to delete storage %s: %s" %(name, e))
+            raise
+
+    def list_storage(self, rg_name, json=False, fields=None, query=None):
+        '''See AzureCLI.list_storage'''
+        return self._dumps(self.arm_list(self._path(rg_name, 'Microsoft.Storage/storageAccounts')),
+                           json, fields, query)
+
+    def show_storage(self, name, rg_name, json=False, fields=None, query=None):
+        '''See AzureCLI.show_storage'''
+        return self._dumps(self.arm_get(self._path(rg_name, 'Microsoft.Storage/storageAccounts', name)),
+                           json, fields, query)
+
+    def get_storage_keys(self, storage_name, rg_name):
+        '''See AzureCLI.get_storage_keys'''
+        out = self.arm_post(self._path(rg_name, 'Microsoft.Storage/storageAccounts', storage_name, 'listKeys'))
+        keys = dict((key['keyName'], key['value']) for key in out['keys'])
+
+        #Keep storage keys out of recorded cassettes
+        if self.cassette:
+            self.cassette.add_secrets(keys.values())
+        return keys
+
+    '''
+    ************************************
+    Azure REST Inventory Functions
+    ************************************
+    '''
+
+    def _activity_events(self, rg_name, start_time, max_events):
+        '''See AzureCLI._activity_events'''
+        query = "eventTimestamp ge '%s'" %time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start_time))
+        if rg_name:
+            query += " and resourceGroupName eq '%s'" %rg_name
+        path = "%s/providers/Microsoft.Insights/eventtypes/management/values?%s" %(self._sub_path(), urlencode(
+            {'$filter': query, '$select': 'eventDataId,resourceId,operationName,status,eventTimestamp'}))
+
+        events = []
+        api_version = self._api_version(path)
+        while path and len(events) < max_events:
+            page = self._request("GET", path, api_version=api_version)[2] or {}
+            events.extend({'id': event.get('eventDataId'), 'resourceId': event.get('resourceId'),
+                           'operation': (event.get('operationName') or {}).get('value'),
+                           'status': (event.get('status') or {}).get('value'),
+                           'time': event.get('eventTimestamp')} for event in page.get('value', []))
+            path = page.get('nextLink')
+        return events[:max_events]
+
+    def _show_resources(self, resource_ids):
+        '''See AzureCLI._show_resources'''
+        found = {}
+        for resource_id in resource_ids:
+            try:
+                found[resource_id.lower()] = self.arm_get(resource_id)
+            except AzureRestError as e:
+                if e.status != 404:
+                    raise
+                found[resource_id.lower()] = None
+        return found
+
+'''
+************************************
+Plan Runner
+************************************
+'''
+
+def _plan_refs(value):
+    '''Step ids referenced in value as "${id}" strings, see run_plan'''
+    if isinstance(value, str):
+        m = re.match(r'^\$\{([\w.-]+)\}$', value)
+        return {m.group(1)} if m else set()
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return set().union(*[_plan_refs(item) for item in value]) if value else set()
+    return set()
+
+def _plan_resolve(value, results):
+    '''Value with "${id}" strings replaced by result of that step'''
+    if isinstance(value, str):
+        m = re.match(r'^\$\{([\w.-]+)\}$', value)
+        return results[m.group(1)] if m else value
+    if isinstance(value, dict):
+        return dict((key, _plan_resolve(item, results)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_plan_resolve(item, results) for item in value]
+    return value
+
+def _plan_json(value):
+    '''Step result as JSON serialisable value'''
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    if isinstance(value, str):
+        #Commands run with -o json return JSON text
+        try:
+            return jsonlib.loads(value) if value.lstrip()[:1] in ('{', '[') else value
+        except ValueError:
+            return value
+    if hasattr(value, '_asdict'):
+        return dict((key, _plan_json(item)) for key, item in value._asdict().items())
+    if isinstance(value, dict):
+        return dict((str(key), _plan_json(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return [_plan_json(item) for item in value]
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return str(value)
+
+def load_plan(path):
+    '''
+    Purpose:
+            Reads plan of AzureCLI operations from YAML or JSON file, see run_plan
+    Arguments:
+            * path - Plan file, JSON if it ends with .json otherwise YAML
+    Returns:
+            Plan as dictionary with list of steps
+    '''
+    with open(path, 'r') as plan_file:
+        plan = jsonlib.load(plan_file) if path.endswith('.json') else yaml.safe_load(plan_file)
+    if isinstance(plan, list):
+        plan = {'steps': plan}
+    return plan
+
+def _plan_steps(azure, plan):
+    '''
+    Checks steps of plan call public methods of azure (object or class) and their dependencies
+    form no cycle. Returns list of steps with id and set of step ids each depends on
+    '''
+    steps = []
+    for index, step in enumerate(plan.get('steps') or []):
+        step = dict(step)
+        step['id'] = str(step.get('id') or "step-%d" %(index + 1))
+        method = step.get('method')
+        if not method or method.startswith('_') or not callable(getattr(azure, method, None)):
+            log.error("Step %s has unknown method %s" %(step['id'], method))
+            raise ValueError("Step %s has unknown method %s" %(step['id'], method))
+        after = step.get('after') or []
+        step['depends'] = set([after] if isinstance(after, str) else after) | \
+                          _plan_refs(step.get('args') or []) | _plan_refs(step.get('kwargs') or {})
+        steps.append(step)
+
+    ids = [step['id'] for step in steps]
+    if len(set(ids)) != len(ids):
+        log.error("Plan has duplicate step ids")
+        raise ValueError("Plan has duplicate step ids")
+    for step in steps:
+        unknown = step['depends'] - set(ids)
+        if unknown:
+            log.error("Step %s depends on unknown steps %s" %(step['id'], ", ".join(sorted(unknown))))
+            raise ValueError("Step %s depends on unknown steps %s" %(step['id'], ", ".join(sorted(unknown))))
+
+    #Check plan has no cycles before anything runs
+    ordered = set()
+    remaining = list(steps)
+    while remaining:
+        ready = [step for step in remaining if step['depends'] <= ordered]
+        if not ready:
+            log.error("Plan steps %s depend on each other" %", ".join(step['id'] for step in remaining))
+            raise ValueError("Plan steps %s depend on each other" %", ".join(step['id'] for step in remaining))
+        ordered.update(step['id'] for step in ready)
+        remaining = [step for step in remaining if step['id'] not in ordered]
+    return steps
+
+def run_plan(azure, plan, max_workers=8, on_result=None):
+    '''
+    Purpose:
+            Runs plan of AzureCLI operations with one logged in object. Each step calls a public
+            method with args and kwargs. A step starts once the steps listed in its 'after' and
+            the steps whose results it uses ("${id}" as a whole argument value) have succeeded,
+            steps without dependencies run at the same time. Steps depending on a failed step
+            are skipped
+    Arguments:
+            * azure - Logged in Azure object
+            * plan - Dictionary with list 'steps', each a dictionary of 'id' (default step-<n>),
+                     'method', 'args', 'kwargs', 'after' and 'timeout' (seconds step may run)
+            * max_workers - Number of steps run at the same time, default 8
+            * on_result - Function called with each PlanStepResult as it finishes, default None
+    Returns:
+            List of PlanStepResult in plan order
+    '''
+    steps = _plan_steps(azure, plan)
+    ids = [step['id'] for step in steps]
+    start_time = time.time()
+    results = {}
+    outputs = {}
+    pending = list(steps)
+
+    def finish(step, status, started, result=None, error=None):
+        results[step['id']] = PlanStepResult(step['id'], step['method'], status, result, error,
+                                             started - start_time, time.time() - started)
+        if on_result:
+            on_result(results[step['id']])
+
+    def call(step):
+        args = _plan_resolve(step.get('args') or [], outputs)
+        kwargs = _plan_resolve(step.get('kwargs') or {}, outputs)
+        target = azure.scope(step['timeout']) if step.get('timeout') else azure
+        return getattr(target, step['method'])(*args, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while pending or running:
+            for step in list(pending):
+                failed = [dep for dep in step['depends'] if dep in results and results[dep].status != 'ok']
+                if failed:
+                    pending.remove(step)
+                    finish(step, 'skipped', time.time(), error="Depends on failed step %s" %", ".join(sorted(failed)))
+                elif all(dep in outputs for dep in step['depends']):
+                    pending.remove(step)
+                    running[executor.submit(call, step)] = (step, time.time())
+            if not running:
+                continue
+
+            try:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+            except KeyboardInterrupt:
+                #Stop running steps instead of waiting for them
+                azure.cancel("interrupted")
+                raise
+            for future in done:
+                step, started = running.pop(future)
+                try:
+                    outputs[step['id']] = future.result()
+                except Exception as e:
+                    log.error("Step %s (%s) failed: %s" %(step['id'], step['method'], e))
+                    finish(step, 'failed', started, error="%s: %s" %(type(e).__name__, e))
+                else:
+                    finish(step, 'ok', started, result=outputs[step['id']])
+
+    return [results[step_id] for step_id in ids]
+
+def main(argv=None):
+    '''
+    Purpose:
+            Command line entry point, python -m azure_lib plan.yaml. Logs in once, runs plan with
+            run_plan and writes a JSON line per finished step (id, method, status, result, error,
+            start and elapsed seconds) followed by a summary line. Credentials are read from the
+            plan 'login' object or AZURE_APPID, AZURE_DIRID and AZURE_KEY (or AZURE_USERNAME and
+            AZURE_PW) environment variables. Login goes to a temporary Azure CLI configuration
+            directory removed afterwards, so the profile of the user and other runs are left alone
+    Arguments:
+            * argv - Command line arguments, default sys.argv
+    Returns:
+            Exit code, 0 if every step succeeded
+    '''
+    parser = argparse.ArgumentParser(prog="python -m azure_lib",
+                                     description="Run a YAML or JSON plan of AzureCLI operations")
+    parser.add_argument("plan", help="Plan file, JSON if it ends with .json otherwise YAML")
+    parser.add_argument("-o", "--output", help="File to write results to, default stdout")
+    parser.add_argument("-j", "--max-workers", type=int, help="Steps run at the same time, default 8")
+    parser.add_argument("--backend", choices=("cli", "arm"), help="Azure CLI or REST backend, default cli")
+    parser.add_argument("--cassette", help="Replay commands from cassette instead of running them")
+    parser.add_argument("--timeout", type=float, help="Seconds whole plan may run, default plan timeout or none")
+    parser.add_argument("--config-dir", help="Azure CLI configuration directory to log in to, "
+                                             "default a temporary one removed after plan finishes")
+    parser.add_argument("--no-logout", action="store_true", help="Stay logged in to --config-dir after plan finishes")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log progress to stderr")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    plan = load_plan(args.plan)
+    login = dict(plan.get('login') or {})
+    for name in ('appid', 'dirid', 'key', 'username', 'pw', 'subscription'):
+        login[name] = os.environ.get("AZURE_" + name.upper(), login.get(name))
+    subscription = login.pop('subscription')
+    backend = args.backend or plan.get('backend') or "cli"
+    cassette = AzCassette(args.cassette) if args.cassette else None
+
+    #Bad plan is reported before logging in
+    _plan_steps(AzureARM if backend == "arm" else AzureCLI, plan)
+    config_dir = args.config_dir or tempfile.mkdtemp(prefix="azure_lib-")
+    try:
+        if backend == "arm":
+            azure = AzureARM(cassette=cassette, subscription=subscription, config_dir=config_dir, **login)
+        else:
+            azure = AzureCLI(cassette=cassette, config_dir=config_dir, **login)
+        azure.login_azure_cli()
+    except Exception:
+        if not args.config_dir:
+            shutil.rmtree(config_dir, ignore_errors=True)
+        raise
+    session = azure
+    if subscription and backend != "arm":
+        azure = azure.context(subscription)
+    if args.timeout or plan.get('timeout'):
+        azure = azure.scope(args.timeout or plan['timeout'])
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    lock = threading.Lock()
+
+    def write(result):
+        line = jsonlib.dumps(_plan_json(result))
+        with lock:
+            out.write(line + "\n")
+            out.flush()
+
+    start_time = time.time()
+    try:
+        results = run_plan(azure, plan, args.max_workers or plan.get('max_workers') or 8, write)
+    finally:
+        if not (args.no_logout and args.config_dir):
+            session.disconnect_azure()
+        if not args.config_dir:
+            shutil.rmtree(config_dir, ignore_errors=True)
+    counts = dict((status, sum(1 for result in results if result.status == status))
+                  for status in ('ok', 'failed', 'skipped'))
+    out.write(jsonlib.dumps({'summary': dict(counts, steps=len(results), elapsed=time.time() - start_time)}) + "\n")
+    if args.output:
+        out.close()
+    return 0 if counts['ok'] == len(results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,321 @@
+##########################################################
+#
+#   Name:   azure_lib_bench
+#
+#   Purpose:  Benchmarks AzureCLI workflows against a local
+#             fake az with configurable latency and failure
+#             injection. Reports az process spawns, wall time
+#             and peak RSS for each workflow.
+#
+#   Usage:    python azure_lib_bench.py [--latency 0.05]
+#                 [--latency-for "vm create=1.5"]
+#                 [--fail-rate "vm create=0.1"]
+#                 [--flows network,linux] [--json]
+#
+###########################################################
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+FLOWS = ['network', 'linux', 'storage', 'template', 'routes']
+
+# Fake az - keeps a small resource state so the AzureCLI checks made in
+# the workflows (VM gone before disk delete, container exists before upload...) pass
+FAKE_AZ = r'''#!%(python)s
+import fcntl, json, os, random, re, sys, time
+
+config = json.load(open(os.environ["FAKE_AZ_CONFIG"]))
+args = sys.argv[1:]
+command = " ".join(arg for arg in args if not arg.startswith("-")).split(" ")
+
+def option(*names):
+    for name in names:
+        if name in args:
+            return args[args.index(name) + 1]
+
+def matches(key):
+    return " ".join(command).startswith(key)
+
+#Spawn accounting - parent shell means an extra process per call
+try:
+    parent = open("/proc/%%d/comm" %%os.getppid()).read().strip()
+except Exception:
+    parent = ""
+with open(config["count_file"], "a") as counter:
+    counter.write("%%s %%s\n" %%(parent, " ".join(command[:3])))
+
+#Latency and failure injection, longest matching command prefix wins
+keys = sorted(config["latency"], key=len, reverse=True)
+latency = next((config["latency"][key] for key in keys if key and matches(key)), config["latency"].get("", 0))
+time.sleep(latency)
+for key in sorted(config["fail_rate"], key=len, reverse=True):
+    if matches(key):
+        if random.random() < config["fail_rate"][key]:
+            sys.stderr.write("ERROR: injected failure for %%s\n" %%key)
+            sys.exit(1)
+        break
+
+with open(config["state_file"], "a+") as state_file:
+    fcntl.flock(state_file, fcntl.LOCK_EX)
+    state_file.seek(0)
+    state = json.loads(state_file.read() or "{}")
+    kinds = ["vm", "disk", "nic", "nsg", "pip", "container"]
+    for kind in kinds:
+        state.setdefault(kind, [])
+    name = option("-n", "--name")
+    out = {}
+
+    def table(names):
+        return "Name\n" + "-" * 20 + "\n" + "".join("%%s\n" %%n for n in names)
+
+    if matches("vm create"):
+        state["vm"].append(name)
+        state["disk"].append(name + "_OsDisk_1_0123456789abcdef")
+        state["nic"].append(name + "VMNic")
+        state["nsg"].append(name + "NSG")
+        state["pip"].append(name + "PublicIP")
+        out = {"powerState": "VM running", "publicIpAddress": "52.0.0.1",
+               "privateIpAddress": "10.0.0.4", "resourceGroup": option("-g")}
+    elif matches("vm delete"):
+        state["vm"].remove(name)
+    elif matches("disk delete"):
+        state["disk"].remove(name)
+    elif matches("network nic delete"):
+        state["nic"].remove(name)
+    elif matches("network nsg delete"):
+        state["nsg"].remove(name)
+    elif matches("network public-ip delete"):
+        state["pip"].remove(name)
+    elif matches("storage container create"):
+        state["container"].append(name)
+    elif matches("storage container delete"):
+        state["container"].remove(name)
+    elif matches("storage account keys list"):
+        out = [{"keyName": "key1", "permissions": "Full", "value": "ZmFrZWtleQ=="},
+               {"keyName": "key2", "permissions": "Full", "value": "ZmFrZWtleTI="}]
+    elif matches("group deployment create"):
+        out = {"name": "deployment", "properties": {"provisioningState": "Succeeded", "outputs": {}}}
+
+    listings = {"vm list": "vm", "disk list": "disk", "network nic list": "nic",
+                "network nsg list": "nsg", "network public-ip list": "pip",
+                "storage container list": "container"}
+    for key in listings:
+        if matches(key):
+            out = [{"name": n} for n in state[listings[key]]]
+            if listings[key] == "pip":
+                out = [dict(record, ipAddress="52.0.0.1") for record in out]
+    if matches("resource list"):
+        out = [{"name": n} for kind in kinds for n in state[kind]]
+
+    state_file.seek(0)
+    state_file.truncate()
+    state_file.write(json.dumps(state))
+
+#Name filters pushed down by AzureCLI ie [?starts_with(name, 'vm_')].name
+query = re.match(r"\[\?(?:starts_with\(name, '(.*)'\)|name=='(.*)')\]\.(\w+)$", option("--query") or "")
+if query and isinstance(out, list):
+    out = [record.get(query.group(3)) for record in out if record["name"].startswith(query.group(1) or "")
+           and query.group(2) in (None, record["name"])]
+
+if query and option("-o") == "tsv":
+    sys.stdout.write("".join("%%s\n" %%value for value in out))
+elif option("-o") in ("table", "tsv") and isinstance(out, list):
+    sys.stdout.write(table(n["name"] for n in out))
+else:
+    sys.stdout.write(json.dumps(out, indent=2) + "\n")
+'''
+
+
+def run_flow(flow, workdir, routes=50, subnets=5):
+    '''
+    Purpose:
+            Runs one workflow against the fake az, has to run in its own process so
+            peak RSS belongs to that workflow only
+    Arguments:
+            * flow - Name of workflow, one of FLOWS
+            * workdir - Directory holding the fake az, its configuration and files for the flow
+            * routes - Number of routes programmed in the routes flow, default 50
+            * subnets - Number of subnets added in the network flow, default 5
+    '''
+    from azure_lib import AzureCLI
+
+    azure = AzureCLI(appid="bench-app", dirid="bench-dir", key="bench-key")
+    rg = "bench-rg"
+
+    if flow == 'network':
+        azure.create_rg(rg)
+        azure.create_vnet("bench-vnet", rg, "10.0.0.0/16")
+        for i in range(subnets):
+            azure.add_vnet_subnet("subnet%d" %i, rg, "bench-vnet", "10.0.%d.0/24" %i)
+
+    elif flow == 'linux':
+        azure.deploy_linux("benchvm", rg, "bench-vnet", "subnet0")
+        azure.delete_linux("benchvm", rg)
+
+    elif flow == 'storage':
+        image = os.path.join(workdir, "image.vhd")
+        azure.create_storage("benchstorage", rg)
+        azure.create_storage_container("images", rg, "benchstorage")
+        azure.list_storage_container(rg, "benchstorage")
+        azure.upload_vhd_to_container("images", "benchstorage", rg, image)
+        azure.delete_storage_container("images", rg, "benchstorage")
+        azure.delete_storage("benchstorage", rg)
+
+    elif flow == 'template':
+        azure.deploy_from_template_custom_image(rg, "benchstorage", os.path.join(workdir, "image.vhd"),
+                                                os.path.join(workdir, "template.json"),
+                                                os.path.join(workdir, "parameters.json"))
+
+    elif flow == 'routes':
+        azure.add_route_table(rg, "bench-rt")
+        for i in range(routes):
+            azure.add_route(rg, "bench-rt", "route%d" %i, "10.%d.0.0/16" %i, "10.0.0.4")
+
+    else:
+        raise ValueError("Unknown flow %s, use one of %s" %(flow, ", ".join(FLOWS)))
+
+
+def bench_flow(flow, workdir, config, routes=50, subnets=5):
+    '''
+    Purpose:
+            Runs one workflow in a child process against a fresh fake az state and
+            collects its measurements
+    Arguments:
+            * flow - Name of workflow, one of FLOWS
+            * workdir - Directory holding the fake az
+            * config - Fake az configuration dictionary (latency, fail_rate)
+            * routes - Number of routes programmed in the routes flow, default 50
+            * subnets - Number of subnets added in the network flow, default 5
+    Returns:
+            Dictionary with flow, ok, error, az_calls, spawns, wall_s and peak_rss_kb
+    '''
+    config = dict(config, count_file=os.path.join(workdir, "%s.count" %flow),
+                  state_file=os.path.join(workdir, "%s.state" %flow))
+    for path in (config["count_file"], config["state_file"]):
+        if os.path.exists(path):
+            os.remove(path)
+    config_file = os.path.join(workdir, "%s.config.json" %flow)
+    with open(config_file, "w") as f:
+        json.dump(config, f)
+
+    env = dict(os.environ, FAKE_AZ_CONFIG=config_file,
+               PATH=workdir + os.pathsep + os.environ.get("PATH", ""),
+               PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-flow", flow,
+                           "--workdir", workdir, "--routes", str(routes), "--subnets", str(subnets)],
+                          env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    wall = time.perf_counter() - start
+
+    child = {}
+    if proc.stdout.strip():
+        child = json.loads(proc.stdout.decode('utf-8').strip().splitlines()[-1])
+
+    calls = []
+    if os.path.exists(config["count_file"]):
+        calls = [line.split(" ", 1)[0] for line in open(config["count_file"]).read().splitlines()]
+
+    ok = proc.returncode == 0 and child.get('ok', False)
+    error = None
+    if not ok:
+        error = child.get('error') or (proc.stderr.decode('utf-8', 'replace').strip().splitlines() or [None])[-1]
+
+    return {'flow': flow,
+            'ok': ok,
+            'error': error,
+            'az_calls': len(calls),
+            #Each call spawned through a shell costs an extra process
+            'spawns': len(calls) + sum(parent in ("sh", "bash", "dash") for parent in calls),
+            'wall_s': round(child.get('wall_s', wall), 3),
+            'peak_rss_kb': child.get('peak_rss_kb')}
+
+
+def setup_workdir(workdir):
+    '''Writes the fake az and the files used by the storage and template flows'''
+    fake_az = os.path.join(workdir, "az")
+    with open(fake_az, "w") as f:
+        f.write(FAKE_AZ %{'python': sys.executable})
+    os.chmod(fake_az, 0o755)
+
+    with open(os.path.join(workdir, "image.vhd"), "wb") as f:
+        f.truncate(1024 * 1024)
+    with open(os.path.join(workdir, "template.json"), "w") as f:
+        json.dump({"$schema": "https://schema.management.azure.com/schemas/2015-01-01/deploymentTemplate.json#",
+                   "contentVersion": "1.0.0.0", "resources": []}, f)
+    with open(os.path.join(workdir, "parameters.json"), "w") as f:
+        json.dump({"contentVersion": "1.0.0.0", "parameters": {}}, f)
+
+
+def parse_rates(values):
+    '''Turns ["vm create=1.5", ...] into {"vm create": 1.5, ...}'''
+    rates = {}
+    for value in values or []:
+        key, _, rate = value.rpartition("=")
+        rates[key.strip()] = float(rate)
+    return rates
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark AzureCLI workflows against a fake az")
+    parser.add_argument("--flows", default=",".join(FLOWS), help="Comma separated flows to run")
+    parser.add_argument("--latency", type=float, default=0.0, help="Default seconds added to every az call")
+    parser.add_argument("--latency-for", action="append", help="Latency for a command ie 'vm create=1.5'")
+    parser.add_argument("--fail-rate", action="append", help="Failure rate for a command ie 'vm create=0.1'")
+    parser.add_argument("--repeat", type=int, default=1, help="Times each flow is run")
+    parser.add_argument("--routes", type=int, default=50, help="Routes programmed in the routes flow")
+    parser.add_argument("--subnets", type=int, default=5, help="Subnets added in the network flow")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+    parser.add_argument("--run-flow", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_flow:
+        #Child process - run one flow and report
+        start = time.perf_counter()
+        result = {'ok': True, 'error': None}
+        try:
+            run_flow(args.run_flow, args.workdir, args.routes, args.subnets)
+        except (Exception, AssertionError) as e:
+            result = {'ok': False, 'error': "%s: %s" %(type(e).__name__, e)}
+        result['wall_s'] = time.perf_counter() - start
+        result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(json.dumps(result))
+        return 0
+
+    latency = parse_rates(args.latency_for)
+    latency[""] = args.latency
+    config = {'latency': latency, 'fail_rate': parse_rates(args.fail_rate)}
+
+    workdir = tempfile.mkdtemp(prefix="azure_lib_bench")
+    try:
+        setup_workdir(workdir)
+        results = []
+        for flow in args.flows.split(","):
+            for _ in range(args.repeat):
+                results.append(bench_flow(flow.strip(), workdir, config, args.routes, args.subnets))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        print("%-10s %-5s %9s %7s %9s %12s" %("flow", "ok", "az_calls", "spawns", "wall_s", "peak_rss_kb"))
+        for result in results:
+            print("%-10s %-5s %9d %7d %9.3f %12s" %(result['flow'], result['ok'], result['az_calls'],
+                                                    result['spawns'], result['wall_s'], result['peak_rss_kb']))
+            if not result['ok']:
+                print("           error: %s" %result['error'])
+
+    return 0 if all(result['ok'] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,396 @@
+'''
+Tests of azure_lib logic that runs without Azure - JSON streaming, address planning, route
+diffs, field queries, plans, and the REST backend and blob downloads against local stub servers
+'''
+import io
+import json
+import os
+import re
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+import pytest
+
+import azure_lib
+from azure_lib import AddressPlanner, Route, _fields_query, _iter_json_array, run_plan
+
+
+def serve(handler):
+    '''Starts handler on a local port, returns server and its URL'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d" %server.server_port
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''Base of stub servers - keep-alive responses, no request logging'''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+'''
+************************************
+JSON Streaming
+************************************
+'''
+
+class TrickleStream():
+    '''Byte stream returning at most size bytes per read, like a pipe'''
+
+    def __init__(self, data, size):
+        self.data = io.BytesIO(data)
+        self.size = size
+
+    def read(self, size):
+        return self.data.read(min(size, self.size))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 65536])
+def test_iter_json_array_across_chunks(chunk_size):
+    records = [{'name': 'vm1', 'tags': {'env': 'café'}}, [1, 2], "a,]b", 12345, 1.5, None, True]
+    data = json.dumps(records, indent=2).encode('utf-8')
+    assert list(_iter_json_array(TrickleStream(data, chunk_size), chunk_size)) == records
+
+
+def test_iter_json_array_empty():
+    assert list(_iter_json_array(io.BytesIO(b" [ ] "))) == []
+    assert list(_iter_json_array(io.BytesIO(b""))) == []
+
+
+def test_iter_json_array_keeps_number_cut_by_chunk():
+    assert list(_iter_json_array(TrickleStream(b"[123456789]", 3), 3)) == [123456789]
+
+
+def test_iter_json_array_rejects_other_output():
+    with pytest.raises(ValueError):
+        list(_iter_json_array(io.BytesIO(b'{"name": "vm1"}')))
+
+
+def test_iter_json_array_truncated():
+    elements = _iter_json_array(io.BytesIO(b'[{"name": "vm1"}, {"name": "v'), 8)
+    assert next(elements) == {'name': 'vm1'}
+    with pytest.raises(ValueError):
+        next(elements)
+
+
+'''
+************************************
+Address Planning
+************************************
+'''
+
+def test_planner_allocates_lowest_free_prefixes():
+    planner = AddressPlanner({'vnet': ['10.0.0.0/16']}, {'vnet': ['10.0.0.0/24']})
+    assert str(planner.allocate('vnet', 24)) == '10.0.1.0/24'
+    assert str(planner.allocate('vnet', 25)) == '10.0.2.0/25'
+    assert str(planner.allocate('vnet', 23)) == '10.0.4.0/23'
+    assert str(planner.allocate('vnet', 25)) == '10.0.2.128/25'
+
+
+def test_planner_overlaps_finds_every_used_prefix():
+    planner = AddressPlanner({'vnet': ['10.0.0.0/16']}, {'vnet': ['10.0.%d.0/24' %i for i in range(4)]})
+    assert [str(prefix) for prefix in planner.overlaps('vnet', '10.0.0.0/16')] == \
+           ['10.0.0.0/24', '10.0.1.0/24', '10.0.2.0/24', '10.0.3.0/24']
+    assert [str(prefix) for prefix in planner.overlaps('vnet', '10.0.1.128/25')] == ['10.0.1.0/24']
+    assert [str(prefix) for prefix in planner.overlaps('vnet', '10.0.2.0/23')] == ['10.0.2.0/24', '10.0.3.0/24']
+    assert planner.overlaps('vnet', '10.0.4.0/24') == []
+
+
+def test_planner_reserve_checks_prefix():
+    planner = AddressPlanner({'vnet': ['10.0.0.0/16']})
+    planner.reserve('vnet', '10.0.1.0/24')
+    with pytest.raises(ValueError):
+        planner.reserve('vnet', '10.0.0.0/23')
+    with pytest.raises(ValueError):
+        planner.reserve('vnet', '10.1.0.0/24')
+    #Free space around reserved prefix is still handed out
+    assert str(planner.allocate('vnet', 24)) == '10.0.0.0/24'
+    assert str(planner.allocate('vnet', 24)) == '10.0.2.0/24'
+
+
+def test_planner_release_merges_buddies():
+    planner = AddressPlanner({'vnet': ['10.0.0.0/24']})
+    halves = [planner.allocate('vnet', 25), planner.allocate('vnet', 25)]
+    with pytest.raises(ValueError):
+        planner.allocate('vnet', 26)
+    for half in halves:
+        planner.release('vnet', half)
+    assert str(planner.allocate('vnet', 24)) == '10.0.0.0/24'
+    with pytest.raises(ValueError):
+        planner.release('vnet', '10.0.1.0/24')
+
+
+'''
+************************************
+Routes and Fields
+************************************
+'''
+
+def test_diff_routes():
+    azure = azure_lib.AzureCLI('appid', 'dirid', 'key')
+    current = [{'name': 'keep', 'addressPrefix': '10.1.0.0/16', 'nextHopType': 'VirtualAppliance',
+                'nextHopIpAddress': '10.0.0.4'},
+               {'name': 'Move', 'properties': {'addressPrefix': '10.2.0.0/16', 'nextHopType': 'VirtualAppliance',
+                                               'nextHopIpAddress': '10.0.0.4'}},
+               {'name': 'old', 'addressPrefix': '10.3.0.0/16', 'nextHopType': 'Internet'}]
+    dumps = json.dumps
+    azure.show_routes = lambda rg_name, route_table, json=False: dumps(current)
+
+    diff = azure.diff_routes('rg', 'rt', [('keep', '10.1.0.0/16', None, '10.0.0.4'),
+                                          {'name': 'move', 'prefix': '10.2.0.0/16', 'next_hop_type': None,
+                                           'next_hop_add': '10.0.0.5'},
+                                          Route('new', '10.4.0.0/16', 'Internet', None)])
+    assert diff.unchanged == [Route('keep', '10.1.0.0/16', 'VirtualAppliance', '10.0.0.4')]
+    assert diff.updates == [Route('move', '10.2.0.0/16', 'VirtualAppliance', '10.0.0.5')]
+    assert diff.adds == [Route('new', '10.4.0.0/16', 'Internet', None)]
+    assert diff.deletes == [Route('old', '10.3.0.0/16', 'Internet', None)]
+
+
+def test_fields_query():
+    assert _fields_query(['name', 'ipAddress']) == "[].{name:name, ipAddress:ipAddress}"
+    assert _fields_query('hardwareProfile.vmSize', many=False) == "{vmSize:hardwareProfile.vmSize}"
+    assert _fields_query({'ip': 'ipAddress'}) == "[].{ip:ipAddress}"
+    assert _fields_query(['name', 'ipAddress'], tsv=True) == "[].[name, ipAddress]"
+
+
+def test_fields_query_rejects_clashing_names():
+    with pytest.raises(ValueError):
+        _fields_query(['osProfile.name', 'name'])
+
+
+'''
+************************************
+Plans
+************************************
+'''
+
+class PlanAzure():
+    '''Stands in for a logged in Azure object, records calls'''
+
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def create_rg(self, rg_name, location=None):
+        with self._lock:
+            self.calls.append(('create_rg', rg_name))
+        return rg_name
+
+    def create_vnet(self, name, rg_name):
+        with self._lock:
+            self.calls.append(('create_vnet', name, rg_name))
+        return {'name': name, 'resourceGroup': rg_name}
+
+    def delete_rg(self, rg_name):
+        raise RuntimeError("rg %s is locked" %rg_name)
+
+
+def test_run_plan_passes_results_and_skips_dependents_of_failures():
+    azure = PlanAzure()
+    finished = []
+    plan = {'steps': [{'id': 'rg', 'method': 'create_rg', 'args': ['rg1']},
+                      {'id': 'vnet', 'method': 'create_vnet', 'kwargs': {'name': 'v', 'rg_name': '${rg}'}},
+                      {'id': 'drop', 'method': 'delete_rg', 'args': ['rg2']},
+                      {'method': 'create_rg', 'args': ['rg3'], 'after': 'drop'}]}
+    results = run_plan(azure, plan, max_workers=4, on_result=finished.append)
+
+    assert [(result.id, result.status) for result in results] == \
+           [('rg', 'ok'), ('vnet', 'ok'), ('drop', 'failed'), ('step-4', 'skipped')]
+    assert results[1].result == {'name': 'v', 'resourceGroup': 'rg1'}
+    assert results[2].error == "RuntimeError: rg rg2 is locked"
+    assert azure.calls.index(('create_rg', 'rg1')) < azure.calls.index(('create_vnet', 'v', 'rg1'))
+    assert ('create_rg', 'rg3') not in azure.calls
+    assert sorted(result.id for result in finished) == ['drop', 'rg', 'step-4', 'vnet']
+
+
+@pytest.mark.parametrize('steps', [
+    [{'method': '_run'}],
+    [{'method': 'deploy_everything'}],
+    [{'id': 'a', 'method': 'create_rg', 'after': 'b'}, {'id': 'b', 'method': 'create_rg', 'after': 'a'}],
+    [{'id': 'a', 'method': 'create_rg', 'args': ['${missing}']}],
+    [{'id': 'a', 'method': 'create_rg'}, {'id': 'a', 'method': 'create_rg'}]])
+def test_run_plan_rejects_bad_plans_before_running(steps):
+    azure = PlanAzure()
+    with pytest.raises(ValueError):
+        run_plan(azure, {'steps': steps})
+    assert azure.calls == []
+
+
+'''
+************************************
+REST Backend
+************************************
+'''
+
+class ArmHandler(StubHandler):
+    '''Resource Manager stub - PUT finishes through an Azure-AsyncOperation polled twice'''
+    resources = {}
+    operations = {}
+    requests = []
+
+    def reply(self, status, value=None, headers=None):
+        self.send(status, json.dumps(value).encode() if value is not None else b"", headers)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path.lower()
+        self.requests.append(('GET', path))
+        if path in self.operations:
+            self.operations[path] += 1
+            return self.reply(200, {'status': 'Succeeded' if self.operations[path] > 1 else 'InProgress'},
+                              {'Retry-After': '0'})
+        if path in self.resources:
+            return self.reply(200, self.resources[path])
+        self.reply(404, {'error': {'code': 'ResourceNotFound', 'message': "%s not found" %path}})
+
+    def do_PUT(self):
+        path = urlsplit(self.path).path.lower()
+        self.requests.append(('PUT', path))
+        assert self.headers['Authorization'] == "Bearer TOKEN"
+        assert re.search(r'api-version=\d{4}-\d\d-\d\d', self.path)
+        resource = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        resource.update({'id': path, 'name': path.rsplit('/', 1)[1]})
+        resource.setdefault('properties', {})['provisioningState'] = 'Succeeded'
+        self.resources[path] = resource
+        operation = "/operations/%d" %len(self.operations)
+        self.operations[operation] = 0
+        self.reply(201, resource, {'Azure-AsyncOperation': "http://%s%s" %(self.headers['Host'], operation),
+                                   'Retry-After': '0'})
+
+
+@pytest.fixture
+def arm():
+    ArmHandler.resources, ArmHandler.operations, ArmHandler.requests = {}, {}, []
+    server, url = serve(ArmHandler)
+    azure = azure_lib.AzureARM(token="TOKEN", subscription="sub1", endpoint=url, poll_interval=0)
+    azure.login_azure_cli()
+    yield azure
+    azure.disconnect_azure()
+    server.shutdown()
+    server.server_close()
+
+
+def test_arm_create_rg(arm):
+    arm.create_rg('rg1', 'westus')
+    rg_path = '/subscriptions/sub1/resourcegroups/rg1'
+    assert ArmHandler.resources[rg_path]['location'] == 'westus'
+    assert json.loads(arm.show_rg('rg1'))['name'] == 'rg1'
+
+
+def test_arm_create_vnet_polls_async_operation(arm):
+    arm.create_vnet('vnet1', 'rg1', '10.0.0.0/16', 'westus', subnet_name='sub1', subnet_prefix='10.0.0.0/24')
+
+    vnet_path = '/subscriptions/sub1/resourcegroups/rg1/providers/microsoft.network/virtualnetworks/vnet1'
+    assert ArmHandler.requests[0] == ('PUT', vnet_path)
+    #Operation reported InProgress once before it succeeded
+    assert list(ArmHandler.operations.values()) == [2]
+    vnet = ArmHandler.resources[vnet_path]
+    assert vnet['properties']['addressSpace'] == {'addressPrefixes': ['10.0.0.0/16']}
+    assert vnet['properties']['subnets'] == [{'name': 'sub1', 'properties': {'addressPrefix': '10.0.0.0/24'}}]
+
+
+def test_arm_show_vnet_fields(arm):
+    arm.create_vnet('vnet1', 'rg1', '10.0.0.0/16', 'westus')
+    assert json.loads(arm.show_vnet('vnet1', 'rg1', json=True, fields=['name', 'addressSpace.addressPrefixes'])) == \
+           {'name': 'vnet1', 'addressPrefixes': ['10.0.0.0/16']}
+    assert arm.show_vnet('vnet1', 'rg1', fields={'state': 'provisioningState', 'where': 'location'}) == \
+           "Succeeded\twestus\n"
+
+
+def test_arm_missing_resource(arm):
+    with pytest.raises(azure_lib.AzureRestError) as error:
+        arm.show_vnet('missing', 'rg1')
+    assert error.value.status == 404
+    assert error.value.code == 'ResourceNotFound'
+
+
+'''
+************************************
+Blob Downloads
+************************************
+'''
+
+BLOB = bytes(range(256)) * 32
+
+class BlobHandler(StubHandler):
+    '''Blob service stub of one block blob - ranged GETs fail once fail_after of them were served'''
+    etag = '"0x1"'
+    fail_after = None
+    ranges = []
+
+    def do_HEAD(self):
+        self.send(200, BLOB, {'ETag': self.etag, 'x-ms-blob-type': 'BlockBlob'})
+
+    def do_GET(self):
+        start, end = map(int, re.match(r'bytes=(\d+)-(\d+)', self.headers['x-ms-range']).groups())
+        if self.headers.get('If-Match') != self.etag:
+            return self.send(412, b"", {'x-ms-error-code': 'ConditionNotMet'})
+        if self.fail_after is not None and len(self.ranges) >= self.fail_after:
+            return self.send(403, b"", {'x-ms-error-code': 'AuthenticationFailed'})
+        type(self).ranges.append((start, end + 1))
+        self.send(206, BLOB[start:end + 1], {'ETag': self.etag})
+
+
+@pytest.fixture
+def blob_azure():
+    BlobHandler.etag, BlobHandler.fail_after, BlobHandler.ranges = '"0x1"', None, []
+    server, url = serve(BlobHandler)
+    azure = azure_lib.AzureCLI('appid', 'dirid', 'key')
+    azure._blob_url = lambda *args: (url, "/images/disk.vhd?sig=secret")
+    yield azure
+    server.shutdown()
+    server.server_close()
+
+
+def download(azure, file_path, **kwargs):
+    return azure.download_blob('storage', 'rg', 'images', 'disk.vhd', file_path, max_workers=1, **kwargs)
+
+
+def test_download_blob_resumes_interrupted_download(blob_azure, tmp_path):
+    file_path = str(tmp_path / "disk.vhd")
+    BlobHandler.fail_after = 3
+    with pytest.raises(azure_lib.AzureRestError):
+        download(blob_azure, file_path, chunk_size=1024)
+    assert os.path.exists(file_path + ".progress")
+
+    #Resumed with smaller chunks only fetches chunks not covered by finished ones
+    BlobHandler.fail_after, BlobHandler.ranges = None, []
+    transfer = download(blob_azure, file_path, chunk_size=512)
+    assert (transfer.size, transfer.transferred, transfer.skipped) == (len(BLOB), len(BLOB) - 3072, 3072)
+    assert sorted(BlobHandler.ranges) == [(start, start + 512) for start in range(3072, len(BLOB), 512)]
+    with open(file_path, 'rb') as downloaded:
+        assert downloaded.read() == BLOB
+    assert not os.path.exists(file_path + ".progress")
+
+
+def test_download_blob_restarts_when_blob_changed(blob_azure, tmp_path):
+    file_path = str(tmp_path / "disk.vhd")
+    BlobHandler.fail_after = 2
+    with pytest.raises(azure_lib.AzureRestError):
+        download(blob_azure, file_path, chunk_size=1024)
+
+    BlobHandler.etag, BlobHandler.fail_after, BlobHandler.ranges = '"0x2"', None, []
+    transfer = download(blob_azure, file_path, chunk_size=1024)
+    assert transfer.transferred == len(BLOB)
+    assert len(BlobHandler.ranges) == len(BLOB) // 1024
+
+
+def test_download_blob_without_resume(blob_azure, tmp_path):
+    file_path = str(tmp_path / "disk.vhd")
+    BlobHandler.fail_after = 2
+    with pytest.raises(azure_lib.AzureRestError):
+        download(blob_azure, file_path, chunk_size=1024)
+
+    BlobHandler.fail_after, BlobHandler.ranges = None, []
+    assert download(blob_azure, file_path, chunk_size=1024, resume=False).transferred == len(BLOB)